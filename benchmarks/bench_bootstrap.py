@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the batched bootstrap against the per key bootstrap errorguimonitor used before.
+
+    python benchmarks/bench_bootstrap.py [keys] [resamples]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+from errorguimonitor.significance import BootstrapMedianTest
+
+DEFAULT_KEYS = 50000
+DEFAULT_RESAMPLES = 10000
+TARGET_DAYS = 1
+HISTORY_DAYS = 5
+# the per key bootstrap is timed on a sample of keys and extrapolated
+LEGACY_SAMPLE_KEYS = 200
+
+def check_error_rate_increase(target_errors, history_errors, n_resamples, alpha=0.05):
+    """ the per key bootstrap of ErrorCompareReporter before the batched engine """
+    def samples(data):
+        return data[np.random.randint(0, len(data), (n_resamples, len(data)))]
+
+    target_median_scores = map(np.median, samples(np.array(target_errors)))
+    history_median_scores = map(np.median, samples(np.array(history_errors)))
+
+    delta_median = [x[0] - x[1] for x in zip(target_median_scores, history_median_scores)]
+
+    return np.percentile(delta_median, [100 * alpha / 2., 100 * (1 - alpha / 2.)])
+
+def main(keys, resamples):
+    rng = np.random.default_rng(0)
+    targets = rng.poisson(20, (keys, TARGET_DAYS))
+    histories = rng.poisson(15, (keys, HISTORY_DAYS))
+
+    started = time.perf_counter()
+    for key in range(LEGACY_SAMPLE_KEYS):
+        check_error_rate_increase(targets[key], histories[key], resamples)
+    legacy_time = (time.perf_counter() - started) * keys / LEGACY_SAMPLE_KEYS
+
+    test = BootstrapMedianTest(n_resamples=resamples, rng=np.random.default_rng(0))
+    started = time.perf_counter()
+    intervals = test.intervals(targets, histories)
+    batched_time = time.perf_counter() - started
+
+    print('{} keys x {} resamples: per key {:.1f}s (extrapolated), batched {:.2f}s, {:.0f}x, {} keys increased'.format(
+        keys, resamples, legacy_time, batched_time, legacy_time / batched_time, int((intervals[:, 0] > 0).sum())))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_KEYS,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_RESAMPLES)
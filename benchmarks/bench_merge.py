@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+Benchmark merging daily reports into the error matrix against the nested dicts of lists used before.
+
+    python benchmarks/bench_merge.py [keys] [days]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from errorguimonitor.error_matrix import ErrorMatrix
+from synthetic import generate_reports
+
+DEFAULT_KEYS = 100000
+DEFAULT_DAYS = 6
+
+def merge_reports(reports):
+    """ the merge of ErrorCompareReporter before the error matrix """
+    errors = dict()
+    for report in reports:
+        for module in report:
+            if not module in errors:
+                errors[module] = {}
+
+            for error in report[module]:
+                if error in errors[module]:
+                    errors[module][error].append(report[module][error])
+                else:
+                    errors[module][error] = [report[module][error]]
+
+    return errors
+
+def measure(merge, reports):
+    """
+    Return seconds taken, and bytes retained and allocated at peak by the merge.
+    """
+    started = time.perf_counter()
+    merge(reports)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    merged = merge(reports)
+    (retained, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (elapsed, retained, peak)
+
+def main(keys, days):
+    reports = generate_reports(keys, days)
+
+    print('{} keys over {} days'.format(keys, days))
+    print('{:>16} {:>10} {:>14} {:>10}'.format('merge', 'seconds', 'retained MB', 'peak MB'))
+    for (name, merge) in [('dicts of lists', merge_reports), ('error matrix', ErrorMatrix.from_reports)]:
+        (elapsed, retained, peak) = measure(merge, reports)
+
+        print('{:>16} {:>10.3f} {:>14.1f} {:>10.1f}'.format(name, elapsed, retained / 1024 ** 2, peak / 1024 ** 2))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_KEYS,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_DAYS)
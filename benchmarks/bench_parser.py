@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the summary table parser against the pyquery selector based one.
+
+    python benchmarks/bench_parser.py [rows ...]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyquery import PyQuery as pq
+
+from errorguimonitor.report_parser import ErrorTableParser
+from synthetic import generate_summary_page
+
+DEFAULT_ROWS = (10000, 100000)
+
+def parse_pyquery(content):
+    """ the parser errorguimonitor used before ErrorTableParser """
+    errors = {}
+    html = pq(content)
+    for tr in html('div.borderedBoxWhite table.tablesorter tr')[1:]:
+        tr = pq(tr)
+        app = tr('td:eq(1)').text().strip()
+        key = tr('td:eq(2)').text().strip()
+        occurrences = int(tr('td:eq(3)').text().strip())
+        errors.setdefault(app, {}).setdefault(key, occurrences)
+
+    return errors
+
+def parse_streaming(content, chunk_size=64 * 1024):
+    parser = ErrorTableParser()
+    for i in range(0, len(content), chunk_size):
+        parser.feed(content[i:i + chunk_size])
+
+    return parser.close()
+
+def measure(parse, content):
+    # tracemalloc sees the Python heap only, the libxml2 tree pyquery builds is not counted
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = parse(content)
+    elapsed = time.perf_counter() - started
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (result, elapsed, peak)
+
+def main(rows_list):
+    print('{:>8} {:>10} {:>12} {:>12} {:>10} {:>10} {:>8}'.format(
+        'rows', 'page MB', 'pyquery s', 'stream s', 'pq MB', 'stream MB', 'speedup'))
+    for rows in rows_list:
+        content = generate_summary_page(rows)
+
+        (expected, pq_time, pq_peak) = measure(parse_pyquery, content)
+        (actual, stream_time, stream_peak) = measure(parse_streaming, content)
+        assert actual == expected, 'parsers disagree for {} rows'.format(rows)
+
+        print('{:>8} {:>10.1f} {:>12.2f} {:>12.2f} {:>10.1f} {:>10.1f} {:>7.1f}x'.format(
+            rows, len(content) / 2 ** 20, pq_time, stream_time, pq_peak / 2 ** 20, stream_peak / 2 ** 20,
+            pq_time / stream_time))
+
+if __name__ == '__main__':
+    main([int(rows) for rows in sys.argv[1:]] or DEFAULT_ROWS)
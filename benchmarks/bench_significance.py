@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Compare runtime and decisions of the significance tests.
+
+Daily counts are simulated as Poisson around the occurrences of the sample ErrorGUI page
+(test_fixture/sample_errorgui_page.html) and of synthetic rows, with a known share of keys increased.
+
+    python benchmarks/bench_significance.py [keys]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+from errorguimonitor.report_parser import ErrorTableParser
+from errorguimonitor.significance import SIGNIFICANCE_TESTS, get_significance_test
+from synthetic import generate_rows
+
+DEFAULT_KEYS = 20000
+TARGET_DAYS = 1
+HISTORY_DAYS = 5
+INCREASED_SHARE = 0.05
+INCREASE_FACTOR = 3
+N_RESAMPLES = 100
+
+def get_rates(keys):
+    parser = ErrorTableParser()
+    with open(os.path.join(ROOT, 'test_fixture', 'sample_errorgui_page.html'), 'r') as f:
+        parser.feed(f.read())
+    fixture_rates = [occurrences for app in parser.close().values() for occurrences in app.values()]
+
+    synthetic_rates = [occurrences for (_, _, occurrences) in generate_rows(keys - len(fixture_rates))]
+
+    return np.array(fixture_rates + synthetic_rates, dtype=float)
+
+def main(keys):
+    rng = np.random.default_rng(0)
+    rates = get_rates(keys)
+
+    increased = rng.random(len(rates)) < INCREASED_SHARE
+    targets = rng.poisson(np.where(increased, rates * INCREASE_FACTOR, rates)[:, None], (len(rates), TARGET_DAYS))
+    histories = rng.poisson(rates[:, None], (len(rates), HISTORY_DAYS))
+
+    decisions = {}
+    print('{} keys, {} increased x{}, {} target vs {} history days'.format(
+        len(rates), int(increased.sum()), INCREASE_FACTOR, TARGET_DAYS, HISTORY_DAYS))
+    print('{:>12} {:>10} {:>10} {:>16} {:>16}'.format('test', 'seconds', 'flagged', 'true positives', 'false positives'))
+    for name in sorted(SIGNIFICANCE_TESTS):
+        test = get_significance_test(name, N_RESAMPLES, rng=np.random.default_rng(0))
+
+        started = time.perf_counter()
+        flagged = test.increased(test.compare(targets, histories))
+        elapsed = time.perf_counter() - started
+
+        decisions[name] = flagged
+        print('{:>12} {:>10.3f} {:>10} {:>16} {:>16}'.format(
+            name, elapsed, int(flagged.sum()), int((flagged & increased).sum()), int((flagged & ~increased).sum())))
+
+    names = sorted(decisions)
+    for (i, first) in enumerate(names):
+        for second in names[i + 1:]:
+            print('{} vs {}: decisions agree for {:.1%} of keys'.format(
+                first, second, (decisions[first] == decisions[second]).mean()))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_KEYS)
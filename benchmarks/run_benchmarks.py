@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""
+Timed scenarios over synthetic ErrorGUI data, written as JSON so versions can be compared.
+
+    python benchmarks/run_benchmarks.py [--rows ROWS] [--keys KEYS] [--days DAYS] [--output FILE] [--compare FILE]
+
+Scenarios:
+    cli_startup           python -m errorguimonitor --help in a new interpreter
+    fetch                 report pages from the local stub through ErrorReportRetriever.get_html
+    build_reports         the same windows through ErrorReportBuilder, streamed and parsed, uncached
+    process_html          ErrorReportBuilder._process_html of one page
+    merge                 ErrorCompareReporter._merge_reports of the target and history days
+    prepare_report_<test> ErrorCompareReporter._prepare_report with each significance test
+    create_notification   ErrorCompareReporter._create_notification of the poisson comparison
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+from errorguimonitor import __version__
+from errorguimonitor.history_store import HistoryStore
+from errorguimonitor.report_builder import ErrorReportBuilder
+from errorguimonitor.report_retriever import TIME_FORMAT, ErrorReportRetriever
+from errorguimonitor.reporter import ErrorCompareReporter
+from errorguimonitor.significance import SIGNIFICANCE_TESTS
+from stub_server import StubErrorGUI
+from synthetic import generate_reports, generate_summary_page
+
+DEFAULT_ROWS = 20000
+DEFAULT_KEYS = 20000
+DEFAULT_DAYS = 6
+DEFAULT_WINDOWS = 6
+DEFAULT_REPEAT = 3
+TARGET_DAYS = 1
+# a scenario this much slower than in the compared results is reported as a regression
+DEFAULT_TOLERANCE = 1.2
+
+def timed(function, repeat):
+    """
+    Run function repeat times, returning its last result and the seconds of every run.
+    """
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - started)
+
+    return (result, runs)
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_scenarios(args):
+    scenarios = {}
+
+    def record(name, function, **extra):
+        (result, runs) = timed(function, args.repeat)
+        scenarios[name] = dict(seconds=float(np.median(runs)), min_seconds=min(runs), runs=runs, **extra)
+        print('{:<32} {:>10.4f} s'.format(name, scenarios[name]['seconds']))
+
+        return result
+
+    record('cli_startup', lambda: subprocess.check_call([sys.executable, '-m', 'errorguimonitor', '--help'], cwd=ROOT,
+                                                        stdout=subprocess.DEVNULL))
+
+    windows = [
+        (datetime(2018, 4, 10, hour), datetime(2018, 4, 10, hour, 59, 59)) for hour in range(args.windows)
+    ]
+    with StubErrorGUI(rows=args.rows, keys=max(args.keys, args.rows), latency=args.latency) as stub:
+        for window in windows:
+            # pages are generated before the clock starts
+            stub.get_page(*[moment.strftime(TIME_FORMAT) for moment in window])
+
+        retriever = ErrorReportRetriever(stub.env, 'user', 'password')
+        pages = record('fetch', lambda: [retriever.get_html(*window) for window in windows], windows=len(windows))
+        scenarios['fetch']['megabytes'] = sum(len(page) for page in pages) / 2 ** 20
+        scenarios['fetch']['logins'] = retriever.logins
+        retriever.close()
+
+        def build_reports():
+            report_builder = ErrorReportBuilder(stub.env, 'user', 'password', stream=True,
+                                                store=HistoryStore(':memory:'), bucket_size=None)
+            try:
+                return report_builder.build_reports(windows, args.max_workers)
+            finally:
+                report_builder.get_store().close()
+                report_builder.close()
+
+        record('build_reports', build_reports, windows=len(windows), max_workers=args.max_workers)
+
+    page = generate_summary_page(args.rows)
+    report_builder = ErrorReportBuilder(None, None, None)
+    record('process_html', lambda: report_builder._process_html(page), rows=args.rows)
+
+    reports = generate_reports(args.keys, args.days)
+    reporter = ErrorCompareReporter('QED', datetime(2018, 4, 10), None, None, None, None, seed=0)
+    (target_report, history_report) = record(
+        'merge', lambda: (reporter._merge_reports(reports[:TARGET_DAYS]), reporter._merge_reports(reports[TARGET_DAYS:])),
+        keys=args.keys, days=args.days)
+
+    comparisons = {}
+    for name in sorted(SIGNIFICANCE_TESTS):
+        reporter.significance_test = name
+        comparisons[name] = record('prepare_report_{}'.format(name),
+                                   lambda: reporter._prepare_report(target_report, history_report), keys=args.keys)
+
+    reporter.significance_test = 'poisson'
+    (new_errors, errors_increased) = comparisons['poisson']
+    target_dates = [(datetime(2018, 4, 10), datetime(2018, 4, 10, 23, 59, 59))]
+    history_dates = [(day, day + timedelta(hours=23, minutes=59, seconds=59))
+                     for day in [datetime(2018, 4, 10) - timedelta(days=i + 1) for i in range(args.days - TARGET_DAYS)]]
+    (_, body, attachments) = record('create_notification', lambda: reporter._create_notification(
+        target_dates, history_dates, [('QED', new_errors, errors_increased)]))
+    scenarios['create_notification']['megabytes'] = len(body) / 2 ** 20
+    scenarios['create_notification']['attached_megabytes'] = sum(len(data) for (_, data) in attachments) / 2 ** 20
+
+    return scenarios
+
+def compare(results, baseline, tolerance):
+    """
+    Print the scenarios against the baseline results and return the names of the ones slower beyond tolerance.
+    """
+    print('\n{:<32} {:>10} {:>10} {:>8}'.format('scenario', 'baseline', 'current', 'ratio'))
+    regressions = []
+    for (name, scenario) in sorted(results['scenarios'].items()):
+        if name not in baseline['scenarios']:
+            continue
+
+        ratio = scenario['seconds'] / max(baseline['scenarios'][name]['seconds'], 1e-9)
+        if ratio > tolerance:
+            regressions.append(name)
+        print('{:<32} {:>10.4f} {:>10.4f} {:>7.2f}x{}'.format(
+            name, baseline['scenarios'][name]['seconds'], scenario['seconds'], ratio, ' slower' if ratio > tolerance else ''))
+
+    return regressions
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='benchmark errorguimonitor on synthetic ErrorGUI data')
+    parser.add_argument('--rows', help='rows of every report page (default: {})'.format(DEFAULT_ROWS),
+                        type=int, default=DEFAULT_ROWS)
+    parser.add_argument('--keys', help='keys of the merged reports (default: {})'.format(DEFAULT_KEYS),
+                        type=int, default=DEFAULT_KEYS)
+    parser.add_argument('--days', help='target and history days (default: {})'.format(DEFAULT_DAYS),
+                        type=int, default=DEFAULT_DAYS)
+    parser.add_argument('--windows', help='report windows fetched (default: {})'.format(DEFAULT_WINDOWS),
+                        type=int, default=DEFAULT_WINDOWS)
+    parser.add_argument('--max-workers', help='windows fetched concurrently by build_reports (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--latency', help='seconds the stub waits before every response (default: 0)',
+                        type=float, default=0.)
+    parser.add_argument('--repeat', help='runs of every scenario (default: {})'.format(DEFAULT_REPEAT),
+                        type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--output', help='JSON file to write the results to', type=str)
+    parser.add_argument('--compare', help='JSON results of an earlier version to compare with', type=str)
+    parser.add_argument('--tolerance', help='slowdown reported as a regression (default: {})'.format(DEFAULT_TOLERANCE),
+                        type=float, default=DEFAULT_TOLERANCE)
+
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+
+    results = {
+        'version': __version__,
+        'commit': get_commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'parameters': {
+            'rows': args.rows, 'keys': args.keys, 'days': args.days, 'windows': args.windows,
+            'max_workers': args.max_workers, 'latency': args.latency, 'repeat': args.repeat
+        },
+        'scenarios': run_scenarios(args)
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if baseline['parameters'] != results['parameters']:
+            print('\nparameters differ from the compared results: {}'.format(baseline['parameters']))
+
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for SAFE and ErrorGUI, serving synthetic summary pages to ErrorReportRetriever.
+
+    with StubErrorGUI(rows=10000) as stub:
+        retriever = ErrorReportRetriever(stub.env, 'user', 'password')
+"""
+
+import os
+import socketserver
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from errorguimonitor.report_retriever import ENV
+from synthetic import generate_reauth_form, generate_summary_page
+
+STUB_ENV = 'STUB'
+
+LOGIN_PATH = '/safe-ui/fcc/login.fcc'
+REPORT_PATH = '/ErrorGUINext/initialResults.do'
+REAUTH_PATH = '/ErrorGUINext/reauth'
+
+SESSION_COOKIE = 'SMSESSION'
+WRITE_CHUNK_SIZE = 64 * 1024
+
+class StubErrorGUI(object):
+    """
+    The SAFE login hands out a session cookie. ErrorGUI answers a session it has not seen with the
+    re-auth form and serves summary pages once the form was posted back.
+
+    Pages are generated once per window, seeded by it, so the same window always gets the same page.
+    With session_requests a session expires after that many reports, like SAFE sessions do.
+    """
+    def __init__(self, rows=1000, apps=5, keys=None, latency=0., session_requests=None, env=STUB_ENV):
+        self.rows = rows
+        self.apps = apps
+        self.keys = keys
+        self.latency = latency
+        self.session_requests = session_requests
+        self.env = env
+        self.logins = 0
+        self.reauths = 0
+        self.reports = 0
+        self._sessions = {}
+        self._pages = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self._server.server_address[:2])
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        ENV.pop(self.env, None)
+
+    def get_page(self, start_time, end_time):
+        with self._lock:
+            page = self._pages.get((start_time, end_time))
+        if page is None:
+            seed = zlib.crc32('{}|{}'.format(start_time, end_time).encode('utf-8'))
+            page = generate_summary_page(self.rows, self.apps, seed, self.keys).encode('utf-8')
+            with self._lock:
+                self._pages[(start_time, end_time)] = page
+
+        return page
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        env_data = dict(ENV['QED'])
+        env_data['safe_url'] = self.url + LOGIN_PATH
+        env_data['error_gui_url'] = self.url + '/ErrorGUINext'
+        ENV[self.env] = env_data
+
+    def _authenticate(self, token, digest):
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None or session['digest'] != digest:
+                return False
+
+            session['authenticated'] = True
+            self.reauths += 1
+
+            return True
+
+    def _login(self):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[token] = { 'authenticated': False, 'digest': uuid.uuid4().hex, 'reports': 0 }
+            self.logins += 1
+
+        return token
+
+    def _open_report(self, token):
+        """
+        None when the session may have the report, otherwise the digest its re-auth form asks for.
+        """
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                # an expired session gets a form it cannot submit
+                return 'expired'
+            if not session['authenticated']:
+                return session['digest']
+
+            session['reports'] += 1
+            self.reports += 1
+            if self.session_requests is not None and session['reports'] >= self.session_requests:
+                del self._sessions[token]
+
+            return None
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is the same, from Python 3.7 only
+    daemon_threads = True
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        time.sleep(stub.latency)
+
+        url = urlsplit(self.path)
+        if url.path != REPORT_PATH:
+            return self._send(404, b'')
+
+        digest = stub._open_report(self._get_token())
+        if digest is not None:
+            form = generate_reauth_form(stub.url + REAUTH_PATH, 'user', time.strftime('%Y-%m-%d %H:%M'), digest)
+            return self._send(200, form.encode('utf-8'))
+
+        query = parse_qs(url.query)
+        self._send(200, stub.get_page(query['start_time'][0], query['end_time'][0]))
+
+    def do_POST(self):
+        stub = self.server.stub
+        time.sleep(stub.latency)
+
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        if self.path == LOGIN_PATH:
+            return self._send(200, b'<html><body>Logged in</body></html>',
+                              { 'Set-Cookie': '{}={}; Path=/'.format(SESSION_COOKIE, stub._login()) })
+        if self.path == REAUTH_PATH:
+            stub._authenticate(self._get_token(), form.get('digest', [None])[0])
+            return self._send(200, b'<html><body>Authenticated</body></html>')
+
+        self._send(404, b'')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _get_token(self):
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            (name, _, value) = cookie.strip().partition('=')
+            if name == SESSION_COOKIE:
+                return value
+
+        return None
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        for i in range(0, len(body), WRITE_CHUNK_SIZE):
+            self.wfile.write(body[i:i + WRITE_CHUNK_SIZE])
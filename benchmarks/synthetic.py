@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Synthetic ErrorGUI pages for benchmarks.
+"""
+
+import random
+
+PAGE_HEADER = (
+    '<html><head><title>ErrorGUI</title></head><body>\n'
+    '<div class="borderedBoxWhite">\n'
+    '<table width="100%" cellspacing="1" cellpadding="0" border="0" class="tablesorter">\n'
+    '<thead><tr><th>&nbsp;</th><th>&nbsp;Application&nbsp;</th><th>&nbsp;Key Name&nbsp;</th>'
+    '<th>&nbsp;Occurrences&nbsp;</th></tr></thead>\n'
+    '<tbody>\n'
+)
+
+PAGE_ROW = (
+    '<tr><td></td>\n'
+    '<td><a href="specificParam.do?view=summary&environs=QED&appName={app}">{app}</a></td>\n'
+    '<td><a href="specificParam.do?view=summary&environs=QED&keyName={key}">{key}</a></td>\n'
+    '<td>&nbsp;<a href="specificParam.do?view=summary&environs=QED&keyName={key}">{occurrences}</a></td>\n'
+    '</tr>\n'
+)
+
+PAGE_FOOTER = '</tbody>\n</table>\n</div>\n</body></html>\n'
+
+REAUTH_FORM = (
+    '<html><body onload="document.forms[0].submit()">\n'
+    '<form method="post" action="{action}">\n'
+    '<input type="hidden" name="uid" value="{uid}"/>\n'
+    '<input type="hidden" name="time" value="{time}"/>\n'
+    '<input type="hidden" name="digest" value="{digest}"/>\n'
+    '</form></body></html>\n'
+)
+
+# share of the keys reported on each day
+DAILY_KEYS_SHARE = 0.8
+
+def generate_rows(rows, apps=5, seed=0, keys=None):
+    """
+    Yield (app, key, occurrences) rows. With keys the rows are a sample of that many keys, otherwise every row is a key of its own.
+    """
+    rnd = random.Random(seed)
+    app_names = ['App{}'.format(i) for i in range(apps)]
+    indices = sorted(rnd.sample(range(keys), rows)) if keys is not None else range(rows)
+    for i in indices:
+        yield (app_names[i % apps], 'Cobalt.Module{}.Error.Key{}'.format(i % 97, i), rnd.randint(1, 500))
+
+def generate_reports(keys, days, apps=5, daily_share=DAILY_KEYS_SHARE):
+    """
+    Return {app: {key: occurrences}} reports of days, each with a share of the keys.
+    """
+    rows = list(generate_rows(keys, apps))
+    reports = []
+    for day in range(days):
+        report = {}
+        for (i, (app, key, occurrences)) in enumerate(rows):
+            if (i * 7919 + day * 104729) % 1000 < daily_share * 1000:
+                report.setdefault(app, {})[key] = occurrences
+        reports.append(report)
+
+    return reports
+
+def generate_reauth_form(action, uid, time, digest):
+    """
+    Return the re-auth form ErrorGUI sends sessions it does not know yet.
+    """
+    return REAUTH_FORM.format(action=action, uid=uid, time=time, digest=digest)
+
+def generate_summary_page(rows, apps=5, seed=0, keys=None):
+    """
+    Return a summary page with the given number of error rows spread over apps, sampled from keys when provided.
+    """
+    parts = [PAGE_HEADER]
+    for (app, key, occurrences) in generate_rows(rows, apps, seed, keys):
+        parts.append(PAGE_ROW.format(app=app, key=key, occurrences=occurrences))
+    parts.append(PAGE_FOOTER)
+
+    return ''.join(parts)
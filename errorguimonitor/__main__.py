@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+
+"""
+python -m errorguimonitor, the same as the errorguimonitor command.
+"""
+
+from .cli import command_line_runner
+
+command_line_runner()
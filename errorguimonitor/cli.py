@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+
+"""
+Command line module.
+
+errorguimonitor compare|fetch|cache|watch. The parser is built from the standard library and the
+settings only - every command imports numpy, requests and the rest when it runs, so --help and
+--version start at once.
+"""
+
+import argparse
+import os
+import sys
+
+from datetime import datetime, timedelta
+
+from . import __version__
+from .settings import (ALPHA, BUCKET_SIZE, ENV, HISTORY_LENGTH, MAX_MESSAGE_BYTES, MEDIAN, MIN_OCCURRENCES, N_RESAMPLES,
+                       NOTIFIERS, PARSER_VERSION, POLL_INTERVAL, RECIPIENTS, SIGNIFICANCE_TEST, SIGNIFICANCE_TEST_NAMES,
+                       STATE_FILE_NAME, STATISTICS, TARGET_LENGTH, THRESHOLD, TOP_N)
+
+COMMANDS = ['compare', 'fetch', 'cache', 'watch']
+# earlier versions compared without a command
+DEFAULT_COMMAND = 'compare'
+TOP_LEVEL_OPTIONS = ['-h', '--help', '-v', '--version']
+
+DATE_FORMAT = '%Y-%m-%d'
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# slowest calls printed with --profile
+PROFILE_LINES = 25
+# credentials of a replayed run given none
+REPLAY_USER = 'replay'
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        raise argparse.ArgumentTypeError('incorrect date provided. Please use year-month-day format')
+
+def parse_list(value):
+    """
+    Parse comma separated values.
+    """
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def parse_size(value):
+    """
+    Parse a size in bytes with an optional K, M or G suffix, e.g. 500M.
+    """
+    value = value.strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(value))
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='errorguimonitor',
+                                     description='compare errors for two periods in s specific environment via the command line')
+    parser.add_argument('-v', '--version', help='displays the current version of errorguimonitor',
+                        action='store_true')
+
+    # options shared by the commands, grouped by what they are for
+    env_parser = argparse.ArgumentParser(add_help=False)
+    env_parser.add_argument('-e', '--environment',
+                            help='comma separated environments, compared into one report ({} only at the moment)'.format(
+                                ', '.join(sorted(ENV))), type=parse_list, required=True)
+    env_parser.add_argument('-u', '--user', help='SAFE ID user', type=str)
+    env_parser.add_argument('-p', '--password', help='SAFE ID password', type=str)
+
+    fetch_parser = argparse.ArgumentParser(add_help=False)
+    fetch_parser.add_argument('--max-workers', help='the number of report days fetched concurrently (default: 1)',
+                              type=int, default=1)
+    fetch_parser.add_argument('--stream', help='parse report pages while they are downloaded', action='store_true')
+    fetch_parser.add_argument('--keep-html', help='directory to keep gzipped report pages in for debugging', type=str)
+    fetch_parser.add_argument('--bucket-hours', help=('fetch and cache reports in buckets of this many hours, '
+                                                      '0 caches whole windows only (default: {:g})').format(
+                              BUCKET_SIZE.total_seconds() / 3600 if BUCKET_SIZE else 0),
+                              type=float, default=BUCKET_SIZE.total_seconds() / 3600 if BUCKET_SIZE else 0)
+    fetch_parser.add_argument('--apps', help='comma separated applications to compare (default: all)', type=parse_list)
+    fetch_parser.add_argument('--metrics', help='JSON file to write the stage timings and counters of the run to', type=str)
+    fetch_parser.add_argument('--metrics-prom',
+                              help='Prometheus textfile to write the stage timings and counters of the run to', type=str)
+    fetch_parser.add_argument('--profile',
+                              help='file to dump the cProfile stats of the run to, the slowest calls are printed', type=str)
+
+    offline_parser = argparse.ArgumentParser(add_help=False)
+    offline_parser.add_argument('--record', help=('directory to record the SAFE and ErrorGUI responses of the run to, '
+                                                  'bypassing the cache'), type=str)
+    offline_parser.add_argument('--replay', help='directory of recorded responses to run from instead of SAFE and ErrorGUI',
+                                type=str)
+    offline_parser.add_argument('--replay-latency', help='seconds every replayed response waits for (default: 0)',
+                                type=float, default=0.)
+
+    target_parser = argparse.ArgumentParser(add_help=False)
+    target_parser.add_argument('-d', '--date', help='the target date (year-month-day)', type=parse_date, required=True)
+    target_parser.add_argument('--target-length', help=('the target period in hours, business days or weeks ending at '
+                                                        'the date, e.g. 6h, 1d or 1w (default: {})').format(TARGET_LENGTH),
+                               type=str, default=TARGET_LENGTH)
+
+    history_parser = argparse.ArgumentParser(add_help=False)
+    history_parser.add_argument('--history-length', help=('the history period before the target, in hours, business '
+                                                          'days or weeks (default: {})').format(HISTORY_LENGTH),
+                                type=str, default=HISTORY_LENGTH)
+    history_parser.add_argument('--holidays',
+                                help='file of holidays, one year-month-day per line, skipped like weekends; repeatable',
+                                action='append', default=[])
+
+    notify_parser = argparse.ArgumentParser(add_help=False)
+    notify_parser.add_argument('-smtp_user', '--smtp_user', help='Gmail account username', type=str)
+    notify_parser.add_argument('-smtp_password', '--smtp_password', help='Gmail account password', type=str)
+    notify_parser.add_argument('--notifier', help='where to send reports to: {} (default: smtp)'.format(', '.join(NOTIFIERS)),
+                               type=str, default='smtp')
+    notify_parser.add_argument('--recipients',
+                               help='comma separated report recipients (default: {})'.format(', '.join(RECIPIENTS)),
+                               type=parse_list, default=RECIPIENTS)
+
+    subparsers = parser.add_subparsers(dest='command')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare the target period with the history and send the report (the default command)',
+        parents=[env_parser, target_parser, history_parser, fetch_parser, offline_parser, notify_parser])
+    compare_parser.add_argument('--cache-max-age-days', help='evict cached reports fetched more than this many days ago',
+                                type=float)
+    compare_parser.add_argument('--cache-max-bytes',
+                                help='evict least recently used cached reports above this size, e.g. 500M', type=parse_size)
+    compare_parser.add_argument('--resamples', help='the number of bootstrap resamples (default: {})'.format(N_RESAMPLES),
+                                type=int, default=N_RESAMPLES)
+    compare_parser.add_argument('--test', help=('the significance test for error rates increase (default: {}); '
+                                                'permutation needs at least {:g} ways to pick the target windows among '
+                                                'the compared ones, e.g. 2d v. 5d but not 1d v. 5d').format(
+                                SIGNIFICANCE_TEST, 1. / ALPHA), choices=SIGNIFICANCE_TEST_NAMES, default=SIGNIFICANCE_TEST)
+    compare_parser.add_argument('--env-diff', help='compare the two environments given with each other over the same days',
+                                action='store_true')
+    compare_parser.add_argument('--seed', help='seed the statistics, so the same data always gives the same report',
+                                type=int)
+    compare_parser.add_argument('--baseline-days', help=('compare the target days with a baseline of this many business '
+                                                         'days, e.g. 30 or 90, kept in a trend store updated incrementally'),
+                                type=int)
+    compare_parser.add_argument('--baseline', help='the baseline statistic of --baseline-days (default: {})'.format(MEDIAN),
+                                choices=STATISTICS, default=MEDIAN)
+    compare_parser.add_argument('--raw-keys', help='compare error keys as reported, without collapsing ids, GUIDs and numbers',
+                                action='store_true')
+    compare_parser.add_argument('--top', help=('the most frequent new errors and most increased errors listed per '
+                                               'application, 0 lists all of them (default: {})').format(TOP_N),
+                                type=int, default=TOP_N)
+    compare_parser.add_argument('--max-email-size', help=('the size the report message is kept under, the rest of the '
+                                                          'results attached or cut, e.g. 5M (default: {}M)').format(
+                                MAX_MESSAGE_BYTES // 1024 ** 2), type=parse_size, default=MAX_MESSAGE_BYTES)
+
+    subparsers.add_parser(
+        'fetch', help='fetch the target and history reports into the cache without comparing them',
+        parents=[env_parser, target_parser, history_parser, fetch_parser, offline_parser])
+
+    cache_parser = subparsers.add_parser('cache', help='show or prune the cached reports')
+    cache_parser.add_argument('action', choices=['stats', 'prune'])
+    cache_parser.add_argument('--max-age-days', help='evict reports fetched more than this many days ago', type=float)
+    cache_parser.add_argument('--max-bytes', help='evict least recently used reports above this size, e.g. 500M',
+                              type=parse_size)
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='poll for the newest errors and alert as soon as a key crosses the threshold',
+        parents=[env_parser, history_parser, fetch_parser, notify_parser])
+    watch_parser.add_argument('--interval', help='minutes between polls (default: {:g})'.format(POLL_INTERVAL.total_seconds() / 60),
+                              type=float, default=POLL_INTERVAL.total_seconds() / 60)
+    watch_parser.add_argument('--threshold', help=('alert keys over this many times their daily mean of the history '
+                                                   'days (default: {:g})').format(THRESHOLD), type=float, default=THRESHOLD)
+    watch_parser.add_argument('--min-occurrences',
+                              help='alert keys with at least this many occurrences today (default: {})'.format(MIN_OCCURRENCES),
+                              type=int, default=MIN_OCCURRENCES)
+    watch_parser.add_argument('--state', help='file keeping the watch state across restarts', type=str)
+
+    return parser
+
+def check_delivered(notifier):
+    """
+    Exit with an error once the notifier closed with messages it could not deliver.
+    """
+    if notifier.failed:
+        sys.exit('{} notification(s) not delivered.'.format(len(notifier.failed)))
+
+def check_fetch_args(args):
+    """
+    Check the options of the commands fetching reports, printing what is wrong.
+    """
+    unknown_envs = [name for name in args['environment'] if name not in ENV]
+    if unknown_envs:
+        print('unknown environment: {}'.format(', '.join(unknown_envs)))
+        return False
+
+    if args.get('replay'):
+        # replayed logins are not checked, any credentials do
+        args['user'] = args['user'] or REPLAY_USER
+        args['password'] = args['password'] or REPLAY_USER
+
+    if not args['user'] \
+        or not args['password'] \
+        or (args.get('notifier') == 'smtp' and (not args['smtp_user'] or not args['smtp_password'])):
+        print('Please provide usernames and passwords to successfully run the utility.')
+        return False
+
+    if args['max_workers'] < 1:
+        print('--max-workers should be a positive number.')
+        return False
+
+    if args['bucket_hours'] < 0:
+        print('--bucket-hours should not be negative.')
+        return False
+
+    if args.get('record') and args.get('replay'):
+        print('--record and --replay do not go together.')
+        return False
+
+    if args.get('replay') and not os.path.isdir(args['replay']):
+        print('no recordings in {}'.format(args['replay']))
+        return False
+
+    if args.get('replay_latency', 0) < 0:
+        print('--replay-latency should not be negative.')
+        return False
+
+    return True
+
+def check_significance_test(args, holidays):
+    """
+    Check the significance test can find an increase with the compared windows at all, printing why not.
+    """
+    from .report_windows import get_report_windows
+    from .significance import PermutationTest
+
+    if args['test'] != PermutationTest.name:
+        return True
+
+    (target_dates, history_dates) = get_report_windows(args['date'], args['target_length'], args['history_length'],
+                                                       holidays)
+    (target_count, history_count) = (len(target_dates), len(history_dates))
+    if args['env_diff']:
+        # every window of one environment is compared with the same windows of the other one
+        target_count = history_count = target_count + history_count
+
+    if PermutationTest(ALPHA).get_min_p_value(target_count, target_count + history_count) > ALPHA:
+        print(('the {} test cannot find any increase comparing {} target with {} history windows, '
+               'it needs at least {:g} ways to pick the target among them.').format(
+                   PermutationTest.name, target_count, history_count, 1. / ALPHA))
+        return False
+
+    return True
+
+def get_bucket_size(args):
+    return timedelta(hours=args['bucket_hours']) if args['bucket_hours'] else None
+
+def get_lengths(args):
+    """
+    The parsed target and history lengths and the holidays, None after printing what is wrong with them.
+    """
+    from .report_windows import load_holidays, parse_length
+
+    try:
+        lengths = [parse_length(args.get('target_length', TARGET_LENGTH)), parse_length(args['history_length'])]
+        holidays = load_holidays(args['holidays'])
+    except (OSError, ValueError) as e:
+        print(e)
+        return None
+
+    if lengths[1][1] == 'h' and (lengths[0][1] == 'd' or args['command'] == 'watch'):
+        print('--history-length in hours needs a --target-length in hours.')
+        return None
+
+    return (lengths, holidays)
+
+def get_queued_notifier(args, metrics):
+    from .notifiers import QueuedNotifier, get_notifier
+
+    # delivered in the background, so a slow sink never holds up the reports
+    return QueuedNotifier(get_notifier(args['notifier'], args['smtp_user'], args['smtp_password']), metrics=metrics)
+
+def get_transport(args):
+    if args['record']:
+        from .transport import RecordingTransport
+        return RecordingTransport(args['record'])
+
+    if args['replay']:
+        from .transport import ReplayTransport
+        return ReplayTransport(args['replay'], args['replay_latency'])
+
+    return None
+
+def run_cache_command(args):
+    from .history_store import HistoryStore, get_store_path
+
+    store = HistoryStore(get_store_path())
+
+    if args['action'] == 'prune':
+        evicted = store.prune(PARSER_VERSION, args['max_age_days'], args['max_bytes'])
+        print('{} cached report windows evicted.'.format(evicted))
+
+    stats = store.stats()
+    for env_stats in stats:
+        print('{env}: {windows} windows, {errors} errors, {size:.1f} MB, oldest fetch {oldest_fetch}, '
+              'last access {last_access}'.format(size=env_stats['bytes'] / 1024 ** 2, **env_stats))
+    if not stats:
+        print('No cached reports.')
+    print('{}: {:.1f} MB on disk'.format(store.path, store.file_size() / 1024 ** 2))
+
+    store.close()
+
+def run_compare_command(args, metrics):
+    if not check_fetch_args(args):
+        return
+
+    if args['resamples'] < 1:
+        print('--resamples should be a positive number.')
+        return
+
+    if args['top'] < 0:
+        print('--top should not be negative.')
+        return
+
+    if args['max_email_size'] <= 0:
+        print('--max-email-size should be positive.')
+        return
+
+    if args['env_diff'] and len(args['environment']) != 2:
+        print('--env-diff takes two environments.')
+        return
+
+    parsed = get_lengths(args)
+    if parsed is None:
+        return
+    (lengths, holidays) = parsed
+
+    if args['baseline_days'] is not None:
+        from .significance import PoissonRateTest
+
+        if args['baseline_days'] < 1:
+            print('--baseline-days should be a positive number.')
+            return
+        if args['env_diff'] or lengths[0][1] == 'h' or args['test'] != PoissonRateTest.name:
+            print('--baseline-days compares target days with the {} test and no --env-diff.'.format(PoissonRateTest.name))
+            return
+
+    if not check_significance_test(args, holidays):
+        return
+
+    try:
+        notifier = get_queued_notifier(args, metrics)
+    except ValueError as e:
+        print(e)
+        return
+
+    from .reporter import ErrorCompareReporter
+
+    transport = get_transport(args)
+    try:
+        reporter = ErrorCompareReporter(args['environment'], args['date'], args['user'], args['password'],
+                                        args['smtp_user'], args['smtp_password'], max_workers=args['max_workers'],
+                                        stream=args['stream'], raw_html_dir=args['keep_html'],
+                                        cache_max_age_days=args['cache_max_age_days'],
+                                        cache_max_bytes=args['cache_max_bytes'], bucket_size=get_bucket_size(args),
+                                        n_resamples=args['resamples'], seed=args['seed'], significance_test=args['test'],
+                                        apps=args['apps'], notifier=notifier, recipients=args['recipients'],
+                                        env_diff=args['env_diff'], target_length=args['target_length'],
+                                        history_length=args['history_length'], holidays=holidays,
+                                        baseline_days=args['baseline_days'], baseline=args['baseline'],
+                                        normalize_keys=not args['raw_keys'], metrics=metrics, transport=transport,
+                                        use_cache=transport is None, top_n=args['top'],
+                                        max_message_bytes=args['max_email_size'])
+        with metrics.time('run'):
+            reporter.run()
+    finally:
+        notifier.close()
+
+    check_delivered(notifier)
+
+def run_fetch_command(args, metrics):
+    if not check_fetch_args(args):
+        return
+
+    parsed = get_lengths(args)
+    if parsed is None:
+        return
+    (_, holidays) = parsed
+
+    from .history_store import HistoryStore
+    from .report_builder import ErrorReportBuilder
+    from .report_windows import get_report_windows
+
+    (target_dates, history_dates) = get_report_windows(args['date'], args['target_length'], args['history_length'], holidays)
+    windows = target_dates + history_dates
+    transport = get_transport(args)
+
+    for env in args['environment']:
+        # recorded and replayed windows go through the transport, not the cache
+        store = HistoryStore(':memory:') if transport is not None else None
+        report_builder = ErrorReportBuilder(env, args['user'], args['password'], stream=args['stream'],
+                                            raw_html_dir=args['keep_html'], store=store,
+                                            bucket_size=get_bucket_size(args), metrics=metrics, transport=transport)
+        try:
+            with metrics.time('run'):
+                reports = report_builder.build_reports(windows, args['max_workers'], apps=args['apps'])
+        finally:
+            report_builder.close()
+            if store is not None:
+                store.close()
+
+        for ((start_time, end_time), report) in zip(windows, reports):
+            print('{} {} - {}: {} keys, {} errors'.format(
+                env, start_time, end_time, sum(len(errors) for errors in report.values()),
+                sum(sum(errors.values()) for errors in report.values())))
+
+def run_watch_command(args, metrics):
+    if not check_fetch_args(args):
+        return
+
+    if args['interval'] <= 0:
+        print('--interval should be a positive number.')
+        return
+
+    if len(args['environment']) > 1:
+        print('watch takes one environment.')
+        return
+
+    parsed = get_lengths(args)
+    if parsed is None:
+        return
+    (lengths, holidays) = parsed
+
+    try:
+        notifier = get_queued_notifier(args, metrics)
+    except ValueError as e:
+        print(e)
+        return
+
+    from .report_builder import ErrorReportBuilder
+    from .watcher import ErrorWatcher
+
+    env = args['environment'][0]
+    try:
+        report_builder = ErrorReportBuilder(env, args['user'], args['password'], stream=args['stream'],
+                                            raw_html_dir=args['keep_html'], bucket_size=get_bucket_size(args),
+                                            metrics=metrics)
+        state_path = args['state'] or os.path.join(
+            os.path.dirname(report_builder.get_store_path()), STATE_FILE_NAME.format(env=env))
+
+        watcher = ErrorWatcher(report_builder, notifier, state_path, args['recipients'], apps=args['apps'],
+                               threshold=args['threshold'], min_occurrences=args['min_occurrences'],
+                               history_days_count=lengths[1][0], max_workers=args['max_workers'], holidays=holidays)
+        watcher.run(timedelta(minutes=args['interval']))
+    finally:
+        notifier.close()
+
+    check_delivered(notifier)
+
+def write_run_stats(args, metrics, profile):
+    """
+    Write the metrics and the profile of the run to the files asked for.
+    """
+    if profile is not None:
+        import pstats
+
+        profile.disable()
+        profile.dump_stats(args['profile'])
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(PROFILE_LINES)
+
+    if args['metrics']:
+        metrics.write_json(args['metrics'])
+    if args['metrics_prom']:
+        metrics.write_prometheus(args['metrics_prom'])
+
+def command_line_runner(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] not in COMMANDS and argv[0] not in TOP_LEVEL_OPTIONS:
+        argv = [DEFAULT_COMMAND] + argv
+
+    parser = get_parser()
+    args = vars(parser.parse_args(argv))
+
+    if args['version']:
+        print(__version__)
+        return
+
+    if args['command'] is None:
+        parser.print_help()
+        return
+
+    if args['command'] == 'cache':
+        run_cache_command(args)
+        return
+
+    from .metrics import Metrics
+
+    metrics = Metrics()
+    profile = None
+    if args['profile']:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+    run_command = { 'compare': run_compare_command, 'fetch': run_fetch_command, 'watch': run_watch_command }[args['command']]
+    try:
+        run_command(args, metrics)
+    finally:
+        write_run_stats(args, metrics, profile)
+
+if __name__ == '__main__':
+    command_line_runner()
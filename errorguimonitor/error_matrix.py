@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Error matrix module.
+
+Reports of several days kept as a key table and a days x keys matrix of counts.
+"""
+
+import hashlib
+import itertools
+import json
+
+import numpy as np
+
+# daily occurrences of a key stay far below 2 ** 31
+COUNTS_DTYPE = np.int32
+
+class ErrorMatrix(object):
+    """
+    Counts of error keys per day.
+
+    Columns are sorted by app and key: names holds the key of every column and the columns of
+    apps[i] are app_offsets[i]:app_offsets[i + 1]. counts is a (days, keys) COUNTS_DTYPE array with
+    zeros for the days a key was not reported.
+    """
+    def __init__(self, apps, app_offsets, names, counts):
+        self.apps = apps
+        self.app_offsets = app_offsets
+        self.names = names
+        self.counts = counts
+
+    @property
+    def keys(self):
+        """
+        (app, key) of every column.
+        """
+        return [(app, name) for (i, app) in enumerate(self.apps) for name in self.names[self._get_app_slice(i)]]
+
+    def digest(self):
+        """
+        sha256 of the key table and counts, identifying the data of the matrix.
+        """
+        digest = hashlib.sha256(json.dumps([self.apps, self.app_offsets.tolist(), self.names.tolist()]).encode('utf-8'))
+        digest.update(np.ascontiguousarray(self.counts).tobytes())
+
+        return digest.hexdigest()
+
+    @classmethod
+    def from_reports(cls, reports):
+        """
+        Build the matrix from {app: {key: occurrences}} reports, one per day. The keys and counts
+        of all days of an app are gathered in one pass and written with one scatter, so there are
+        no per key Python statements.
+        """
+        apps = sorted(set().union(*reports))
+        app_errors = [[report.get(app, {}) for report in reports] for app in apps]
+        app_names = [sorted(set().union(*errors)) for errors in app_errors]
+
+        app_offsets = np.cumsum([0] + [len(names) for names in app_names])
+        counts = np.zeros((len(reports), app_offsets[-1]), dtype=COUNTS_DTYPE)
+
+        for (errors, names, offset) in zip(app_errors, app_names, app_offsets):
+            sizes = [len(day_errors) for day_errors in errors]
+            columns = dict(zip(names, itertools.count(offset)))
+
+            rows = np.repeat(np.arange(len(reports)), sizes)
+            keys = np.fromiter(map(columns.__getitem__, itertools.chain.from_iterable(errors)), np.int64, len(rows))
+            counts[rows, keys] = np.fromiter(
+                itertools.chain.from_iterable(day_errors.values() for day_errors in errors), COUNTS_DTYPE, len(rows))
+
+        return cls(apps, app_offsets, np.array(list(itertools.chain.from_iterable(app_names)), dtype=object), counts)
+
+    def get_columns(self, other):
+        """
+        Columns of this matrix holding the keys of the other matrix columns, -1 for keys it does not have.
+        """
+        columns = np.full(len(other.names), -1, dtype=np.int64)
+        for (i, app) in enumerate(other.apps):
+            if app not in self.apps:
+                continue
+
+            app_slice = self._get_app_slice(self.apps.index(app))
+            names = self.names[app_slice]
+            other_slice = other._get_app_slice(i)
+            other_names = other.names[other_slice]
+
+            positions = np.minimum(np.searchsorted(names, other_names), max(len(names) - 1, 0))
+            found = names[positions] == other_names if len(names) else np.zeros(len(other_names), dtype=bool)
+            columns[other_slice] = np.where(found, positions + app_slice.start, -1)
+
+        return columns
+
+    def get_counts(self, app, key):
+        """
+        Counts of every day, empty when the key was not reported at all.
+        """
+        if app not in self.apps:
+            return np.zeros(0, dtype=self.counts.dtype)
+
+        app_slice = self._get_app_slice(self.apps.index(app))
+        position = np.searchsorted(self.names[app_slice], key)
+        if position == app_slice.stop - app_slice.start or self.names[app_slice.start + position] != key:
+            return np.zeros(0, dtype=self.counts.dtype)
+
+        return self.counts[:, app_slice.start + position]
+
+    def get_key(self, column):
+        """
+        (app, key) of the column.
+        """
+        app = self.apps[np.searchsorted(self.app_offsets, column, side='right') - 1]
+
+        return (app, self.names[column])
+
+    def take(self, columns):
+        """
+        Matrix of the columns selected by a boolean mask, apps left without columns dropped.
+        """
+        column_apps = np.repeat(np.arange(len(self.apps)), np.diff(self.app_offsets))
+        app_columns = np.bincount(column_apps[columns], minlength=len(self.apps))
+        kept = np.flatnonzero(app_columns)
+
+        return ErrorMatrix([self.apps[i] for i in kept], np.cumsum(np.append(0, app_columns[kept])),
+                           self.names[columns], self.counts[:, columns])
+
+    def to_dict(self):
+        """
+        {app: {key: [counts of every day]}}.
+        """
+        errors = {}
+        for ((app, key), values) in zip(self.keys, self.counts.T.tolist()):
+            errors.setdefault(app, {})[key] = values
+
+        return errors
+
+    def _get_app_slice(self, i):
+        return slice(int(self.app_offsets[i]), int(self.app_offsets[i + 1]))
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+"""
+Files module.
+
+Write the files other runs and tools read - watch state, trends, metrics and recordings - so that
+nobody ever reads one half written.
+"""
+
+import contextlib
+import os
+import threading
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', opener=open):
+    """
+    Open a file written aside and renamed to path once closed, so an interrupted write never leaves a broken file.
+    The aside file is per thread, several threads writing the same path just replace each other's file.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    try:
+        with opener(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+"""
+History store module.
+
+Keep fetched reports in a single SQLite database indexed by environment, window, application and error key.
+"""
+
+import json
+import os
+import pickle
+import re
+import sqlite3
+import threading
+
+from datetime import datetime, timedelta
+
+HISTORY_DATA_DIR = 'history_data'
+DB_FILE_NAME = 'history.sqlite3'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+PICKLE_TIME_FORMAT = '%Y_%m_%d_%H_%M'
+PICKLE_FILE_PATTERN = re.compile(r'^(\d{4}(?:_\d{2}){4})__(\d{4}(?:_\d{2}){4})\.pkl$')
+
+# keeps IN (...) lists below the SQLite host parameters limit
+MAX_QUERY_PARAMS = 500
+
+# approximate storage overhead of an errors row besides the app and key text
+ROW_OVERHEAD_BYTES = 24
+
+# the store is a cache - a database of another schema version is dropped and rebuilt
+SCHEMA_VERSION = 3
+DROP_SCHEMA = '''
+DROP TABLE IF EXISTS errors;
+DROP TABLE IF EXISTS windows;
+DROP TABLE IF EXISTS results;
+DROP TABLE IF EXISTS meta;
+DROP TABLE IF EXISTS fingerprints;
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS windows (
+    id INTEGER PRIMARY KEY,
+    env TEXT NOT NULL,
+    window_start TEXT NOT NULL,
+    window_end TEXT NOT NULL,
+    parser_version INTEGER NOT NULL,
+    fetched_at TEXT NOT NULL,
+    last_access TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    UNIQUE (env, window_start, window_end, parser_version)
+);
+CREATE INDEX IF NOT EXISTS windows_last_access ON windows (last_access);
+CREATE TABLE IF NOT EXISTS errors (
+    window_id INTEGER NOT NULL REFERENCES windows (id) ON DELETE CASCADE,
+    app TEXT NOT NULL,
+    error_key TEXT NOT NULL,
+    occurrences INTEGER NOT NULL,
+    PRIMARY KEY (window_id, app, error_key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS errors_app_window ON errors (app, window_id);
+CREATE TABLE IF NOT EXISTS results (
+    cache_key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    env TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    app TEXT NOT NULL,
+    canonical_key TEXT NOT NULL,
+    first_seen TEXT NOT NULL,
+    PRIMARY KEY (env, fingerprint)
+) WITHOUT ROWID;
+'''
+
+class HistoryStore(object):
+    """
+    Reports cache - one row per (window, app, error key), so any set of windows and apps
+    is loaded with a single indexed query.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+
+        if self._connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self._connection.executescript(DROP_SCHEMA)
+            self._connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get_meta(self, name):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+
+        return row[0] if row else None
+
+    def set_meta(self, name, value):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+    def get_result(self, cache_key):
+        with self._lock:
+            row = self._connection.execute('SELECT result FROM results WHERE cache_key = ?', (cache_key,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def put_result(self, cache_key, result):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO results (cache_key, result, created_at) VALUES (?, ?, ?)',
+                (cache_key, json.dumps(result), datetime.now().strftime(TIME_FORMAT)))
+
+    def get_fingerprints(self, env, fingerprints):
+        """
+        Return {fingerprint: (canonical key, first seen)} of the fingerprints indexed for the environment.
+        """
+        indexed = {}
+        with self._lock:
+            for chunk in self._chunks(fingerprints):
+                rows = self._connection.execute(
+                    ('SELECT fingerprint, canonical_key, first_seen FROM fingerprints '
+                     'WHERE env = ? AND fingerprint IN ({})').format(', '.join('?' * len(chunk))), [env] + chunk)
+                for (fingerprint, canonical_key, first_seen) in rows:
+                    indexed[fingerprint] = (canonical_key, datetime.strptime(first_seen, TIME_FORMAT))
+
+        return indexed
+
+    def put_fingerprints(self, env, rows):
+        """
+        Index (fingerprint, app, canonical key, first seen) rows of the environment - an indexed fingerprint
+        keeps its canonical key.
+        """
+        rows = [(fingerprint, app, key, first_seen.strftime(TIME_FORMAT)) for (fingerprint, app, key, first_seen) in rows]
+
+        # read and written under the lock rather than upserted, which needs SQLite 3.24
+        with self._lock, self._connection:
+            indexed = {}
+            for chunk in self._chunks(fingerprint for (fingerprint, _, _, _) in rows):
+                indexed.update(self._connection.execute(
+                    'SELECT fingerprint, first_seen FROM fingerprints WHERE env = ? AND fingerprint IN ({})'.format(
+                        ', '.join('?' * len(chunk))), [env] + chunk))
+
+            self._connection.executemany(
+                'INSERT INTO fingerprints (env, fingerprint, app, canonical_key, first_seen) VALUES (?, ?, ?, ?, ?)',
+                [(env,) + row for row in rows if row[0] not in indexed])
+            self._connection.executemany(
+                'UPDATE fingerprints SET first_seen = ? WHERE env = ? AND fingerprint = ?',
+                [(first_seen, env, fingerprint) for (fingerprint, _, _, first_seen) in rows
+                 if fingerprint in indexed and first_seen < indexed[fingerprint]])
+
+    def get_reports(self, env, windows, parser_version, apps=None):
+        """
+        Return {(start_time, end_time): {app: {key: occurrences}}} for the cached windows only.
+        """
+        wanted = set(windows)
+        starts = sorted(set(start_time.strftime(TIME_FORMAT) for (start_time, _) in wanted))
+
+        window_ids = {}
+        with self._lock:
+            for chunk in self._chunks(starts):
+                rows = self._connection.execute(
+                    ('SELECT id, window_start, window_end FROM windows '
+                     'WHERE env = ? AND parser_version = ? AND window_start IN ({})').format(', '.join('?' * len(chunk))),
+                    [env, parser_version] + chunk)
+                for (window_id, window_start, window_end) in rows:
+                    window = (datetime.strptime(window_start, TIME_FORMAT), datetime.strptime(window_end, TIME_FORMAT))
+                    if window in wanted:
+                        window_ids[window_id] = window
+
+            reports = dict((window, {}) for window in window_ids.values())
+
+            app_filter = ''
+            apps = sorted(apps) if apps is not None else None
+            if apps is not None:
+                app_filter = ' AND app IN ({})'.format(', '.join('?' * len(apps)))
+
+            for chunk in self._chunks(sorted(window_ids)):
+                rows = self._connection.execute(
+                    'SELECT window_id, app, error_key, occurrences FROM errors WHERE window_id IN ({}){}'.format(
+                        ', '.join('?' * len(chunk)), app_filter),
+                    chunk + (apps or []))
+                for (window_id, app, key, occurrences) in rows:
+                    report = reports[window_ids[window_id]]
+                    if app not in report:
+                        report[app] = {}
+                    report[app][key] = occurrences
+
+            with self._connection:
+                last_access = datetime.now().strftime(TIME_FORMAT)
+                for chunk in self._chunks(sorted(window_ids)):
+                    self._connection.execute(
+                        'UPDATE windows SET last_access = ? WHERE id IN ({})'.format(', '.join('?' * len(chunk))),
+                        [last_access] + chunk)
+
+        return reports
+
+    def put_report(self, env, start_time, end_time, report, parser_version):
+        window = (env, start_time.strftime(TIME_FORMAT), end_time.strftime(TIME_FORMAT), parser_version)
+        now = datetime.now().strftime(TIME_FORMAT)
+        size_bytes = sum(len(app) + len(key) + ROW_OVERHEAD_BYTES for app in report for key in report[app])
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM windows WHERE env = ? AND window_start = ? AND window_end = ? AND parser_version = ?',
+                window)
+            cursor = self._connection.execute(
+                ('INSERT INTO windows (env, window_start, window_end, parser_version, fetched_at, last_access, size_bytes) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?)'),
+                window + (now, now, size_bytes))
+            window_id = cursor.lastrowid
+
+            self._connection.executemany(
+                'INSERT INTO errors (window_id, app, error_key, occurrences) VALUES (?, ?, ?, ?)',
+                ((window_id, app, key, occurrences) for app in report for (key, occurrences) in report[app].items()))
+
+    def migrate_pickles(self, directory, env, parser_version):
+        """
+        Import '{start}__{end}.pkl' reports written by earlier versions. Returns the number of reports imported.
+        """
+        migrated = 0
+        for file_name in sorted(os.listdir(directory)):
+            match = PICKLE_FILE_PATTERN.match(file_name)
+            if not match:
+                continue
+
+            start_time = datetime.strptime(match.group(1), PICKLE_TIME_FORMAT)
+            end_time = datetime.strptime(match.group(2), PICKLE_TIME_FORMAT)
+            # pickles were named with minutes precision, windows end at the last second of a minute
+            end_time = end_time.replace(second=59)
+
+            with open(os.path.join(directory, file_name), 'rb') as f:
+                report = pickle.load(f)
+
+            self.put_report(env, start_time, end_time, report, parser_version)
+            migrated += 1
+
+        return migrated
+
+    def prune(self, parser_version, max_age_days=None, max_bytes=None):
+        """
+        Evict windows of other parser versions, windows fetched more than max_age_days ago and
+        then least recently used windows until the cached reports fit in max_bytes.
+        Returns the number of windows evicted.
+        """
+        with self._lock:
+            with self._connection:
+                evicted = self._connection.execute(
+                    'DELETE FROM windows WHERE parser_version != ?', (parser_version,)).rowcount
+
+                if max_age_days is not None:
+                    fetched_before = (datetime.now() - timedelta(days=max_age_days)).strftime(TIME_FORMAT)
+                    evicted += self._connection.execute(
+                        'DELETE FROM windows WHERE fetched_at < ?', (fetched_before,)).rowcount
+                    self._connection.execute('DELETE FROM results WHERE created_at < ?', (fetched_before,))
+
+                if max_bytes is not None:
+                    total_bytes = self._connection.execute(
+                        'SELECT COALESCE(SUM(size_bytes), 0) FROM windows').fetchone()[0]
+                    lru_ids = []
+                    rows = self._connection.execute(
+                        'SELECT id, size_bytes FROM windows ORDER BY last_access, id').fetchall()
+                    for (window_id, size_bytes) in rows:
+                        if total_bytes <= max_bytes:
+                            break
+                        lru_ids.append(window_id)
+                        total_bytes -= size_bytes
+
+                    for chunk in self._chunks(lru_ids):
+                        evicted += self._connection.execute(
+                            'DELETE FROM windows WHERE id IN ({})'.format(', '.join('?' * len(chunk))), chunk).rowcount
+
+            if evicted:
+                self._connection.execute('VACUUM')
+
+        return evicted
+
+    def stats(self):
+        """
+        Return per environment statistics: windows and errors cached, bytes, oldest fetch and last access.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT env, COUNT(*), SUM(size_bytes), MIN(fetched_at), MAX(last_access), '
+                '(SELECT COUNT(*) FROM errors e JOIN windows x ON x.id = e.window_id WHERE x.env = w.env) '
+                'FROM windows w GROUP BY env ORDER BY env').fetchall()
+
+        return [
+            {
+                'env': env, 'windows': windows, 'errors': errors, 'bytes': size_bytes,
+                'oldest_fetch': oldest_fetch, 'last_access': last_access
+            }
+            for (env, windows, size_bytes, oldest_fetch, last_access, errors) in rows
+        ]
+
+    def file_size(self):
+        if self.path == ':memory:' or not os.path.isfile(self.path):
+            return 0
+
+        return os.path.getsize(self.path)
+
+    def _chunks(self, values):
+        values = list(values)
+        for i in range(0, len(values), MAX_QUERY_PARAMS):
+            yield values[i:i + MAX_QUERY_PARAMS]
+
+def get_history_data_path():
+    """
+    The history_data directory of the package, created when missing.
+    """
+    history_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), HISTORY_DATA_DIR)
+
+    if not os.path.isdir(history_dir):
+        try:
+            os.makedirs(history_dir)
+        except FileExistsError:
+            # created by a concurrent fetch in the meantime
+            pass
+
+    return history_dir
+
+def get_store_path():
+    return os.path.join(get_history_data_path(), DB_FILE_NAME)
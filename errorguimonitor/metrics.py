@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Metrics module.
+
+Time the stages of a run and count what went through them, written out as JSON or
+as a Prometheus textfile.
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+from .files import atomic_open
+
+PROMETHEUS_PREFIX = 'errorguimonitor'
+
+# counters of the run, all of them written even when nothing was counted
+ROWS_PARSED = 'rows_parsed'
+KEYS_COMPARED = 'keys_compared'
+CACHE_HITS = 'cache_hits'
+CACHE_MISSES = 'cache_misses'
+BYTES_DOWNLOADED = 'bytes_downloaded'
+COUNTERS = [ROWS_PARSED, KEYS_COMPARED, CACHE_HITS, CACHE_MISSES, BYTES_DOWNLOADED]
+
+class Metrics(object):
+    """
+    Thread safe stage timers and counters. A stage keeps its calls, total and slowest seconds;
+    stages nest, so e.g. login time is also part of the report fetch it happened in.
+    """
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache_hit_ratio(self):
+        lookups = self.counters[CACHE_HITS] + self.counters[CACHE_MISSES]
+
+        return self.counters[CACHE_HITS] / float(lookups) if lookups else None
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            stage_times = self.stages.setdefault(stage, { 'calls': 0, 'seconds': 0., 'max_seconds': 0. })
+            stage_times['calls'] += 1
+            stage_times['seconds'] += seconds
+            stage_times['max_seconds'] = max(stage_times['max_seconds'], seconds)
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'cache_hit_ratio': self.cache_hit_ratio,
+                'stages': dict((stage, dict(stage_times)) for (stage, stage_times) in self.stages.items())
+            }
+
+    def to_prometheus(self):
+        """
+        Prometheus text exposition format, e.g. for the node exporter textfile collector.
+        """
+        metrics = self.to_dict()
+        lines = []
+
+        for (counter, value) in sorted(metrics['counters'].items()):
+            name = '{}_{}_total'.format(PROMETHEUS_PREFIX, counter)
+            lines += ['# TYPE {} counter'.format(name), '{} {}'.format(name, value)]
+
+        if metrics['cache_hit_ratio'] is not None:
+            name = '{}_cache_hit_ratio'.format(PROMETHEUS_PREFIX)
+            lines += ['# TYPE {} gauge'.format(name), '{} {:g}'.format(name, metrics['cache_hit_ratio'])]
+
+        for (suffix, field, kind) in [('calls_total', 'calls', 'counter'), ('seconds_total', 'seconds', 'counter'),
+                                      ('max_seconds', 'max_seconds', 'gauge')]:
+            name = '{}_stage_{}'.format(PROMETHEUS_PREFIX, suffix)
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (stage, stage_times) in sorted(metrics['stages'].items()):
+                lines.append('{}{{stage="{}"}} {:g}'.format(name, stage, stage_times[field]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        self._write(path, json.dumps(self.to_dict(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path):
+        self._write(path, self.to_prometheus())
+
+    def _write(self, path, content):
+        with atomic_open(path) as f:
+            f.write(content)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Normalizer module.
+
+Collapse error keys differing only by GUIDs, timestamps, ids or numbers into one canonical key per
+fingerprint, with the fingerprint index kept in the history store across runs.
+"""
+
+import functools
+import hashlib
+import re
+
+# (placeholder, pattern) tried in order at every word boundary, the more specific patterns first
+NORMALIZATION_RULES = [
+    ('guid', r'[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}'),
+    ('timestamp', r'\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?'),
+    ('time', r'\d{1,2}:\d{2}:\d{2}(?:[.,]\d+)?'),
+    ('hex', r'0x[0-9a-f]+|(?=[0-9a-f]*\d)[0-9a-f]{12,}'),
+    # ids after =, # or : and standalone numbers long enough not to be status codes
+    ('n', r'(?<=[=#:])\d+|\d{4,}'),
+]
+
+# one alternation, so a key is scanned once whatever the number of rules - every rule starts with
+# a hex digit, so the other word boundaries fail on the lookahead without trying the rules
+NORMALIZATION_RE = re.compile(
+    r'\b(?=[0-9a-f])(?:{})\b'.format('|'.join('(?P<{}>{})'.format(name, pattern) for (name, pattern) in NORMALIZATION_RULES)),
+    re.IGNORECASE)
+# the rules are for ids, which carry digits - keys without any are left as they are
+DIGIT_RE = re.compile(r'\d')
+
+NORMALIZE_CACHE_SIZE = 1 << 17
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_key(key):
+    if not DIGIT_RE.search(key):
+        return key
+
+    return NORMALIZATION_RE.sub(_get_placeholder, key)
+
+def get_fingerprint(app, key):
+    return hashlib.sha1('{}\0{}'.format(app, normalize_key(key)).encode('utf-8')).hexdigest()[:16]
+
+class KeyNormalizer(object):
+    """
+    Rewrites reports of the environment to canonical keys: the first key ever seen of a fingerprint
+    there names all its keys, so a cluster keeps the same name from run to run. Every environment has
+    an index of its own - a key seen in one is still new in another.
+    """
+    def __init__(self, store, env):
+        self.store = store
+        self.env = env
+
+    def normalize_reports(self, windows, reports):
+        """
+        Return the reports of the windows with the occurrences of every fingerprint summed under its
+        canonical key, and {(app, canonical key): first seen} of the keys reported.
+        """
+        # most keys come back every day - each one is normalized once
+        fingerprints = {}
+        first_seen = {}
+        for ((start_time, _), report) in zip(windows, reports):
+            for app in report:
+                for key in report[app]:
+                    fingerprint = fingerprints.get((app, key))
+                    if fingerprint is None:
+                        fingerprint = fingerprints[(app, key)] = get_fingerprint(app, key)
+                    if fingerprint not in first_seen or (start_time, key) < first_seen[fingerprint][1:]:
+                        first_seen[fingerprint] = (app, start_time, key)
+
+        indexed = self.store.get_fingerprints(self.env, list(first_seen))
+        rows = []
+        for (fingerprint, (app, start_time, key)) in first_seen.items():
+            if fingerprint not in indexed or start_time < indexed[fingerprint][1]:
+                rows.append((fingerprint, app, indexed[fingerprint][0] if fingerprint in indexed else key, start_time))
+        self.store.put_fingerprints(self.env, rows)
+        indexed.update((fingerprint, (key, start_time)) for (fingerprint, _, key, start_time) in rows)
+
+        canonical_keys = dict((raw_key, indexed[fingerprint][0]) for (raw_key, fingerprint) in fingerprints.items())
+        normalized_reports = []
+        for report in reports:
+            normalized = {}
+            for app in report:
+                app_errors = normalized[app] = {}
+                for (key, occurrences) in report[app].items():
+                    canonical_key = canonical_keys[(app, key)]
+                    app_errors[canonical_key] = app_errors.get(canonical_key, 0) + occurrences
+            normalized_reports.append(normalized)
+
+        return (normalized_reports, dict(
+            ((app, indexed[fingerprint][0]), indexed[fingerprint][1]) for (fingerprint, (app, _, _)) in first_seen.items()))
+
+def _get_placeholder(match):
+    return '<{}>'.format(match.lastgroup)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+Notifiers module.
+
+Sinks delivering report messages: SMTP, a local maildir, a webhook or stdout,
+optionally behind a queue delivering them in the background.
+"""
+
+import mailbox
+import queue
+import requests
+import smtplib
+import sys
+import threading
+import time
+
+from email.message import EmailMessage
+
+from .metrics import Metrics
+
+SENDER = 'errorguimonitor@test.com'
+
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 587
+
+WEBHOOK_TIMEOUT = 10
+
+RETRIES = 3
+RETRY_DELAY = 1.
+
+class SmtpNotifier(object):
+    """
+    Sends messages over one SMTP connection, opened on the first message and reopened when it drops.
+    """
+    def __init__(self, user, password, host=SMTP_HOST, port=SMTP_PORT):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def close(self):
+        if self._server is None:
+            return
+
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
+
+    def send(self, message):
+        if self._server is None:
+            self._server = self._connect()
+
+        try:
+            self._server.send_message(message)
+        except (smtplib.SMTPException, OSError):
+            # the next attempt starts over with a new connection
+            self.close()
+            raise
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port)
+        server.ehlo()
+        server.starttls()
+        server.login(self.user, self.password)
+
+        return server
+
+class MaildirNotifier(object):
+    """
+    Delivers messages to a local maildir, created when missing.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._maildir = mailbox.Maildir(path, create=True)
+
+    def close(self):
+        pass
+
+    def send(self, message):
+        self._maildir.add(message)
+
+class WebhookNotifier(object):
+    """
+    Posts messages as JSON to a webhook url.
+    """
+    def __init__(self, url, timeout=WEBHOOK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def close(self):
+        self._session.close()
+
+    def send(self, message):
+        response = self._session.post(self.url, timeout=self.timeout, json={
+            'subject': message['Subject'],
+            'from': message['From'],
+            'to': message['To'],
+            'cc': message['Cc'],
+            'body': get_body(message),
+            'attachments': [part.get_filename() for part in message.iter_attachments()]
+        })
+        response.raise_for_status()
+
+class StdoutNotifier(object):
+    """
+    Prints messages, e.g. for dry runs.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+
+    def close(self):
+        self.stream.flush()
+
+    def send(self, message):
+        self.stream.write('To: {}\nSubject: {}\n\n{}\n'.format(message['To'], message['Subject'], get_body(message)))
+        for part in message.iter_attachments():
+            self.stream.write('Attached: {} ({} bytes)\n'.format(part.get_filename(), len(part.get_content())))
+
+class QueuedNotifier(object):
+    """
+    Hands messages over to a background thread, so sending never waits for the sink.
+    Failed deliveries are retried with exponential backoff; close() waits for the queue to drain.
+    Every delivery, retries included, is timed as the deliver_notification stage of the metrics.
+    """
+    def __init__(self, notifier, retries=RETRIES, retry_delay=RETRY_DELAY, metrics=None):
+        self.notifier = notifier
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.failed = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._deliver, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.notifier.close()
+
+    def send(self, message):
+        self._queue.put(message)
+
+    def _deliver(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                return
+
+            with self.metrics.time('deliver_notification'):
+                self._deliver_message(message)
+
+    def _deliver_message(self, message):
+        for attempt in range(self.retries + 1):
+            try:
+                self.notifier.send(message)
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    print('notification "{}" not delivered: {}'.format(message['Subject'], e))
+                    self.failed.append(message)
+                else:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+
+def build_message(subject, body, to, cc=None, bcc=None, sender=SENDER, attachments=None):
+    """
+    HTML message of the report body, with the [(file name, gzipped data)] attachments.
+    """
+    msg = EmailMessage()
+
+    msg['Subject'] = subject
+    msg.set_content(body)
+    msg['From'] = sender
+    msg['To'] = ', '.join(to)
+    msg.replace_header('Content-type', 'text/html')
+    if cc:
+        msg['Cc'] = ', '.join(cc)
+    if bcc:
+        msg['Bcc'] = ', '.join(bcc)
+    for (file_name, data) in attachments or []:
+        msg.add_attachment(data, maintype='application', subtype='gzip', filename=file_name)
+
+    return msg
+
+def get_body(message):
+    """
+    The HTML body of a message, with or without attachments.
+    """
+    return message.get_body(('html', 'plain')).get_content()
+
+def get_notifier(spec, smtp_user=None, smtp_password=None):
+    """
+    Notifier for one of NOTIFIERS, e.g. 'smtp' or 'maildir:/var/mail/errorguimonitor'.
+    """
+    (kind, _, target) = spec.partition(':')
+    if kind == 'smtp':
+        return SmtpNotifier(smtp_user, smtp_password)
+    if kind == 'stdout':
+        return StdoutNotifier()
+    if kind == 'maildir' and target:
+        return MaildirNotifier(target)
+    if kind == 'webhook' and target:
+        return WebhookNotifier(target)
+
+    raise ValueError('unknown notifier: {}'.format(spec))
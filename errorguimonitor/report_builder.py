@@ -4,71 +4,235 @@
 Report builder module.
 """
 
-import inspect
+import gzip
 import os
-import pickle
+import threading
 
-from urllib.parse import quote as url_quote
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-from pyquery import PyQuery as pq
+from urllib.parse import quote as url_quote
 
+from .history_store import DB_FILE_NAME, HistoryStore, get_history_data_path
+from .metrics import CACHE_HITS, CACHE_MISSES, ROWS_PARSED, Metrics
+from .report_parser import ErrorTableParser
 from .report_retriever import ErrorReportRetriever
+from .settings import BUCKET_SIZE, PARSER_VERSION
 
 TIME_FORMAT = '%Y_%m_%d_%H_%M'
 
+RAW_HTML_FILE_NAME = '{env}__{start}__{end}.html.gz'
+
+PICKLES_MIGRATED = 'pickles_migrated'
+
+# windows end at the last second they cover, e.g. 23:59:59
+WINDOW_RESOLUTION = timedelta(seconds=1)
+
 class ErrorReportBuilder(object):
-    def __init__(self, env, user, password):
-        self.report_retriever = ErrorReportRetriever(env, user, password)
-
-    def build_report(self, start_time, end_time):
-        report_file_name = os.path.join(
-            self._get_history_data_path(), 
-            '{}__{}.pkl'.format(start_time.strftime(TIME_FORMAT), end_time.strftime(TIME_FORMAT))
-        )
-        
-        if not os.path.isfile(report_file_name):
-            report = self._load_report(start_time, end_time)
-            pickle.dump(report, open(report_file_name, 'wb'))
+    def __init__(self, env, user, password, stream=False, raw_html_dir=None, store=None, bucket_size=BUCKET_SIZE,
+                 session_pool=None, fetch_slots=None, metrics=None, transport=None):
+        self.env = env
+        self.bucket_size = bucket_size
+        self.stream = stream
+        self.raw_html_dir = raw_html_dir
+        # a semaphore shared by builders limits the fetches running at once across all of them
+        self.fetch_slots = fetch_slots if fetch_slots is not None else _UnlimitedSlots()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.report_retriever = ErrorReportRetriever(env, user, password, session_pool, self.metrics, transport)
+        self._store = store
+        self._owns_store = store is None
+        self._store_lock = threading.Lock()
+
+    def close(self):
+        self.report_retriever.close()
+        if self._store is not None and self._owns_store:
+            self._store.close()
+            self._store = None
+
+    def build_report(self, start_time, end_time, apps=None):
+        return self.build_reports([(start_time, end_time)], apps=apps)[0]
+
+    def build_reports(self, windows, max_workers=1, apps=None):
+        """
+        Build reports for the (start_time, end_time) windows provided, limited to apps when provided.
+        Windows not cached as a whole are put together from bucket_size buckets - cached buckets are
+        loaded with one query and only the missing ones are fetched, up to max_workers at a time.
+        Reports are returned in the same order as windows.
+        """
+        windows = list(windows)
+        store = self.get_store()
+
+        window_pieces = dict((window, self._split_window(*window)) for window in windows)
+        pieces = self._unique(windows + [piece for window in windows for piece in window_pieces[window]])
+
+        with self.metrics.time('cache_read'):
+            reports = store.get_reports(self.env, pieces, PARSER_VERSION, apps)
+
+        missing = self._unique(
+            piece for window in windows if window not in reports
+            for piece in window_pieces[window] if piece not in reports)
+        self.metrics.count(CACHE_HITS, len(self._unique(
+            [window for window in windows if window in reports] +
+            [piece for window in windows if window not in reports for piece in window_pieces[window] if piece in reports])))
+        self.metrics.count(CACHE_MISSES, len(missing))
+
+        if max_workers <= 1 or len(missing) <= 1:
+            fetched = [self._fetch_report(start_time, end_time, apps) for (start_time, end_time) in missing]
         else:
-            report = pickle.load(open(report_file_name, 'rb'))
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+                fetched = list(executor.map(lambda window: self._fetch_report(window[0], window[1], apps), missing))
 
-        return report
+        reports.update(zip(missing, fetched))
 
-    def _extract_error(self, tr, error_dict):
-        app = tr('td:eq(1)').text().strip()
-        key = tr('td:eq(2)').text().strip()
-        occurrences = int(tr('td:eq(3)').text().strip())
+        return [
+            reports[window] if window in reports else self._sum_reports([reports[piece] for piece in window_pieces[window]])
+            for window in windows
+        ]
 
-        if app not in error_dict:
-            error_dict[app] = {}
+    def fetch_report(self, start_time, end_time, apps=None):
+        """
+        Fetch the window in one request, neither read from nor written to the cache - for windows
+        nothing will ask for again, like the minutes a watcher polls.
+        """
+        with self.fetch_slots, self.metrics.time('load_report'):
+            return self._load_report(start_time, end_time, apps)
 
-        if key not in error_dict[app]:
-            error_dict[app][key] = occurrences
+    def get_store(self):
+        with self._store_lock:
+            if self._store is None:
+                self._store = HistoryStore(self.get_store_path())
 
-        return error_dict
+                if not self._store.get_meta(PICKLES_MIGRATED):
+                    # pickles of earlier versions were not keyed by environment
+                    self._store.migrate_pickles(self._get_history_data_path(), self.env, PARSER_VERSION)
+                    self._store.set_meta(PICKLES_MIGRATED, '1')
 
-    def _get_history_data_path(self):
-        history_dir = os.path.join(
-            '../',
-            os.path.dirname(inspect.getfile(self.__class__)),
-            'history_data')
+        return self._store
 
-        if not os.path.isdir(history_dir):
-             os.makedirs(history_dir)
+    def get_store_path(self):
+        return os.path.join(self._get_history_data_path(), DB_FILE_NAME)
 
-        return history_dir
+    def prune_cache(self, max_age_days=None, max_bytes=None):
+        return self.get_store().prune(PARSER_VERSION, max_age_days, max_bytes)
 
-    def _load_report(self, start_time, end_time):
-        result = self.report_retriever.get_html(start_time, end_time)
-        html = pq(result)
+    def _fetch_report(self, start_time, end_time, apps=None):
+        # a window still in progress gets more errors - cache complete windows only,
+        # parsed for all apps so the cache serves any apps later on
+        complete = end_time < datetime.now()
+        with self.fetch_slots, self.metrics.time('load_report'):
+            report = self._load_report(start_time, end_time) if complete else self._load_report(start_time, end_time, apps)
 
-        return self._process_html(html)
+        if complete:
+            with self.metrics.time('cache_write'):
+                self.get_store().put_report(self.env, start_time, end_time, report, PARSER_VERSION)
 
-    def _process_html(self, html):
+        if apps is None:
+            return report
+
+        return dict((app, report[app]) for app in apps if app in report)
+
+    def _get_history_data_path(self):
+        return get_history_data_path()
+
+    def _load_report(self, start_time, end_time, apps=None):
+        parser = self._read_report(start_time, end_time, apps)
+        if not parser.table_found:
+            # SAFE may answer a reused session with its login page rather than the re-auth form -
+            # it is not an empty report, the pooled sessions are logged out
+            self.report_retriever.discard_sessions()
+            parser = self._read_report(start_time, end_time, apps, new_session=True)
+            if not parser.table_found:
+                raise RuntimeError('ErrorGUI sent no error table for {} environment'.format(self.env))
+
+        return parser.errors
+
+    def _parse(self, chunks, apps, stage):
+        parser = ErrorTableParser(apps)
+        with self.metrics.time(stage):
+            for chunk in chunks:
+                parser.feed(chunk)
+            parser.close()
+        self.metrics.count(ROWS_PARSED, parser.rows_parsed)
+
+        return parser
+
+    def _process_html(self, html, apps=None):
+        return self._parse([html], apps, 'parse').errors
+
+    def _read_report(self, start_time, end_time, apps=None, new_session=False):
+        if not self.stream:
+            html = self.report_retriever.get_html(start_time, end_time, new_session=new_session)
+            if self.raw_html_dir:
+                html = ''.join(self._save_raw_html(start_time, end_time, [html]))
+
+            return self._parse([html], apps, 'parse')
+
+        chunks = self.report_retriever.iter_html(start_time, end_time, new_session=new_session)
+        if self.raw_html_dir:
+            chunks = self._save_raw_html(start_time, end_time, chunks)
+
+        # parsing goes along with the download, the parse stage is part of it
+        return self._parse(chunks, apps, 'download_parse')
+
+    def _split_window(self, start_time, end_time):
+        """
+        Split the window into buckets aligned to bucket_size from midnight. Partial buckets
+        at the window edges become pieces of their own.
+        """
+        if not self.bucket_size:
+            return [(start_time, end_time)]
+
+        pieces = []
+        piece_start = start_time
+        while piece_start <= end_time:
+            midnight = datetime(piece_start.year, piece_start.month, piece_start.day)
+            bucket_start = midnight + (piece_start - midnight) // self.bucket_size * self.bucket_size
+            piece_end = min(bucket_start + self.bucket_size - WINDOW_RESOLUTION, end_time)
+            pieces.append((piece_start, piece_end))
+            piece_start = piece_end + WINDOW_RESOLUTION
+
+        return pieces
+
+    def _sum_reports(self, reports):
         errors = {}
-        trs = html('div.borderedBoxWhite table.tablesorter tr')[1:]
-        for tr in trs:
-            self._extract_error(pq(tr), errors)
+        for report in reports:
+            for app in report:
+                if app not in errors:
+                    errors[app] = {}
+
+                app_errors = errors[app]
+                for (key, occurrences) in report[app].items():
+                    app_errors[key] = app_errors.get(key, 0) + occurrences
 
         return errors
 
+    def _unique(self, windows):
+        return list(OrderedDict.fromkeys(windows))
+
+    def _save_raw_html(self, start_time, end_time, chunks):
+        """
+        Write the page to a gzipped debug artifact, passing the chunks through.
+        Whatever was downloaded is kept even when the download or parsing fails half way.
+        """
+        if not os.path.isdir(self.raw_html_dir):
+            os.makedirs(self.raw_html_dir, exist_ok=True)
+
+        file_name = os.path.join(self.raw_html_dir, RAW_HTML_FILE_NAME.format(
+            env=self.env, start=start_time.strftime(TIME_FORMAT), end=end_time.strftime(TIME_FORMAT)))
+
+        with gzip.open(file_name, 'wt', encoding='utf-8') as raw_html:
+            for chunk in chunks:
+                raw_html.write(chunk)
+                yield chunk
+
+class _UnlimitedSlots(object):
+    """
+    Fetch slots of a builder of its own - no limit, as its fetches are limited by max_workers already.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
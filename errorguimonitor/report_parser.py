@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Report parser module.
+
+Stream ErrorGUI summary page rows straight into the errors dictionary,
+without building a DOM for the whole page.
+"""
+
+import re
+
+from lxml import etree
+
+# the same whitespace squashing pyquery applies in .text()
+WHITESPACE_RE = re.compile('[\x20\x09\x0C\u200B\x0A\x0D]+')
+
+BOX_CLASS = 'borderedBoxWhite'
+TABLE_CLASS = 'tablesorter'
+
+APP_CELL = 1
+KEY_CELL = 2
+OCCURRENCES_CELL = 3
+
+class ErrorTableParser(object):
+    """
+    Incremental parser for rows of 'div.borderedBoxWhite table.tablesorter' tables.
+
+    Feed it the page in chunks of any size and call close() to get {app: {key: occurrences}}.
+    Rows of applications other than apps are skipped when apps is provided. table_found tells whether
+    the page had such a table at all - a report of no errors still has one, a login page does not.
+    """
+    def __init__(self, apps=None):
+        self.apps = set(apps) if apps is not None else None
+        self.errors = {}
+        self.rows_parsed = 0
+        self.table_found = False
+        self._parser = etree.HTMLParser(target=_ErrorTableTarget(self))
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    def close(self):
+        self._parser.close()
+        return self.errors
+
+    def add_row(self, cells):
+        if len(cells) <= OCCURRENCES_CELL:
+            return
+
+        app = cells[APP_CELL]
+        if self.apps is not None and app not in self.apps:
+            return
+
+        key = cells[KEY_CELL]
+        occurrences = int(cells[OCCURRENCES_CELL])
+
+        if app not in self.errors:
+            self.errors[app] = {}
+
+        if key not in self.errors[app]:
+            self.errors[app][key] = occurrences
+
+        self.rows_parsed += 1
+
+class _ErrorTableTarget(object):
+    """
+    lxml parser target - a small state machine over start/end/data events.
+    """
+    def __init__(self, table_parser):
+        self.table_parser = table_parser
+        self.box_depth = 0
+        self.table_depth = 0
+        self.open_elements = []
+        self.rows_seen = 0
+        self.row_cells = None
+        self.open_cells = []
+
+    def start(self, tag, attrib):
+        kind = None
+        if tag == 'div' and self._has_class(attrib, BOX_CLASS):
+            self.box_depth += 1
+            kind = 'box'
+        elif tag == 'table' and self.box_depth and self._has_class(attrib, TABLE_CLASS):
+            self.table_depth += 1
+            self.table_parser.table_found = True
+            kind = 'table'
+        elif tag == 'tr' and self.table_depth:
+            # the first row is the table header
+            if self.rows_seen:
+                self.row_cells = []
+            self.rows_seen += 1
+            kind = 'tr'
+        elif tag == 'td' and self.row_cells is not None:
+            self.open_cells.append(len(self.row_cells))
+            self.row_cells.append([])
+            kind = 'td'
+
+        self.open_elements.append(kind)
+
+    def end(self, tag):
+        if not self.open_elements:
+            return
+
+        kind = self.open_elements.pop()
+        if kind == 'box':
+            self.box_depth -= 1
+        elif kind == 'table':
+            self.table_depth -= 1
+        elif kind == 'td':
+            self.open_cells.pop()
+        elif kind == 'tr' and self.row_cells is not None:
+            cells = [WHITESPACE_RE.sub(' ', ''.join(parts)).strip() for parts in self.row_cells]
+            self.row_cells = None
+            self.table_parser.add_row(cells)
+
+    def data(self, data):
+        for cell in self.open_cells:
+            self.row_cells[cell].append(data)
+
+    def close(self):
+        return self.table_parser.errors
+
+    def _has_class(self, attrib, css_class):
+        return css_class in attrib.get('class', '').split()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+Report renderer module.
+
+Render comparisons into a message body of bounded size: the entries of every table ranked by impact,
+the top ones inline and the full results attached as gzipped CSV and JSON.
+"""
+
+import csv
+import gzip
+import html
+import io
+import json
+
+from .settings import MAX_MESSAGE_BYTES, TOP_N
+
+CSV_FILE_NAME = 'errors.csv.gz'
+JSON_FILE_NAME = 'errors.json.gz'
+CSV_FIELDS = ['env', 'app', 'kind', 'rank', 'key', 'occurrences', 'result']
+# zlib's default level, most of the size of level 9 at a fraction of its time
+COMPRESS_LEVEL = 6
+
+NEW = 'new'
+INCREASED = 'increased'
+
+TABLE_START = ('<table style="border: 1px solid black; border-collapse: collapse;" cellpadding="5" border="1">'
+               '<tr><th>Error key</th><th>{}</th></tr>')
+TABLE_ROW = '<tr><td style="text-align: left">{}</td><td>{}</td></tr>'
+TABLE_END = '</table>'
+
+# room kept for the message headers and for closing the body once its rows are cut
+RESERVED_BYTES = 8 * 1024
+# attachments are base64 encoded in 76 character lines
+ENCODED_SIZE = 4. / 3 * 78 / 76
+# the body is sent quoted-printable or base64, whichever the message finds shorter - it is counted as the
+# longer of both, quoted-printable escaping every byte but printable ASCII to three and breaking lines
+# at 76 characters with up to four more
+QP_SAFE_BYTES = bytes(set(range(32, 127)) - set(b'=') | set(b'\t\r\n'))
+QP_LINE_SIZE = 80. / 76
+
+class ReportRenderer(object):
+    """
+    Renders [(env, labels, new errors, errors increased)] sections, one per environment.
+
+    New errors are ranked by their occurrences and increased ones by the first value of their
+    result, the lower bound of the interval or the difference of means. Every table lists its top_n
+    entries, all of them with top_n 0, and rows past max_bytes for the whole message are cut and only
+    counted. When anything is left out, the full results are attached as long as they take half of
+    max_bytes at most.
+    """
+    def __init__(self, significance_test, top_n=TOP_N, max_bytes=MAX_MESSAGE_BYTES):
+        self.significance_test = significance_test
+        self.top_n = top_n
+        self.max_bytes = max_bytes
+
+    def rank(self, new_errors, errors_increased):
+        """
+        {app: ([(key, counts)], [(key, result)])} with the entries of every app ranked by impact.
+        """
+        ranked = {}
+        for app in set(new_errors) | set(errors_increased):
+            ranked[app] = (
+                sorted(new_errors.get(app, {}).items(), key=lambda entry: (-sum(entry[1]), entry[0])),
+                sorted(errors_increased.get(app, {}).items(), key=lambda entry: (-entry[1][0], entry[0]))
+            )
+
+        return ranked
+
+    def render(self, sections, footer=''):
+        """
+        (body, [(file name, gzipped data)]) of the sections.
+        """
+        ranked_sections = [(env, labels, self.rank(new_errors, errors_increased))
+                           for (env, labels, new_errors, errors_increased) in sections]
+
+        writer = self._write_body(ranked_sections, footer, [], [])
+        if not writer.cut:
+            return (writer.getvalue(), [])
+
+        # the body is written again, around the attachments
+        all_attachments = self._get_attachments(ranked_sections)
+        attachments = self._fit_attachments(all_attachments)
+        dropped = [name for (name, _) in all_attachments if name not in dict(attachments)]
+        writer = self._write_body(ranked_sections, footer, attachments, dropped)
+
+        return (writer.getvalue(), attachments)
+
+    def _fit_attachments(self, attachments):
+        """
+        The attachments taking half of max_bytes at most, the larger ones dropped first.
+        """
+        if self.max_bytes is None:
+            return attachments
+
+        attachments = sorted(attachments, key=lambda attachment: len(attachment[1]))
+        while attachments and get_encoded_size(attachments) > self.max_bytes / 2:
+            attachments.pop()
+
+        return sorted(attachments)
+
+    def _get_attachments(self, ranked_sections):
+        rows = []
+        for (env, _, ranked) in ranked_sections:
+            for app in sorted(ranked):
+                (app_new_errors, app_errors_increased) = ranked[app]
+                rows += [
+                    { 'env': env, 'app': app, 'kind': NEW, 'rank': rank, 'key': key, 'occurrences': counts }
+                    for (rank, (key, counts)) in enumerate(app_new_errors, 1)
+                ]
+                rows += [
+                    { 'env': env, 'app': app, 'kind': INCREASED, 'rank': rank, 'key': key,
+                      'result': self.significance_test.format_result(result), 'values': result }
+                    for (rank, (key, result)) in enumerate(app_errors_increased, 1)
+                ]
+
+        csv_file = io.StringIO()
+        writer = csv.DictWriter(csv_file, CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, occurrences=' '.join(str(count) for count in row.get('occurrences', []))))
+
+        return [
+            (CSV_FILE_NAME, gzip.compress(csv_file.getvalue().encode('utf-8'), COMPRESS_LEVEL)),
+            (JSON_FILE_NAME, gzip.compress(json.dumps(rows).encode('utf-8'), COMPRESS_LEVEL))
+        ]
+
+    def _write_body(self, ranked_sections, footer, attachments, dropped):
+        budget = None if self.max_bytes is None else self.max_bytes - get_encoded_size(attachments) - RESERVED_BYTES
+        writer = _BodyWriter(budget)
+        more_label = 'in the attached {}'.format(' and '.join(name for (name, _) in attachments)) if attachments \
+            else 'not listed'
+
+        for (env, labels, ranked) in ranked_sections:
+            if len(ranked_sections) > 1:
+                writer.write('<h2>{}</h2>'.format(html.escape(env)))
+
+            for app in sorted(ranked):
+                (app_new_errors, app_errors_increased) = ranked[app]
+
+                writer.write('<h3>{}</h3>'.format(html.escape(app)))
+                self._write_table(writer, labels[0], labels[1], 'Occurrences', [
+                    (key, ', '.join(str(count) for count in counts)) for (key, counts) in app_new_errors[:self.top_n or None]
+                ], len(app_new_errors), more_label)
+                self._write_table(writer, labels[2], labels[3], 'Increase rate*', [
+                    (key, self.significance_test.format_result(result))
+                    for (key, result) in app_errors_increased[:self.top_n or None]
+                ], len(app_errors_increased), more_label)
+
+            if not ranked:
+                writer.write('No errors observed.<br/><br/>')
+
+        if dropped:
+            writer.write('The full results were not attached, {} would take over half of the {:g} KB message size '
+                         'limit.<br/><br/>'.format(' and '.join(dropped), self.max_bytes / 1024.))
+
+        writer.write(footer)
+
+        return writer
+
+    def _write_table(self, writer, label, empty_label, value_name, rows, total, more_label):
+        if not total:
+            writer.write('{}<br/><br/><br/>'.format(empty_label))
+            return
+
+        writer.write('{}<br/>'.format(label))
+        rows = [TABLE_ROW.format(html.escape(key), html.escape(value)) for (key, value) in rows]
+        table_start = TABLE_START.format(value_name)
+        shown = writer.get_fitting(rows, get_body_size(table_start + TABLE_END))
+        if shown:
+            writer.write(table_start)
+            for row in rows[:shown]:
+                writer.write(row)
+            writer.write(TABLE_END)
+
+        if shown < total:
+            writer.cut = True
+            writer.write('{} more {}.<br/>'.format(total - shown, more_label))
+        writer.write('<br/><br/>')
+
+class _BodyWriter(object):
+    """
+    Body written piece by piece, counting its bytes as sent. Rows are written as far as they fit in the budget,
+    everything else always, so the body stays well formed once the rows are cut.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.size = 0
+        # set once rows were left out, by the budget or by the top
+        self.cut = False
+        self.full = False
+        self._parts = []
+
+    def get_fitting(self, rows, overhead=0):
+        """
+        How many of the rows, written along with overhead bytes, fit in the budget - none once one did not.
+        """
+        if self.budget is None:
+            return len(rows)
+
+        size = self.size + overhead
+        for (i, row) in enumerate(rows):
+            size += get_body_size(row)
+            if self.full or size > self.budget:
+                self.full = True
+                return i
+
+        return len(rows)
+
+    def getvalue(self):
+        return ''.join(self._parts)
+
+    def write(self, text):
+        self._parts.append(text)
+        self.size += get_body_size(text)
+
+def get_body_size(text):
+    """
+    Bytes the text takes in the message body, at most.
+    """
+    data = text.encode('utf-8')
+    escaped = len(data.translate(None, QP_SAFE_BYTES))
+
+    return max(len(data) + 2 * escaped, len(data) * 4. / 3) * QP_LINE_SIZE
+
+def get_encoded_size(attachments):
+    return sum(int(len(data) * ENCODED_SIZE) for (_, data) in attachments)
@@ -6,13 +6,21 @@ Report retriever module.
 Grab HTML from the url provided.
 """
 
+import codecs
+import itertools
 import random
+import re
 import requests
+import threading
 
 from urllib.parse import quote as url_quote
 
 from pyquery import PyQuery as pq
 
+from .metrics import BYTES_DOWNLOADED, Metrics
+from .settings import ENV
+from .transport import HttpTransport
+
 USER_AGENTS = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:11.0) Gecko/20100101 Firefox/11.0',
                'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:22.0) Gecko/20100 101 Firefox/22.0',
                'Mozilla/5.0 (Windows NT 6.1; rv:11.0) Gecko/20100101 Firefox/11.0',
@@ -21,23 +29,6 @@ USER_AGENTS = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:11.0) Gecko/2010
                ('Mozilla/5.0 (Windows; Windows NT 6.1) AppleWebKit/536.5 (KHTML, like Gecko) Chrome/19.0.1084.46'
                 'Safari/536.5'), )
 
-ENV = {
-    'QED': {
-        'safe_url': 'https://safe.thomson.com/safe-ui/fcc/login.fcc',
-        'headers': {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9'
-        },
-        'payload': (
-            "action=LoginPassThrough&AcctMaintPurpose=&ProtectionLevel=SAFE5&"
-            "TARGET=HTTPS%3A%2F%2Fsafe.thomson.com%2Flogin%2Fsso%2FSSOService%3Fapp%3Derrorgul_WLNQED&"
-            "SMAUTHREASON=0&USER={user}&PASSWORD={password}&CAPTCHAANSWER="
-        ),
-        'error_gui_url': 'http://cobalttools.qed.int.westgroup.com/ErrorGUINext'
-    }
-}
-
 QUERY_STRING = (
     "/initialResults.do?search=y&param=&qS=&a=&b=&c=&d=&e=&f=&g=&h=&i=&j=&x=&y=&z=&v="
     "&environs={env}&view=summary&site=all&start_time={start_time}&end_time={end_time}&submitForm=Submit"
@@ -45,44 +36,195 @@ QUERY_STRING = (
 
 TIME_FORMAT = '%Y-%m-%d %H:%M'
 
+CHUNK_SIZE = 64 * 1024
+REAUTH_PEEK_SIZE = 16 * 1024
+
+REAUTH_FORM_PATTERN = re.compile(r'name\s*=\s*["\']?digest\b', re.IGNORECASE)
+
+class SessionPool(object):
+    """
+    Small pool of authenticated sessions, reused across report requests.
+    """
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._sessions:
+                return self._sessions.pop()
+
+        return None
+
+    def release(self, session):
+        with self._lock:
+            if len(self._sessions) < self.max_size:
+                self._sessions.append(session)
+                return
+
+        session.close()
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+
+        for session in sessions:
+            session.close()
+
 class ErrorReportRetriever(object):
-    def __init__(self, env, user, password):
+    def __init__(self, env, user, password, session_pool=None, metrics=None, transport=None):
         self.env = env
         self.user = user
         self.password = password
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.transport = transport if transport is not None else HttpTransport()
+        self.session_pool = session_pool if session_pool is not None else SessionPool()
+        self._owns_session_pool = session_pool is None
+        self.logins = 0
+        self.logins_avoided = 0
+        self._counter_lock = threading.Lock()
+
+    def close(self):
+        # a pool shared with other retrievers is closed by its owner
+        if self._owns_session_pool:
+            self.session_pool.close()
+
+    def discard_sessions(self):
+        """
+        Close the pooled sessions, e.g. once one of them got a page that was not a report.
+        """
+        self.session_pool.close()
+
+    def get_html(self, start_time, end_time, new_session=False):
+        return ''.join(self.iter_html(start_time, end_time, stream=False, new_session=new_session))
+
+    def iter_html(self, start_time, end_time, stream=True, chunk_size=CHUNK_SIZE, new_session=False):
+        """
+        Yield the report page as text chunks. With stream the body is read from the socket
+        chunk by chunk, so the page is never held in memory as a whole.
+        With new_session the page is requested after a new SAFE login rather than with a pooled session.
+        """
+        error_gui_url = self._get_error_gui_url(start_time, end_time)
 
-    def get_html(self, start_time, end_time):
+        session = None if new_session else self.session_pool.acquire()
+        try:
+            chunks = None
+            if session is not None:
+                chunks = self._open_report(session, error_gui_url, stream, chunk_size)
+                if chunks is None:
+                    # SAFE session has expired - start over with a new one
+                    session.close()
+                else:
+                    self._count('logins_avoided')
+
+            if chunks is None:
+                session = self._create_session()
+                chunks = self._open_report(session, error_gui_url, stream, chunk_size)
+                if chunks is None:
+                    raise RuntimeError('ErrorGUI authentication failed for {} environment'.format(self.env))
+
+            for chunk in chunks:
+                yield chunk
+        except BaseException:
+            # includes the consumer abandoning the generator half way through the body
+            if session is not None:
+                session.close()
+            raise
+
+        self.session_pool.release(session)
+
+    def _count(self, counter):
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _create_session(self):
         session = requests.session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=20)
+        adapter = self.transport.get_adapter(self.env)
         session.mount('https://', adapter)
         session.mount('http://', adapter)
 
         env_data = ENV[self.env]
-        headers = env_data['headers']
-        headers['User-Agent'] = random.choice(USER_AGENTS)
 
         # SAFE ID
         payload = env_data['payload'].format(user=self.user, password=url_quote(self.password))
-        session.post(env_data['safe_url'], headers=headers, data=payload, allow_redirects=True)
+        with self.metrics.time('login'):
+            session.post(env_data['safe_url'], headers=self._get_headers(), data=payload, allow_redirects=True)
+        self._count('logins')
 
-        # ErrorGUI request returns re-auth form expecting auto submit by JavaScript code
-        error_gui_url = self._get_error_gui_url(start_time, end_time)
-        auth_response = session.get(error_gui_url, headers={ 'User-Agent': random.choice(USER_AGENTS) }).text
+        return session
 
-        auth_html = pq(auth_response)
+    def _get_headers(self):
+        headers = dict(ENV[self.env]['headers'])
+        headers['User-Agent'] = random.choice(USER_AGENTS)
+
+        return headers
+
+    def _iter_text(self, response, chunk_size):
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+        for chunk in response.iter_content(chunk_size):
+            self.metrics.count(BYTES_DOWNLOADED, len(chunk))
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def _open_report(self, session, error_gui_url, stream, chunk_size):
+        """
+        Request the report, submitting the re-auth form only when ErrorGUI sends it.
+        Returns an iterator over the page text or None when the session is not authenticated anymore.
+        """
+        for reauth in (True, False):
+            # a streamed body is read later on, with the parsing - the stage only covers the headers then
+            with self.metrics.time('report'):
+                response = session.get(error_gui_url, headers={ 'User-Agent': random.choice(USER_AGENTS) }, stream=stream)
+            if stream:
+                chunks = self._iter_text(response, chunk_size)
+            else:
+                self.metrics.count(BYTES_DOWNLOADED, len(response.content))
+                chunks = iter([response.text])
+
+            # the re-auth form is a small page - peek at the beginning of the body for it
+            head = []
+            head_size = 0
+            for chunk in chunks:
+                head.append(chunk)
+                head_size += len(chunk)
+                if head_size >= REAUTH_PEEK_SIZE:
+                    break
+            head = ''.join(head)
+
+            reauth_form = self._get_reauth_form(head)
+            if reauth_form is None:
+                return itertools.chain([head], chunks)
+
+            response.close()
+            if not reauth:
+                return None
+
+            # ErrorGUI request returns re-auth form expecting auto submit by JavaScript code
+            (url, payload) = reauth_form
+            with self.metrics.time('reauth'):
+                session.post(url, headers=self._get_headers(), data=payload, allow_redirects=True)
+
+    def _get_reauth_form(self, html):
+        if not REAUTH_FORM_PATTERN.search(html):
+            return None
+
+        auth_html = pq(html)
         url = auth_html('form').attr('action')
         uid = auth_html('input[name="uid"]').val()
         time = auth_html('input[name="time"]').val()
         digest = auth_html('input[name="digest"]').val()
-        payload='uid={uid}&time={time}&digest={digest}'.format(uid=uid, time=url_quote(time), digest=digest)
-        session.post(url, headers=headers, data=payload, allow_redirects=True)
+        if not url or digest is None:
+            return None
 
-        # get actual errors report
-        report_html = session.get(error_gui_url, headers={ 'User-Agent': random.choice(USER_AGENTS) }).text
+        payload = 'uid={uid}&time={time}&digest={digest}'.format(uid=uid, time=url_quote(time), digest=digest)
 
-        session.close()
-        
-        return report_html
+        return (url, payload)
 
     def _get_error_gui_url(self, start_time, end_time):
         start = start_time.strftime(TIME_FORMAT)
@@ -91,3 +233,9 @@ class ErrorReportRetriever(object):
         url = ENV[self.env]['error_gui_url'] + QUERY_STRING.format(env=self.env, start_time=url_quote(start), end_time=url_quote(end))
 
         return url
+
+def get_auth_key(env, user, password):
+    """
+    Environments with the same key log in to the same SAFE url with the same credentials, so they can share sessions.
+    """
+    return (ENV[env]['safe_url'], user, password)
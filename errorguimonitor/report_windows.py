@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Report windows module.
+
+Plan the target and history windows of a comparison on a business-day calendar.
+"""
+
+import re
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .report_builder import WINDOW_RESOLUTION
+
+DATE_FORMAT = '%Y-%m-%d'
+
+# a length is a count of hours, business days or weeks of business days, e.g. 6h, 5d or 2w
+LENGTH_PATTERN = re.compile(r'^\s*(\d+)\s*([hdw]?)\s*$', re.IGNORECASE)
+BUSINESS_DAYS_PER_WEEK = 5
+
+def parse_length(value):
+    """
+    Parse a length into (count, unit) with unit 'h' or 'd' - weeks become business days and a bare number means days.
+    """
+    if isinstance(value, int):
+        return (value, 'd')
+
+    match = LENGTH_PATTERN.match(value)
+    if not match or not int(match.group(1)):
+        raise ValueError('invalid length: {}'.format(value))
+
+    (count, unit) = (int(match.group(1)), match.group(2).lower() or 'd')
+    if unit == 'w':
+        return (count * BUSINESS_DAYS_PER_WEEK, 'd')
+
+    return (count, unit)
+
+def load_holidays(paths):
+    """
+    Read holiday calendars, files with one year-month-day date per line and # comments.
+    """
+    holidays = set()
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    holidays.add(datetime.strptime(line, DATE_FORMAT).date())
+
+    return sorted(holidays)
+
+def get_calendar(holidays=None):
+    return np.busdaycalendar(holidays=[np.datetime64(day, 'D') for day in holidays or []])
+
+def get_business_days(date, count, calendar, skip=0):
+    """
+    count business days going back from date, rolled back to a business day, after skipping the first skip of them.
+    Days are returned newest first.
+    """
+    offsets = -np.arange(skip, skip + count)
+    days = np.busday_offset(np.datetime64(date.date(), 'D'), offsets, roll='backward', busdaycal=calendar)
+
+    return [datetime(day.year, day.month, day.day) for day in days.tolist()]
+
+def get_business_days_before(date, count, calendar):
+    """
+    count business days before date, newest first.
+    """
+    skip = 1 if np.is_busday(np.datetime64(date.date(), 'D'), busdaycal=calendar) else 0
+
+    return get_business_days(date, count, calendar, skip)
+
+def get_report_windows(date, target_length, history_length, holidays=None, now=None):
+    """
+    Return (target windows, history windows), newest first.
+
+    With a target in days every window is a business day: the target days end at date and the
+    history days come right before them. With a target in hours every window is an hour: the target
+    hours end with date - or with the last complete hour when date is today - and the history is either
+    the hours right before them, or the same hours of the business days before date.
+    """
+    (target_count, target_unit) = parse_length(target_length)
+    (history_count, history_unit) = parse_length(history_length)
+    calendar = get_calendar(holidays)
+
+    if target_unit == 'd':
+        if history_unit == 'h':
+            raise ValueError('history in hours needs a target in hours')
+
+        days = get_business_days(date, target_count + history_count, calendar)
+        windows = [(day, day + timedelta(days=1) - WINDOW_RESOLUTION) for day in days]
+
+        return (windows[:target_count], windows[target_count:])
+
+    now = now if now is not None else datetime.now()
+    day = datetime(date.year, date.month, date.day)
+    target_end = min(day + timedelta(days=1), now.replace(minute=0, second=0, microsecond=0))
+    hours = [target_end - timedelta(hours=i + 1) for i in range(target_count)]
+    target_windows = [(hour, hour + timedelta(hours=1) - WINDOW_RESOLUTION) for hour in hours]
+
+    if history_unit == 'h':
+        hours = [hours[-1] - timedelta(hours=i + 1) for i in range(history_count)]
+        history_windows = [(hour, hour + timedelta(hours=1) - WINDOW_RESOLUTION) for hour in hours]
+    else:
+        history_days = get_business_days_before(day, history_count, calendar)
+        history_windows = [
+            (history_day + (start_time - day), history_day + (end_time - day))
+            for history_day in history_days for (start_time, end_time) in target_windows
+        ]
+
+    return (target_windows, history_windows)
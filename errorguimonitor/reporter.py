@@ -3,254 +3,465 @@
 """
 Reports module for different kind of reports.
 """
-import argparse
+import hashlib
 import numpy as np
-import smtplib
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from .error_matrix import ErrorMatrix
+from .history_store import HistoryStore
+from .metrics import KEYS_COMPARED, Metrics
+from .normalizer import KeyNormalizer, get_fingerprint
+from .notifiers import SmtpNotifier, build_message
+from .report_builder import WINDOW_RESOLUTION, ErrorReportBuilder
+from .report_renderer import ReportRenderer
+from .report_retriever import SessionPool, get_auth_key
+from .report_windows import get_business_days_before, get_calendar, get_report_windows
+from .settings import (ALPHA, BUCKET_SIZE, HISTORY_LENGTH, MAX_MESSAGE_BYTES, MEDIAN, N_RESAMPLES, RECIPIENTS,
+                       SIGNIFICANCE_TEST, TARGET_LENGTH, TOP_N)
+from .significance import get_significance_test
+from .trend_store import CANONICAL_KEYS, RAW_KEYS, TREND_FILE_NAME, WEEKDAY, TrendStore, get_weekday
 
-from datetime import datetime, timedelta
-from email.message import EmailMessage
-
-from prettytable import PrettyTable
-
-from . import __version__
-from .report_builder import ErrorReportBuilder
-
-WORKING_DAYS_CURRENT_COUNT = 1
-WORKING_DAYS_PRIOR_COUNT = 5
 DATE_FORMAT = '%Y-%m-%d'
-RECIPIENTS = ['ihar.malkevich@thomsonreuters.com']
+HOUR_FORMAT = '%Y-%m-%d %H:%M'
+# more windows than this are shown as a range in the subject
+WINDOWS_LISTED = 5
+# bump when the comparison results change shape, so results cached earlier are not reused
+COMPARISON_VERSION = 2
+
+NOTIFICATION_LABELS = ['New errors observed:', 'No new errors observed.', 'Errors increased:', 'No errors increased observed.']
+ENV_DIFF_LABELS = ['Errors only in {env}:', 'No errors only in {env}.', 'Errors elevated in {env} v. {other_env}:',
+                   'No errors elevated in {env} v. {other_env}.']
 
 class ErrorCompareReporter(object):
     """
     Error compare reporter - compares periods and reports new errors or error rates increase.
+    env is one environment or a list of them, compared concurrently into one combined report.
+    With env_diff the two environments are compared with each other over the same days instead.
+    target_length and history_length are hours, business days or weeks, e.g. 6h, 5d or 2w.
+    Keys differing only by ids, GUIDs, timestamps or numbers are compared as one canonical key unless
+    normalize_keys is False.
+    With baseline_days the target days are compared with the baseline statistic of a trend of that many
+    business days instead, kept up to date from the days fetched since the last run.
+    The report lists the top_n entries of every table by impact and stays under max_message_bytes, with
+    the full results attached when anything was left out.
     """
-    def __init__(self, env, date, safeid_user, safeid_password, smtp_user, smtp_password):
-        self.env = env
+    def __init__(self, env, date, safeid_user, safeid_password, smtp_user, smtp_password, max_workers=1,
+                 stream=False, raw_html_dir=None, cache_max_age_days=None, cache_max_bytes=None,
+                 bucket_size=BUCKET_SIZE, n_resamples=N_RESAMPLES, alpha=ALPHA, seed=None,
+                 significance_test=SIGNIFICANCE_TEST, apps=None, notifier=None, recipients=RECIPIENTS, env_diff=False,
+                 target_length=TARGET_LENGTH, history_length=HISTORY_LENGTH, holidays=None, baseline_days=None,
+                 baseline=MEDIAN, normalize_keys=True, metrics=None, transport=None, use_cache=True, top_n=TOP_N,
+                 max_message_bytes=MAX_MESSAGE_BYTES):
+        self.envs = [env] if isinstance(env, str) else list(env)
         self.today = date
         self.safeid_user = safeid_user
         self.safeid_password = safeid_password
         self.smtp_user = smtp_user
         self.smtp_password = smtp_password
+        self.max_workers = max_workers
+        self.stream = stream
+        self.raw_html_dir = raw_html_dir
+        self.cache_max_age_days = cache_max_age_days
+        self.cache_max_bytes = cache_max_bytes
+        self.bucket_size = bucket_size
+        self.n_resamples = n_resamples
+        self.alpha = alpha
+        self.seed = seed
+        self.significance_test = significance_test
+        self.apps = apps
+        self.notifier = notifier
+        self.recipients = recipients
+        self.env_diff = env_diff
+        self.target_length = target_length
+        self.history_length = history_length
+        self.holidays = holidays
+        self.baseline_days = baseline_days
+        self.baseline = baseline
+        self.normalize_keys = normalize_keys
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.transport = transport
+        self.use_cache = use_cache
+        self.top_n = top_n
+        self.max_message_bytes = max_message_bytes
 
     def run(self):
-        target_dates, history_dates = self._get_report_dates(WORKING_DAYS_CURRENT_COUNT, WORKING_DAYS_PRIOR_COUNT)
-        
-        report_builder = ErrorReportBuilder(self.env, self.safeid_user, self.safeid_password)
-
-        target_report = self._get_report(report_builder, target_dates)
-        history_report = self._get_report(report_builder, history_dates)
-
-        (new_errors, errors_increased) = self._prepare_report(target_report, history_report)
-
-        (subject, body) = self._create_notification(target_dates, history_dates, new_errors, errors_increased)
-
-        self._send_notification(subject, body, self.smtp_user, self.smtp_password, RECIPIENTS)
-
-    def _check_error_rate_increase(self, target_errors, history_errors):
-        target_median_scores = map(np.median, self._get_bootstrap_samples(np.array(target_errors), 100))
-        history_median_scores = map(np.median, self._get_bootstrap_samples(np.array(history_errors), 100))
-
-        delta_median = [x[0] - x[1] for x in zip(target_median_scores, history_median_scores)]
-        conf_int_diff = self._stat_intervals(delta_median, 0.05)
-
-        return conf_int_diff
-
-    def _create_notification(self, target_dates, history_dates, new_errors, errors_increased):
-        dates_to = '|'.join([date[0].strftime(DATE_FORMAT) for date in target_dates])
-        dates_compare = '|'.join([date[0].strftime(DATE_FORMAT) for date in history_dates])
-
-        subject = 'Error report for Website for {} v. {}'.format(dates_to, dates_compare)
-
-        body = ''
-
-        tbl_attr = { 
-            'style': 'border: 1px solid black; border-collapse: collapse;',
-            'cellpadding': 5,
-            'border': 1
-        }
-        if len(new_errors):
-            body += 'New errors observed:<br/>'
-            tbl = PrettyTable()
-            tbl.field_names = ['Error key', 'Occurrences']
-            for key in new_errors:
-                tbl.add_row([key, ', '.join([str(val) for val in new_errors[key]])])
-
-            tbl.align["Error key"] = "l"
-            body += tbl.get_html_string(attributes=tbl_attr)
+        target_dates, history_dates = self._get_report_dates(self.target_length, self.history_length)
+        if self.baseline_days:
+            # the history is read from the trend stores, only the target days are fetched
+            history_dates = []
+
+        (report_builders, session_pools) = self._create_report_builders()
+        try:
+            # target and history days of all environments are fetched in one batch
+            reports = self._build_reports(report_builders, target_dates + history_dates)
+            with self.metrics.time('normalize'):
+                normalized = [
+                    self._normalize_reports(report_builder.get_store(), report_builder.env, target_dates + history_dates,
+                                            env_reports, target_dates[-1][0])
+                    for (report_builder, env_reports) in zip(report_builders, reports)
+                ]
+            reports = [env_reports for (env_reports, _) in normalized]
+
+            with self.metrics.time('prepare_report'):
+                comparisons = self._prepare_comparisons(report_builders, target_dates, reports, normalized)
+
+            if self.cache_max_age_days is not None or self.cache_max_bytes is not None:
+                report_builders[0].prune_cache(self.cache_max_age_days, self.cache_max_bytes)
+        finally:
+            # the first builder owns the store shared by all of them
+            for report_builder in reversed(report_builders):
+                report_builder.close()
+            if not self.use_cache:
+                report_builders[0].get_store().close()
+            for session_pool in session_pools:
+                session_pool.close()
+
+        with self.metrics.time('create_notification'):
+            (subject, body, attachments) = self._create_notification(target_dates, history_dates, comparisons)
+
+        # only hands the message over to a queued notifier, which times the delivery itself
+        with self.metrics.time('send_notification'):
+            self._send_notification(subject, body, attachments)
+
+    def _build_reports(self, report_builders, windows):
+        """
+        Reports of the windows for every builder, fetched concurrently across environments.
+        """
+        with self.metrics.time('get_report'):
+            if len(report_builders) == 1:
+                return [report_builders[0].build_reports(windows, self.max_workers, apps=self.apps)]
+
+            with ThreadPoolExecutor(max_workers=len(report_builders)) as executor:
+                return list(executor.map(
+                    lambda report_builder: report_builder.build_reports(windows, self.max_workers, apps=self.apps),
+                    report_builders))
+
+    def _check_error_rate_increases(self, target_errors, history_errors):
+        return self._get_significance_test().compare(target_errors, history_errors)
+
+    def _create_notification(self, target_dates, history_dates, comparisons):
+        """
+        (subject, body, attachments) of one message for the [(env, new errors, errors increased)] comparisons.
+        """
+        dates_to = self._format_windows(target_dates)
+        dates_compare = self._format_windows(history_dates)
+        if self.baseline_days:
+            dates_compare = '{} day {}'.format(self.baseline_days, self.baseline)
+
+        apps = ' ({})'.format(', '.join(self.apps)) if self.apps else ''
+        if self.env_diff:
+            subject = 'Error diff for {}{} for {}|{}'.format(' v. '.join(self.envs), apps, dates_to, dates_compare)
         else:
-            body += 'No new errors observed.<br/>'
-
-        body += '<br/><br/>'
+            subject = 'Error report for {}{} for {} v. {}'.format(', '.join(self.envs), apps, dates_to, dates_compare)
+
+        sections = []
+        for (env, new_errors, errors_increased) in comparisons:
+            labels = NOTIFICATION_LABELS
+            if self.env_diff:
+                other_env = [name for name in self.envs if name != env][0]
+                labels = [label.format(env=env, other_env=other_env) for label in ENV_DIFF_LABELS]
+            sections.append((env, labels, new_errors, errors_increased))
+
+        footer = 'Thanks'
+        if any(any(errors_increased.values()) for (_, _, errors_increased) in comparisons):
+            footer = '* {}<br/><br/>{}'.format(self._get_significance_test().description, footer)
+
+        (body, attachments) = ReportRenderer(self._get_significance_test(), self.top_n, self.max_message_bytes).render(
+            sections, footer)
+
+        return (subject, body, attachments)
+
+    def _create_report_builders(self):
+        """
+        Builders of all environments, sharing one history store, a limit of max_workers fetches
+        at once and SAFE sessions where they log in with the same credentials.
+        """
+        fetch_slots = threading.BoundedSemaphore(self.max_workers)
+        session_pools = {}
+        # without the cache every window goes through the transport and nothing is kept
+        report_builders = []
+        store = None if self.use_cache else HistoryStore(':memory:')
+        for env in self.envs:
+            auth_key = get_auth_key(env, self.safeid_user, self.safeid_password)
+            if len(self.envs) > 1 and auth_key not in session_pools:
+                session_pools[auth_key] = SessionPool()
+
+            report_builders.append(ErrorReportBuilder(
+                env, self.safeid_user, self.safeid_password, stream=self.stream, raw_html_dir=self.raw_html_dir,
+                store=report_builders[0].get_store() if report_builders else store, bucket_size=self.bucket_size,
+                session_pool=session_pools.get(auth_key), fetch_slots=fetch_slots, metrics=self.metrics,
+                transport=self.transport))
+
+        return (report_builders, list(session_pools.values()))
+
+    def _format_windows(self, windows):
+        """
+        Windows of a subject - days or hours, a range once there are more than WINDOWS_LISTED of them.
+        """
+        whole_days = all(start.hour == 0 and end - start >= timedelta(hours=23) for (start, end) in windows)
+        formatted = [start.strftime(DATE_FORMAT if whole_days else HOUR_FORMAT) for (start, _) in windows]
+
+        if len(formatted) > WINDOWS_LISTED:
+            return '{} - {} ({} {})'.format(formatted[-1], formatted[0], len(formatted), 'days' if whole_days else 'hours')
+
+        return '|'.join(formatted)
+
+    def _get_comparison(self, store, target_report, history_report, known_keys=frozenset()):
+        """
+        Compare the reports, reusing the cached result of a seeded comparison of the same data.
+        """
+        if self.seed is None:
+            return self._prepare_report(target_report, history_report, known_keys)
+
+        cache_key = self._get_comparison_cache_key(target_report, history_report, known_keys)
+        result = store.get_result(cache_key)
+        if result is not None:
+            return (result['new_errors'], result['errors_increased'])
+
+        (new_errors, errors_increased) = self._prepare_report(target_report, history_report, known_keys)
+        store.put_result(cache_key, { 'new_errors': new_errors, 'errors_increased': errors_increased })
 
-        if len(errors_increased):
-            body += 'Errors increased:<br/>'
-            tbl = PrettyTable()
-            tbl.field_names = ['Error key', 'Increase rate*']
-            for key in errors_increased:
-                tbl.add_row([key, ' - '.join([str(round(val, 0)) for val in errors_increased[key]])])
-
-            tbl.align["Error key"] = "l"
-            body += tbl.get_html_string(attributes=tbl_attr)
+        return (new_errors, errors_increased)
 
-            body += '<br/>* 95% confidence interval for the difference between medians'
+    def _get_comparison_cache_key(self, target_report, history_report, known_keys=frozenset()):
+        data = '{}:{}:{}'.format(target_report.digest(), history_report.digest(), sorted(known_keys)).encode('utf-8')
+        parameters = '{}:{}:{}:{}:{}'.format(
+            COMPARISON_VERSION, self.significance_test, self.seed, self.n_resamples, self.alpha)
+
+        return '{}:{}'.format(parameters, hashlib.sha256(data).hexdigest())
+
+    def _get_significance_test(self):
+        # a new generator for every batch - with a seed the same data always gives the same result
+        return get_significance_test(self.significance_test, self.n_resamples, self.alpha, np.random.default_rng(self.seed))
+
+    def _get_report_dates(self, target_length, history_length):
+        """
+        (target windows, history windows), newest first, on the business-day calendar of the holidays.
+        """
+        return get_report_windows(self.today, target_length, history_length, self.holidays)
+
+    def _get_trend_store(self, report_builder, target_dates):
+        """
+        Trend of the business days before the target, after adding the days missing since the last run.
+        """
+        oldest_day = np.datetime64(target_dates[-1][0], 'D')
+        trend_path = os.path.join(os.path.dirname(report_builder.get_store_path()),
+                                  TREND_FILE_NAME.format(env=report_builder.env, days=self.baseline_days,
+                                                         keys=CANONICAL_KEYS if self.normalize_keys else RAW_KEYS))
+        trend_store = TrendStore(trend_path if self.use_cache else None, self.baseline_days)
+        if trend_store.last_day is not None and trend_store.last_day >= oldest_day:
+            # a target the trend went past - its baseline is built aside from the cached reports
+            trend_store = TrendStore(None, self.baseline_days)
+
+        days = get_business_days_before(target_dates[-1][0], self.baseline_days, get_calendar(self.holidays))
+        missing_days = [
+            day for day in reversed(days) if trend_store.last_day is None or np.datetime64(day, 'D') > trend_store.last_day
+        ]
+        if missing_days:
+            windows = [(day, day + timedelta(days=1) - WINDOW_RESOLUTION) for day in missing_days]
+            # the trend keeps all apps, whatever the apps compared
+            with self.metrics.time('get_report'):
+                reports = report_builder.build_reports(windows, self.max_workers)
+            (reports, _) = self._normalize_reports(
+                report_builder.get_store(), report_builder.env, windows, reports, missing_days[0])
+            for (day, report) in zip(missing_days, reports):
+                trend_store.add_day(day, report)
+
+            if trend_store.path is not None:
+                trend_store.save()
+
+        return trend_store
+
+    def _join_env_keys(self, first_reports, second_reports):
+        """
+        The second environment reports with their canonical keys renamed after the canonical keys of the same
+        fingerprints in the first environment - every environment names a cluster after the first key seen there.
+        """
+        if not self.normalize_keys:
+            return second_reports
+
+        # most keys come back every day - each one is fingerprinted once
+        first_keys = dict((get_fingerprint(app, key), key) for (app, key) in set(
+            (app, key) for report in first_reports for app in report for key in report[app]))
+
+        joined_keys = {}
+        joined_reports = []
+        for report in second_reports:
+            joined = {}
+            for app in report:
+                app_errors = joined[app] = {}
+                for (key, occurrences) in report[app].items():
+                    joined_key = joined_keys.get((app, key))
+                    if joined_key is None:
+                        joined_key = joined_keys[(app, key)] = first_keys.get(get_fingerprint(app, key), key)
+                    app_errors[joined_key] = app_errors.get(joined_key, 0) + occurrences
+            joined_reports.append(joined)
+
+        return joined_reports
+
+    def _merge_reports(self, reports):
+        with self.metrics.time('merge'):
+            return ErrorMatrix.from_reports(reports)
+
+    def _normalize_reports(self, store, env, windows, reports, seen_before):
+        """
+        Reports of the windows of env keyed by canonical keys and the set of canonical keys first seen there
+        before seen_before.
+        """
+        if not self.normalize_keys:
+            return (reports, frozenset())
+
+        (reports, first_seen) = KeyNormalizer(store, env).normalize_reports(windows, reports)
+
+        return (reports, frozenset(key for (key, seen) in first_seen.items() if seen < seen_before))
+
+    def _prepare_baseline_report(self, target_report, trend_store, weekdays, known_keys=frozenset()):
+        """
+        Compare every app of the target report with the trend baseline, in O(keys) for the whole report.
+        Keys the trend does not have but in known_keys, seen before the target, have a baseline of zero.
+        """
+        new_errors = dict((app, {}) for app in target_report.apps)
+        errors_increased = dict((app, {}) for app in target_report.apps)
+
+        if self.baseline == WEEKDAY:
+            # the mean rate of the target weekdays, measured over as many days as the rarest of them had
+            rates = np.mean([trend_store.get_baseline(target_report, WEEKDAY, weekday) for weekday in weekdays], axis=0)
+            history_days = max(min(trend_store.weekday_days[weekday] for weekday in weekdays), 1)
         else:
-            body += 'No errors increased observed.<br/>'
-
-        body += '<br/><br/>Thanks'
-
-        return (subject, body)
-
-    def _get_bootstrap_samples(self, data, n_samples):
-        indices = np.random.randint(0, len(data), (n_samples, len(data)))
-        samples = data[indices]
-        return samples
-
-    def _get_report(self, report_builder, dates):
-        errors = dict()
-        for (start_date, end_date) in dates:
-            report = report_builder.build_report(start_date, end_date)
-            for module in report:
-                if not module in errors:
-                    errors[module] = {}
-
-                for error in report[module]:
-                    if error in errors[module]:
-                        errors[module][error].append(report[module][error])
-                    else:
-                        errors[module][error] = [report[module][error]]
-
-        return errors
-
-    def _get_report_dates(self, target_days_count, history_dates_count):
-        report_dates = list()
+            rates = trend_store.get_baseline(target_report, self.baseline)
+            history_days = self.baseline_days
 
-        days_collected = 0
-        days_look_back = 0
+        target_counts = target_report.counts.T
 
-        days_count = target_days_count + history_dates_count
-
-        while days_collected < days_count:
-            report_date = self.today + timedelta(days=days_look_back)
-            adjust_date = False
-
-            if report_date.weekday() == 6:
-                days_look_back -= 2
-                adjust_date = True
-            elif report_date.weekday() == 5:
-                days_look_back -= 1
-                adjust_date = True
-
-            if adjust_date == True:
-                report_date = self.today + timedelta(days=days_look_back)
-
-            start_date = datetime(report_date.year, report_date.month, report_date.day)
-            end_date = datetime(report_date.year, report_date.month, report_date.day) + timedelta(hours=23, minutes=59, seconds=59)
+        for column in np.flatnonzero(rates < 0):
+            (app, key) = target_report.get_key(column)
+            if (app, key) in known_keys:
+                rates[column] = 0
+            else:
+                new_errors[app][key] = target_counts[column].tolist()
 
-            report_dates.append((start_date, end_date))
-            
-            days_collected += 1
-            days_look_back -= 1
+        compared = np.flatnonzero(rates >= 0)
+        self.metrics.count(KEYS_COMPARED, len(compared))
+        if len(compared):
+            significance_test = self._get_significance_test()
+            conf_int_diffs = significance_test.compare_totals(
+                target_counts[compared].sum(axis=1), len(weekdays), rates[compared] * history_days, history_days)
 
-        target_dates = report_dates[:WORKING_DAYS_CURRENT_COUNT]
-        history_dates = report_dates[WORKING_DAYS_CURRENT_COUNT:]
+            increased = significance_test.increased(conf_int_diffs)
+            for (column, conf_int_diff, is_increased) in zip(compared, conf_int_diffs, increased):
+                if is_increased:
+                    (app, key) = target_report.get_key(column)
+                    errors_increased[app][key] = conf_int_diff.tolist()
 
-        return (target_dates, history_dates)
+        return (new_errors, errors_increased)
 
-    def _prepare_report(self, target_report, history_report):
-        errors_target = target_report['Website']
-        errors_history = history_report['Website']
+    def _prepare_comparisons(self, report_builders, target_dates, reports, normalized):
+        """
+        [(env, new errors, errors increased)] of the environments, compared the way the reporter was set up for.
+        """
+        if self.env_diff:
+            return self._prepare_env_diff(self._merge_reports(reports[0]),
+                                          self._merge_reports(self._join_env_keys(reports[0], reports[1])))
+
+        if self.baseline_days:
+            return [
+                (report_builder.env,) + self._prepare_baseline_report(
+                    self._merge_reports(env_reports), self._get_trend_store(report_builder, target_dates),
+                    [get_weekday(start_time) for (start_time, _) in target_dates], known_keys)
+                for (report_builder, (env_reports, known_keys)) in zip(report_builders, normalized)
+            ]
+
+        return [
+            (report_builder.env,) + self._get_comparison(
+                report_builder.get_store(), self._merge_reports(env_reports[:len(target_dates)]),
+                self._merge_reports(env_reports[len(target_dates):]), known_keys)
+            for (report_builder, (env_reports, known_keys)) in zip(report_builders, normalized)
+        ]
+
+    def _prepare_env_diff(self, first_report, second_report):
+        """
+        Compare two environments over the same days, returning [(env, {app: {key: counts}}, {app: {key: result}})]
+        with the keys only in each environment and the keys elevated in it over the other one.
+        """
+        reports = [first_report, second_report]
+        # columns of the keys of each report in the other one
+        other_columns = [second_report.get_columns(first_report), first_report.get_columns(second_report)]
+
+        comparisons = []
+        for (env, report, columns) in zip(self.envs, reports, other_columns):
+            only_errors = dict((app, {}) for app in report.apps)
+            for column in np.flatnonzero(columns < 0):
+                (app, key) = report.get_key(column)
+                only_errors[app][key] = report.counts[:, column].tolist()
+
+            comparisons.append((env, only_errors, dict((app, {}) for app in report.apps)))
+
+        # keys in both environments are compared both ways in one batch
+        shared = np.flatnonzero(other_columns[0] >= 0)
+        self.metrics.count(KEYS_COMPARED, 2 * len(shared))
+        if len(shared):
+            first_counts = first_report.counts.T[shared]
+            second_counts = second_report.counts.T[other_columns[0][shared]]
+            results = self._check_error_rate_increases(
+                np.concatenate([first_counts, second_counts]), np.concatenate([second_counts, first_counts]))
+
+            increased = self._get_significance_test().increased(results)
+            for (i, (_, _, errors_elevated)) in enumerate(comparisons):
+                part = slice(i * len(shared), (i + 1) * len(shared))
+                for (column, result, is_increased) in zip(shared, results[part], increased[part]):
+                    if is_increased:
+                        (app, key) = first_report.get_key(column)
+                        errors_elevated[app][key] = result.tolist()
+
+        return comparisons
+
+    def _prepare_report(self, target_report, history_report, known_keys=frozenset()):
+        """
+        Compare every app of the target report, returning ({app: {key: counts}}, {app: {key: result}}).
+        Keys missing from the history but in known_keys, seen before the target, are compared with zeros.
+        """
+        new_errors = dict((app, {}) for app in target_report.apps)
+        errors_increased = dict((app, {}) for app in target_report.apps)
+
+        history_columns = history_report.get_columns(target_report)
+        target_counts = target_report.counts.T
+
+        compared = history_columns >= 0
+        for column in np.flatnonzero(history_columns < 0):
+            (app, key) = target_report.get_key(column)
+            if (app, key) in known_keys:
+                compared[column] = True
+            else:
+                new_errors[app][key] = target_counts[column].tolist()
 
-        new_errors = {}
-        errors_increased = {}
+        compared = np.flatnonzero(compared)
+        self.metrics.count(KEYS_COMPARED, len(compared))
+        if len(compared):
+            found = history_columns[compared] >= 0
+            history_counts = np.zeros((len(compared), len(history_report.counts)), dtype=history_report.counts.dtype)
+            history_counts[found] = history_report.counts.T[history_columns[compared][found]]
 
-        for key in errors_target:
-            if not key in errors_history:
-                new_errors[key] = errors_target[key]
-            else:
-                target_errors_count = errors_target[key] 
-                history_errors_count = errors_history[key]
+            # keys of all apps go through the statistics in one batch, days without a key count as zero
+            conf_int_diffs = self._check_error_rate_increases(target_counts[compared], history_counts)
 
-                conf_int_diff = self._check_error_rate_increase(target_errors_count, history_errors_count)
-                if conf_int_diff[0] > 0:
-                    errors_increased[key] = conf_int_diff
+            increased = self._get_significance_test().increased(conf_int_diffs)
+            for (column, conf_int_diff, is_increased) in zip(compared, conf_int_diffs, increased):
+                if is_increased:
+                    (app, key) = target_report.get_key(column)
+                    errors_increased[app][key] = conf_int_diff.tolist()
 
         return (new_errors, errors_increased)
 
-    def _send_notification(self, subject, body, smtp_user, smtp_password, to, cc=None, bcc=None):
-        msg = EmailMessage()
-
-        msg['Subject'] = subject
-        msg.set_content(body)
-        msg['From'] = 'errorguimonitor@test.com'
-        msg['To'] = ', '.join(to)
-        msg.replace_header('Content-type', 'text/html')
-        if cc:
-            msg['Cc'] = ', '.join(cc)
-        if bcc:
-            msg['Bcc'] = ', '.join(bcc)
-
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.ehlo()
-        server.starttls()
-        server.login(smtp_user, smtp_password)
-        server.send_message(msg)
-        server.quit()
-
-    def _stat_intervals(self, stat, alpha):
-        boundaries = np.percentile(stat, [100 * alpha / 2., 100 * (1 - alpha / 2.)])
-        return boundaries
-
-def get_parser():
-    parser = argparse.ArgumentParser(description='compare errors for two periods in s specific environment via the command line')
-
-    parser.add_argument('-e', '--environment', help='the environment (QED only at the moment)', type=str)
-    parser.add_argument('-d', '--date', help='the target date (year-month-day)', type=str)
-    parser.add_argument('-u', '--user', help='SAFE ID user', type=str)
-    parser.add_argument('-p', '--password', help='SAFE ID password', type=str)
-    parser.add_argument('-smtp_user', '--smtp_user', help='Gmail account username', type=str)
-    parser.add_argument('-smtp_password', '--smtp_password', help='Gmail account password', type=str)
-
-    parser.add_argument('-v', '--version', help='displays the current version of errorguimonitor',
-                        action='store_true')
-
-    return parser
-
-def command_line_runner():
-    parser = get_parser()
-    args = vars(parser.parse_args())
-
-    if args['version']:
-        print(__version__)
-        return
-
-    if not args['environment'] \
-        or not args['date']:
-        parser.print_help()
-        return
-
-    env = args['environment']
-    try:
-        target_date = datetime.strptime(args['date'], DATE_FORMAT)
-    except ValueError:
-        print('incorrect date provided. Please use year-month-day format')
-        return
-
-    safe_id_user = args['user']
-    safe_id_password = args['password']
-    smtp_user = args['smtp_user']
-    smtp_password = args['smtp_password']
-
-    if not safe_id_user \
-        or not safe_id_password \
-        or not smtp_user \
-        or not smtp_password:
-        print('Please provide usernames and passwords to successfully run the utility.')
-        parser.print_help()
-        return
-    
-    reporter = ErrorCompareReporter(env, target_date, safe_id_user, safe_id_password, smtp_user, smtp_password)
-    reporter.run()
-
-if __name__ == '__main__':
-    command_line_runner()
+    def _send_notification(self, subject, body, attachments=None):
+        """
+        Send through the notifier provided, or through a connection of our own when there is none.
+        """
+        notifier = self.notifier if self.notifier is not None else SmtpNotifier(self.smtp_user, self.smtp_password)
+        notifier.send(build_message(subject, body, self.recipients, attachments=attachments))
 
+        if self.notifier is None:
+            notifier.close()
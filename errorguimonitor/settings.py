@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+Settings module.
+
+The environments and the defaults the command line shows, free of third party imports, so building
+the command line does not load what a command may never use.
+"""
+
+from datetime import timedelta
+
+ENV = {
+    'QED': {
+        'safe_url': 'https://safe.thomson.com/safe-ui/fcc/login.fcc',
+        'headers': {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.9'
+        },
+        'payload': (
+            "action=LoginPassThrough&AcctMaintPurpose=&ProtectionLevel=SAFE5&"
+            "TARGET=HTTPS%3A%2F%2Fsafe.thomson.com%2Flogin%2Fsso%2FSSOService%3Fapp%3Derrorgul_WLNQED&"
+            "SMAUTHREASON=0&USER={user}&PASSWORD={password}&CAPTCHAANSWER="
+        ),
+        'error_gui_url': 'http://cobalttools.qed.int.westgroup.com/ErrorGUINext'
+    }
+}
+
+RECIPIENTS = ['ihar.malkevich@thomsonreuters.com']
+NOTIFIERS = ['maildir:PATH', 'smtp', 'stdout', 'webhook:URL']
+
+# entries listed of every table of a report and the size a report message is kept under
+TOP_N = 20
+MAX_MESSAGE_BYTES = 2 * 1024 ** 2
+
+# bump when the parser output changes, so reports cached by an earlier parser are fetched again
+PARSER_VERSION = 1
+
+# reports may be fetched and cached in buckets of this size, so any window reuses them - off by default,
+# as every bucket is a request of its own, e.g. 24 of them for a day
+BUCKET_SIZE = None
+
+WORKING_DAYS_CURRENT_COUNT = 1
+WORKING_DAYS_PRIOR_COUNT = 5
+TARGET_LENGTH = '{}d'.format(WORKING_DAYS_CURRENT_COUNT)
+HISTORY_LENGTH = '{}d'.format(WORKING_DAYS_PRIOR_COUNT)
+
+# names of the tests in significance.SIGNIFICANCE_TESTS
+SIGNIFICANCE_TEST_NAMES = ['bootstrap', 'permutation', 'poisson']
+SIGNIFICANCE_TEST = 'poisson'
+N_RESAMPLES = 100
+ALPHA = 0.05
+
+MEDIAN = 'median'
+EWMA = 'ewma'
+WEEKDAY = 'weekday'
+STATISTICS = [MEDIAN, EWMA, WEEKDAY]
+
+STATE_FILE_NAME = 'watch_{env}.json'
+POLL_INTERVAL = timedelta(minutes=15)
+THRESHOLD = 2.
+MIN_OCCURRENCES = 10
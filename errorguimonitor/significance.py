@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""
+Significance module.
+
+Batched statistics deciding whether error counts of the target period increased over the history period.
+"""
+
+import itertools
+import math
+
+import numpy as np
+
+# upper bound for the number of bootstrap medians or permutations held in memory at once
+MAX_CHUNK_ELEMENTS = 2 ** 22
+
+class BootstrapMedianTest(object):
+    """
+    Confidence interval for the difference between target and history medians, bootstrapped for all keys at once.
+
+    The data of every key is sorted, so the median of a resample only depends on which order statistics
+    were drawn. Those positions are drawn once per (target days, history days) shape and shared by all keys
+    of that shape - each key still gets an ordinary bootstrap. Resamples drawing the same positions give the
+    same difference, so every key is evaluated once per distinct draw and percentiles are weighted by counts.
+    """
+    name = 'bootstrap'
+
+    def __init__(self, n_resamples=100, alpha=0.05, rng=None):
+        self.n_resamples = n_resamples
+        self.alpha = alpha
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    @property
+    def description(self):
+        return '{:g}% confidence interval for the difference between medians'.format(100 * (1 - self.alpha))
+
+    def compare(self, targets, histories):
+        return self.intervals(targets, histories)
+
+    def format_result(self, result):
+        return ' - '.join([str(round(val, 0)) for val in result])
+
+    def increased(self, results):
+        return np.asarray(results)[:, 0] > 0
+
+    def intervals(self, targets, histories):
+        """
+        Return a (keys, 2) array with the interval bounds, targets and histories being per key sequences of counts.
+        """
+        intervals = np.empty((len(targets), 2))
+        percentiles = [100 * self.alpha / 2., 100 * (1 - self.alpha / 2.)]
+
+        for (rows, target_values, history_values) in group_by_shape(targets, histories):
+            draws = np.concatenate(
+                [self._median_positions(target_values.shape[1]), self._median_positions(history_values.shape[1])],
+                axis=1)
+            (draws, weights) = np.unique(draws, axis=0, return_counts=True)
+
+            target_values = np.sort(target_values, axis=1)
+            history_values = np.sort(history_values, axis=1)
+
+            chunk_size = max(1, MAX_CHUNK_ELEMENTS // len(draws))
+            for start in range(0, len(rows), chunk_size):
+                chunk = slice(start, start + chunk_size)
+                delta_median = (
+                    self._medians(target_values[chunk], draws[:, 0], draws[:, 1]) -
+                    self._medians(history_values[chunk], draws[:, 2], draws[:, 3]))
+
+                intervals[rows[chunk]] = weighted_percentiles(delta_median, weights, percentiles)
+
+        return intervals
+
+    def _median_positions(self, n):
+        """
+        (n_resamples, 2) positions of the lower and upper median order statistics of resamples of n sorted values.
+        """
+        positions = np.sort(self.rng.integers(0, n, (self.n_resamples, n)), axis=1)
+
+        return positions[:, [(n - 1) // 2, n // 2]]
+
+    def _medians(self, values, lower, upper):
+        return (values[:, lower] + values[:, upper]) / 2.
+
+class PoissonRateTest(object):
+    """
+    Closed form test treating daily counts as Poisson: Wald confidence interval for the ratio between
+    the target and history daily rates, computed on the log scale for all keys at once.
+    """
+    name = 'poisson'
+
+    def __init__(self, alpha=0.05):
+        self.alpha = alpha
+
+    @property
+    def description(self):
+        return '{:g}% confidence interval for the ratio between daily rates'.format(100 * (1 - self.alpha))
+
+    def compare(self, targets, histories):
+        results = np.empty((len(targets), 2))
+
+        for (rows, target_values, history_values) in group_by_shape(targets, histories):
+            results[rows] = self.compare_totals(
+                target_values.sum(axis=1), target_values.shape[1], history_values.sum(axis=1), history_values.shape[1])
+
+        return results
+
+    def compare_totals(self, target_total, target_days, history_total, history_days):
+        """
+        Return a (keys, 2) array with the interval bounds from the totals of every key over the target and history days.
+        """
+        z = normal_ppf(1 - self.alpha / 2.)
+        target_total = np.asarray(target_total, dtype=float)
+        history_total = np.asarray(history_total, dtype=float)
+
+        # keeps the ratio finite for keys without any errors in one of the periods
+        zero_total = (target_total == 0) | (history_total == 0)
+        target_total = np.where(zero_total, target_total + 0.5, target_total)
+        history_total = np.where(zero_total, history_total + 0.5, history_total)
+
+        log_ratio = np.log(target_total / target_days) - np.log(history_total / history_days)
+        margin = z * np.sqrt(1. / target_total + 1. / history_total)
+
+        return np.exp(np.stack([log_ratio - margin, log_ratio + margin], axis=1))
+
+    def format_result(self, result):
+        return ' - '.join([str(round(val, 2)) for val in result])
+
+    def increased(self, results):
+        return np.asarray(results)[:, 0] > 1
+
+class PermutationTest(object):
+    """
+    One-sided permutation test for the difference between target and history daily means.
+    All relabellings of the days are enumerated when there are at most max_permutations of them,
+    otherwise max_permutations random relabellings are drawn.
+    """
+    name = 'permutation'
+
+    def __init__(self, alpha=0.05, max_permutations=10000, rng=None):
+        self.alpha = alpha
+        self.max_permutations = max_permutations
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    @property
+    def description(self):
+        return 'difference between daily means (one-sided permutation test p-value, significant below {:g})'.format(
+            self.alpha)
+
+    def compare(self, targets, histories):
+        """
+        Return a (keys, 2) array of the observed difference between means and its p-value.
+        """
+        results = np.empty((len(targets), 2))
+
+        for (rows, target_values, history_values) in group_by_shape(targets, histories):
+            target_days = target_values.shape[1]
+            days = target_days + history_values.shape[1]
+            (indicator, exact) = self._get_relabellings(target_days, days)
+
+            pooled = np.concatenate([target_values, history_values], axis=1)
+            observed = target_values.mean(axis=1) - history_values.mean(axis=1)
+
+            chunk_size = max(1, MAX_CHUNK_ELEMENTS // len(indicator))
+            for start in range(0, len(rows), chunk_size):
+                chunk = slice(start, start + chunk_size)
+                target_sums = pooled[chunk].dot(indicator.T)
+                other_sums = pooled[chunk].sum(axis=1)[:, None] - target_sums
+                statistics = target_sums / target_days - other_sums / (days - target_days)
+
+                extreme = (statistics >= observed[chunk, None] - 1e-9).sum(axis=1)
+                if exact:
+                    p_values = extreme / float(len(indicator))
+                else:
+                    p_values = (extreme + 1.) / (len(indicator) + 1.)
+
+                results[rows[chunk]] = np.stack([observed[chunk], p_values], axis=1)
+
+        return results
+
+    def format_result(self, result):
+        return '{} (p={})'.format(round(result[0], 1), round(result[1], 3))
+
+    def get_min_p_value(self, target_days, days):
+        """
+        The smallest p-value the test gives with target_days of days - above alpha nothing is ever significant.
+        """
+        combinations = number_of_combinations(days, target_days)
+        if combinations <= self.max_permutations:
+            return 1. / combinations
+
+        return 1. / (self.max_permutations + 1)
+
+    def increased(self, results):
+        results = np.asarray(results)
+        return (results[:, 0] > 0) & (results[:, 1] <= self.alpha)
+
+    def _get_relabellings(self, target_days, days):
+        """
+        (relabellings, days) indicator matrix of the days labelled as target, and whether it is exhaustive.
+        """
+        exact = number_of_combinations(days, target_days) <= self.max_permutations
+        if exact:
+            labelled = np.array(list(itertools.combinations(range(days), target_days)))
+        else:
+            labelled = np.argsort(self.rng.random((self.max_permutations, days)), axis=1)[:, :target_days]
+
+        indicator = np.zeros((len(labelled), days))
+        indicator[np.arange(len(labelled))[:, None], labelled] = 1
+
+        return (indicator, exact)
+
+SIGNIFICANCE_TESTS = {
+    BootstrapMedianTest.name: BootstrapMedianTest,
+    PermutationTest.name: PermutationTest,
+    PoissonRateTest.name: PoissonRateTest
+}
+
+def get_significance_test(name, n_resamples=100, alpha=0.05, rng=None):
+    if name == BootstrapMedianTest.name:
+        return BootstrapMedianTest(n_resamples, alpha, rng)
+    if name == PermutationTest.name:
+        return PermutationTest(alpha, rng=rng)
+    if name == PoissonRateTest.name:
+        return PoissonRateTest(alpha)
+
+    raise ValueError('unknown significance test: {}'.format(name))
+
+def normal_ppf(q):
+    """
+    Quantile of the standard normal distribution, by bisection on the error function.
+    """
+    (low, high) = (-40., 40.)
+    for _ in range(100):
+        middle = (low + high) / 2.
+        if 0.5 * (1 + math.erf(middle / math.sqrt(2))) < q:
+            low = middle
+        else:
+            high = middle
+
+    return (low + high) / 2.
+
+def number_of_combinations(n, k):
+    return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
+
+def weighted_percentiles(values, weights, percentiles):
+    """
+    Percentiles along axis 1 of values with each column repeated weights times - the same numbers
+    np.percentile gives for the expanded array, without expanding it.
+    """
+    order = np.argsort(values, axis=1, kind='stable')
+    values = np.take_along_axis(values, order, axis=1)
+    cumulative_weights = np.cumsum(weights[order], axis=1)
+    rows = np.arange(len(values))
+    size = weights.sum()
+
+    result = np.empty((len(values), len(percentiles)))
+    for (i, percentile) in enumerate(percentiles):
+        position = percentile / 100. * (size - 1)
+        lower_rank = int(np.floor(position))
+        upper_rank = min(lower_rank + 1, size - 1)
+        fraction = position - lower_rank
+
+        lower = values[rows, (cumulative_weights > lower_rank).argmax(axis=1)]
+        upper = values[rows, (cumulative_weights > upper_rank).argmax(axis=1)]
+        result[:, i] = lower + fraction * (upper - lower)
+
+    return result
+
+def group_by_shape(targets, histories):
+    """
+    Yield (rows, target values, history values) for the keys sharing the same number of target
+    and history counts, values being 2D float arrays.
+    """
+    if isinstance(targets, np.ndarray) and isinstance(histories, np.ndarray) and targets.ndim == histories.ndim == 2:
+        yield (np.arange(len(targets)), targets.astype(float), histories.astype(float))
+        return
+
+    shapes = {}
+    for (row, (target, history)) in enumerate(zip(targets, histories)):
+        shapes.setdefault((len(target), len(history)), []).append(row)
+
+    for shape in sorted(shapes):
+        rows = np.array(shapes[shape])
+        target_values = np.array([targets[row] for row in shapes[shape]], dtype=float).reshape(len(rows), shape[0])
+        history_values = np.array([histories[row] for row in shapes[shape]], dtype=float).reshape(len(rows), shape[1])
+
+        yield (rows, target_values, history_values)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Transport module.
+
+How the report retriever reaches SAFE and ErrorGUI: over HTTP, over HTTP recording every exchange,
+or replaying the recorded exchanges locally with no host involved.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .files import atomic_open
+
+MAX_RETRIES = 20
+
+# report pages are keyed by environment and window, any other exchange by its method and url
+REPORT_FILE_NAME = '{env}__{start}__{end}.gz'
+EXCHANGE_FILE_NAME = '{env}__{method}__{digest}.gz'
+
+# the body is stored as it was decoded, and sessions are not replayed
+DROPPED_HEADERS = frozenset(['set-cookie', 'content-encoding', 'content-length', 'transfer-encoding'])
+
+class HttpTransport(object):
+    """
+    The hosts themselves.
+    """
+    def get_adapter(self, env):
+        return HTTPAdapter(max_retries=MAX_RETRIES)
+
+class RecordingTransport(object):
+    """
+    The hosts themselves, with every response stored gzipped in the path directory. A report page
+    requested again, e.g. after the re-auth form, replaces the one stored before.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get_adapter(self, env):
+        return _RecordingAdapter(self, env)
+
+    def save(self, env, request, response, body):
+        headers = dict((name, value) for (name, value) in response.headers.items() if name.lower() not in DROPPED_HEADERS)
+        exchange = { 'method': request.method, 'url': request.url, 'status': response.status_code,
+                     'reason': response.reason, 'headers': headers }
+
+        path = os.path.join(self.path, get_exchange_file_name(env, request.method, request.url))
+        with atomic_open(path, 'wb', gzip.open) as f:
+            f.write(json.dumps(exchange).encode('utf-8') + b'\n')
+            f.write(body)
+
+class ReplayTransport(object):
+    """
+    The exchanges recorded in the path directory, each one served after latency seconds.
+    A request never recorded fails like a host that cannot be reached.
+    """
+    def __init__(self, path, latency=0.):
+        self.path = path
+        self.latency = latency
+
+    def get_adapter(self, env):
+        return _ReplayAdapter(self, env)
+
+    def load(self, env, request):
+        path = os.path.join(self.path, get_exchange_file_name(env, request.method, request.url))
+        if not os.path.isfile(path):
+            raise requests.exceptions.ConnectionError(
+                'no recording of {} {}'.format(request.method, request.url), request=request)
+
+        with gzip.open(path, 'rb') as f:
+            exchange = json.loads(f.readline().decode('utf-8'))
+            body = f.read()
+
+        time.sleep(self.latency)
+
+        response = requests.Response()
+        response.status_code = exchange['status']
+        response.reason = exchange['reason']
+        response.headers = CaseInsensitiveDict(exchange['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        # the body is there already - streamed or not, it is read in slices of it
+        response._content = body
+        response._content_consumed = True
+
+        return response
+
+class _RecordingAdapter(HTTPAdapter):
+    def __init__(self, transport, env):
+        super(_RecordingAdapter, self).__init__(max_retries=MAX_RETRIES)
+        self.transport = transport
+        self.env = env
+
+    def send(self, request, **kwargs):
+        response = super(_RecordingAdapter, self).send(request, **kwargs)
+        # a streamed body is read up front to be stored, the retriever then reads it in slices
+        self.transport.save(self.env, request, response, response.content)
+
+        return response
+
+class _ReplayAdapter(BaseAdapter):
+    def __init__(self, transport, env):
+        super(_ReplayAdapter, self).__init__()
+        self.transport = transport
+        self.env = env
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        return self.transport.load(self.env, request)
+
+def get_exchange_file_name(env, method, url):
+    query = parse_qs(urlsplit(url).query)
+    if method == 'GET' and 'start_time' in query and 'end_time' in query:
+        return REPORT_FILE_NAME.format(env=env, start=_get_file_part(query['start_time'][0]),
+                                       end=_get_file_part(query['end_time'][0]))
+
+    return EXCHANGE_FILE_NAME.format(env=env, method=method, digest=hashlib.sha1(url.encode('utf-8')).hexdigest()[:16])
+
+def _get_file_part(value):
+    return re.sub(r'\W', '_', value)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Trend store module.
+
+Keep the daily counts of every key over the last business days, with the rolling statistics
+a baseline is taken from updated as each day is added.
+"""
+
+import os
+
+import numpy as np
+
+from .error_matrix import COUNTS_DTYPE, ErrorMatrix
+from .files import atomic_open
+from .settings import EWMA, MEDIAN, WEEKDAY
+
+# trends of canonical and of raw keys are kept apart, their keys cannot be compared with each other
+TREND_FILE_NAME = 'trend_{env}_{days}d_{keys}.npz'
+CANONICAL_KEYS = 'canonical'
+RAW_KEYS = 'raw'
+
+# bump when the stored arrays change, so a trend of an earlier layout is rebuilt
+TREND_VERSION = 2
+
+DAYS_PER_WEEK = 7
+
+class TrendStore(object):
+    """
+    Ring buffer of the daily counts of the last days business days, kept in one .npz file.
+
+    Days are added oldest first. Each one updates the EWMA with a span of days and the per weekday sums
+    the seasonal means come from incrementally, while the medians are recomputed over the ring, in
+    O(days x keys) per day added. A baseline is read in O(keys) either way. Keys without any occurrences
+    left in the ring are dropped.
+    """
+    def __init__(self, path, days):
+        self.path = path
+        self.days = days
+        self.alpha = 2. / (days + 1)
+        self._load()
+
+    @property
+    def last_day(self):
+        """
+        The newest day added, None for an empty trend.
+        """
+        return self.ring_days[(self.day_count - 1) % self.days] if self.day_count else None
+
+    def add_day(self, day, report):
+        """
+        Add the {app: {key: occurrences}} report of a business day newer than the last day.
+        """
+        day = np.datetime64(day, 'D')
+        if self.day_count and day <= self.last_day:
+            raise ValueError('days are added oldest first: {} is not after {}'.format(day, self.last_day))
+
+        values = self._get_values(ErrorMatrix.from_reports([report]))
+        weekday = get_weekday(day)
+
+        # the oldest day leaves the ring and its counts leave the weekday sums
+        position = self.day_count % self.days
+        if self.day_count >= self.days:
+            evicted_weekday = get_weekday(self.ring_days[position])
+            self.weekday_sums[evicted_weekday] -= self.matrix.counts[position]
+            self.weekday_days[evicted_weekday] -= 1
+
+        self.matrix.counts[position] = values
+        self.ring_days[position] = day
+        self.weekday_sums[weekday] += values
+        self.weekday_days[weekday] += 1
+        self.ewma = values.astype(float) if not self.day_count else self.ewma + self.alpha * (values - self.ewma)
+        self.day_count += 1
+
+        # a median has no running update - it is taken over the ring again, one partition per key
+        filled = self.matrix.counts[:min(self.day_count, self.days)]
+        self.medians = np.median(filled, axis=0)
+        self._drop_idle_keys(filled.any(axis=0))
+
+    def get_baseline(self, matrix, statistic=MEDIAN, weekday=None):
+        """
+        Daily rates of the matrix keys by the statistic, -1 for keys the trend does not have.
+        The weekday statistic is the mean of the days of weekday, Monday being 0.
+        """
+        if statistic == MEDIAN:
+            rates = self.medians
+        elif statistic == EWMA:
+            rates = self.ewma
+        elif statistic == WEEKDAY:
+            rates = self.weekday_sums[weekday] / max(self.weekday_days[weekday], 1)
+        else:
+            raise ValueError('unknown statistic: {}'.format(statistic))
+
+        columns = self.matrix.get_columns(matrix)
+        known = columns >= 0
+        # only the known columns are looked up, a trend without any keys has no rates to index
+        baseline = np.full(len(columns), -1.)
+        baseline[known] = rates[columns[known]]
+
+        return baseline
+
+    def save(self):
+        with atomic_open(self.path, 'wb') as f:
+            np.savez(f, version=TREND_VERSION, days=self.days, day_count=self.day_count,
+                     apps=np.array(self.matrix.apps, dtype=str), app_offsets=self.matrix.app_offsets,
+                     names=np.array(self.matrix.names.tolist(), dtype=str), counts=self.matrix.counts,
+                     ring_days=self.ring_days, weekday_sums=self.weekday_sums, weekday_days=self.weekday_days,
+                     ewma=self.ewma, medians=self.medians)
+
+    def _drop_idle_keys(self, active):
+        if active.all():
+            return
+
+        self.matrix = self.matrix.take(active)
+        self.weekday_sums = self.weekday_sums[:, active]
+        self.ewma = self.ewma[active]
+        self.medians = self.medians[active]
+
+    def _get_values(self, day_matrix):
+        """
+        Counts of the day in the trend columns, adding the columns of keys seen for the first time.
+        """
+        columns = self.matrix.get_columns(day_matrix)
+        if (columns < 0).any():
+            # the key table is rebuilt from both tables and the arrays moved to the new columns
+            key_table = ErrorMatrix.from_reports([get_key_report(self.matrix), get_key_report(day_matrix)])
+            moved = key_table.get_columns(self.matrix)
+
+            counts = np.zeros((self.days, len(key_table.names)), dtype=COUNTS_DTYPE)
+            counts[:, moved] = self.matrix.counts
+            self.matrix = ErrorMatrix(key_table.apps, key_table.app_offsets, key_table.names, counts)
+            self.weekday_sums = self._move(self.weekday_sums, moved, len(key_table.names))
+            self.ewma = self._move(self.ewma, moved, len(key_table.names))
+            self.medians = self._move(self.medians, moved, len(key_table.names))
+            columns = self.matrix.get_columns(day_matrix)
+
+        values = np.zeros(len(self.matrix.names), dtype=COUNTS_DTYPE)
+        values[columns] = day_matrix.counts[0]
+
+        return values
+
+    def _load(self):
+        if self.path is not None and os.path.isfile(self.path):
+            with np.load(self.path) as data:
+                if int(data['version']) == TREND_VERSION and int(data['days']) == self.days:
+                    self.day_count = int(data['day_count'])
+                    self.matrix = ErrorMatrix(data['apps'].tolist(), data['app_offsets'],
+                                              data['names'].astype(object), data['counts'])
+                    self.ring_days = data['ring_days']
+                    self.weekday_sums = data['weekday_sums']
+                    self.weekday_days = data['weekday_days']
+                    self.ewma = data['ewma']
+                    self.medians = data['medians']
+                    return
+
+        self.day_count = 0
+        self.matrix = ErrorMatrix([], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=object),
+                                  np.zeros((self.days, 0), dtype=COUNTS_DTYPE))
+        self.ring_days = np.full(self.days, np.datetime64('NaT'), dtype='datetime64[D]')
+        self.weekday_sums = np.zeros((DAYS_PER_WEEK, 0), dtype=np.int64)
+        self.weekday_days = np.zeros(DAYS_PER_WEEK, dtype=np.int64)
+        self.ewma = np.zeros(0)
+        self.medians = np.zeros(0)
+
+    def _move(self, values, columns, size):
+        moved = np.zeros(values.shape[:-1] + (size,), dtype=values.dtype)
+        moved[..., columns] = values
+
+        return moved
+
+def get_key_report(matrix):
+    """
+    {app: {key: 0}} of the matrix keys.
+    """
+    report = {}
+    for (app, key) in matrix.keys:
+        report.setdefault(app, {})[key] = 0
+
+    return report
+
+def get_weekday(day):
+    # 1970-01-01, day 0, was a Thursday
+    return int((np.datetime64(day, 'D').astype(np.int64) + 3) % DAYS_PER_WEEK)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Watcher module.
+
+Poll ErrorGUI for the newest minutes only, keep running per key counts of the day and alert
+as soon as a key crosses the threshold.
+"""
+
+import json
+import os
+import time
+
+from datetime import datetime, timedelta
+
+from prettytable import PrettyTable
+
+from .error_matrix import ErrorMatrix
+from .files import atomic_open
+from .notifiers import build_message
+from .report_builder import WINDOW_RESOLUTION
+from .report_windows import get_business_days_before, get_calendar
+from .settings import MIN_OCCURRENCES, POLL_INTERVAL, THRESHOLD
+
+DATE_FORMAT = '%Y-%m-%d'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+HISTORY_DAYS_COUNT = 5
+
+class ErrorWatcher(object):
+    """
+    Long running monitor over one report builder, so its authenticated sessions are reused by every poll.
+
+    The state - counts of the day so far, the baseline and the keys already alerted - is kept in a
+    JSON file, so a restarted watcher goes on from the last minute it fetched.
+    """
+    def __init__(self, report_builder, notifier, state_path, recipients, apps=None, threshold=THRESHOLD,
+                 min_occurrences=MIN_OCCURRENCES, history_days_count=HISTORY_DAYS_COUNT, max_workers=1, holidays=None):
+        self.report_builder = report_builder
+        self.notifier = notifier
+        self.state_path = state_path
+        self.recipients = recipients
+        self.apps = apps
+        self.threshold = threshold
+        self.min_occurrences = min_occurrences
+        self.history_days_count = history_days_count
+        self.max_workers = max_workers
+        self.holidays = holidays
+        self.state = self._load_state()
+
+    def poll(self, now=None):
+        """
+        Fetch the minutes since the last poll and return the [(app, key, count, baseline)] alerted.
+        """
+        now = now if now is not None else datetime.now()
+        # ErrorGUI is queried with minutes precision - fetch complete minutes only
+        end_time = now.replace(second=0, microsecond=0) - WINDOW_RESOLUTION
+        today = datetime(end_time.year, end_time.month, end_time.day)
+
+        if self.state.get('date') != today.strftime(DATE_FORMAT):
+            self._start_day(today)
+
+        start_time = datetime.strptime(self.state['last_end'], TIME_FORMAT) + WINDOW_RESOLUTION
+        if start_time > end_time:
+            return []
+
+        # the minutes of a poll are never asked for again - they are not cached
+        report = self.report_builder.fetch_report(start_time, end_time, apps=self.apps)
+
+        counts = self.state['counts']
+        for app in report:
+            app_counts = counts.setdefault(app, {})
+            for (key, occurrences) in report[app].items():
+                app_counts[key] = app_counts.get(key, 0) + occurrences
+
+        alerts = self._get_alerts(report)
+        for (app, key, _, _) in alerts:
+            self.state['alerted'].setdefault(app, []).append(key)
+
+        self.state['last_end'] = end_time.strftime(TIME_FORMAT)
+        self._save_state()
+
+        if alerts:
+            (subject, body) = self._create_notification(end_time, alerts)
+            self.notifier.send(build_message(subject, body, self.recipients))
+
+        return alerts
+
+    def run(self, interval=POLL_INTERVAL, polls=None):
+        """
+        Poll every interval, polls times or until interrupted.
+        """
+        try:
+            while polls is None or polls > 0:
+                started = time.time()
+                try:
+                    self.poll()
+                except Exception as e:
+                    # a failed poll is retried with the next one, the state still ends at the last minute fetched
+                    print('poll failed: {}'.format(e))
+
+                if polls is not None:
+                    polls -= 1
+                    if not polls:
+                        break
+
+                time.sleep(max(0, interval.total_seconds() - (time.time() - started)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.report_builder.close()
+
+    def _create_notification(self, end_time, alerts):
+        subject = 'Error alert for {} at {}'.format(self.report_builder.env, end_time.strftime('%Y-%m-%d %H:%M'))
+
+        body = 'Errors over {:g} times the daily mean of the last {} business days on {}:<br/>'.format(
+            self.threshold, self.history_days_count, self.state['date'])
+
+        tbl = PrettyTable()
+        tbl.field_names = ['Application', 'Error key', 'Occurrences today', 'Daily mean']
+        for (app, key, count, baseline) in alerts:
+            tbl.add_row([app, key, count, round(baseline, 1)])
+
+        tbl.align["Error key"] = "l"
+        body += tbl.get_html_string(attributes={
+            'style': 'border: 1px solid black; border-collapse: collapse;',
+            'cellpadding': 5,
+            'border': 1
+        })
+
+        body += '<br/><br/>Thanks'
+
+        return (subject, body)
+
+    def _get_alerts(self, report):
+        """
+        Keys of the report whose count of the day crossed the threshold and were not alerted yet today.
+        """
+        alerts = []
+        for app in sorted(report):
+            alerted = set(self.state['alerted'].get(app, []))
+            baseline = self.state['baseline'].get(app, {})
+            for key in sorted(report[app]):
+                count = self.state['counts'][app][key]
+                if key in alerted or count < self.min_occurrences:
+                    continue
+
+                if count > self.threshold * baseline.get(key, 0):
+                    alerts.append((app, key, count, baseline.get(key, 0)))
+
+        return alerts
+
+    def _get_history_dates(self, today):
+        days = get_business_days_before(today, self.history_days_count, get_calendar(self.holidays))
+
+        return [(day, day + timedelta(days=1) - WINDOW_RESOLUTION) for day in days]
+
+    def _load_state(self):
+        if not os.path.isfile(self.state_path):
+            return {}
+
+        with open(self.state_path, 'r') as f:
+            return json.load(f)
+
+    def _save_state(self):
+        with atomic_open(self.state_path) as f:
+            json.dump(self.state, f)
+
+    def _start_day(self, today):
+        """
+        Reset the counts for a new day and compute its baseline, the mean daily counts of the history days.
+        """
+        history = ErrorMatrix.from_reports(
+            self.report_builder.build_reports(self._get_history_dates(today), self.max_workers, apps=self.apps))
+        means = history.counts.mean(axis=0)
+
+        baseline = {}
+        for (column, (app, key)) in enumerate(history.keys):
+            baseline.setdefault(app, {})[key] = float(means[column])
+
+        self.state = {
+            'date': today.strftime(DATE_FORMAT),
+            'last_end': (today - WINDOW_RESOLUTION).strftime(TIME_FORMAT),
+            'counts': {},
+            'baseline': baseline,
+            'alerted': {}
+        }
+        self._save_state()
@@ -59,11 +59,12 @@ setup(
     packages=find_packages(),
     entry_points={
         'console_scripts': [
-            'errorguimonitor = errorguimonitor.errorguimonitor:command_line_runner',
+            'errorguimonitor = errorguimonitor.cli:command_line_runner',
         ]
     },
     install_requires=[
-        'numpy',
+        'numpy>=1.17',
+        'lxml',
         'PTable',
         'pyquery',
         'requests'
@@ -2,17 +2,30 @@
 
 """ Tests for errorguimonitor. """
 
+import gzip
 import inspect
+import json
+import mailbox
 import os
+import pickle
 import re
+import shutil
+import smtplib
+import subprocess
 import sys
+import tempfile
+import time
 import unittest
 import unittest.mock as mock
 
 from datetime import datetime, timedelta
+
+import numpy as np
+import requests
+
 from pyquery import PyQuery as pq
 
-from errorguimonitor import reporter, report_builder, report_retriever
+from errorguimonitor import cli, error_matrix, files, history_store, metrics, normalizer, notifiers, reporter, report_builder, report_parser, report_renderer, report_retriever, report_windows, settings, significance, transport, trend_store, watcher
 
 class ErrorCompareReporterTestCase(unittest.TestCase):
     def setUp(self):
@@ -61,75 +74,193 @@ class ErrorCompareReporterTestCase(unittest.TestCase):
         self.assertEqual(history_dates[3], (datetime(2018, 4, 4), datetime(2018, 4, 4, 23, 59, 59)))
         self.assertEqual(history_dates[4], (datetime(2018, 4, 3), datetime(2018, 4, 3, 23, 59, 59)))
 
-    def test_get_report(self):
-        """ Test get report merged from multiple files into one """
+    def test_get_report_dates_holidays(self):
+        """ test a week of history skips the holidays """
         # arrange
-        vals = {
-            (datetime(2018, 4, 5), datetime(2018, 4, 5, 23, 59, 59)): { 'module_1': { 'a': 1, 'c': 1 }, 'module_2': { 'x': 1, 'y': 2 } }, 
-            (datetime(2018, 4, 4), datetime(2018, 4, 4, 23, 59, 59)): { 'module_1': { 'b': 2, 'c': 2 }, 'module_2': { 'x': 2 } }
-        }
+        today = datetime(2018, 4, 10) + timedelta(hours=8)
+        qed1week = reporter.ErrorCompareReporter('env', today, 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                                 holidays=[datetime(2018, 4, 6).date(), datetime(2018, 4, 2).date()])
 
-        def side_effect(*args):
-            return vals[args]
+        # act
+        target_dates, history_dates = qed1week._get_report_dates('1d', '1w')
 
-        mock_report_builder = report_builder.ErrorReportBuilder('env', 'user', 'password')
-        mock_report_builder.build_report = mock.MagicMock(side_effect=side_effect)
+        # assert
+        self.assertEqual(target_dates, [(datetime(2018, 4, 10), datetime(2018, 4, 10, 23, 59, 59))])
+        self.assertEqual([start for (start, _) in history_dates], [
+            datetime(2018, 4, 9), datetime(2018, 4, 5), datetime(2018, 4, 4), datetime(2018, 4, 3), datetime(2018, 3, 30)])
 
-        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password')
-        dates = [
-            (datetime(2018, 4, 5), datetime(2018, 4, 5, 23, 59, 59)),
-            (datetime(2018, 4, 4), datetime(2018, 4, 4, 23, 59, 59))
+    def test_merge_reports(self):
+        """ Test reports of multiple days merged into one """
+        # arrange
+        reports = [
+            { 'module_1': { 'a': 1, 'c': 1 }, 'module_2': { 'x': 1, 'y': 2 } },
+            { 'module_1': { 'b': 2, 'c': 2 }, 'module_2': { 'x': 2 } }
         ]
-        
+        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password')
+
         # act
-        report = qed1week._get_report(mock_report_builder, dates)
+        report = qed1week._merge_reports(reports)
 
         # assert
-        self.assertEqual(report, { 'module_1': { 'a': [1], 'b': [2], 'c': [1, 2] }, 'module_2': { 'x': [1, 2], 'y': [2] } })
+        self.assertEqual(report.keys, [('module_1', 'a'), ('module_1', 'b'), ('module_1', 'c'), ('module_2', 'x'), ('module_2', 'y')])
+        np.testing.assert_array_equal(report.counts, [[1, 0, 1, 1, 2], [0, 2, 2, 2, 0]])
+        self.assertEqual(report.to_dict(), { 'module_1': { 'a': [1, 0], 'b': [0, 2], 'c': [1, 2] }, 'module_2': { 'x': [1, 2], 'y': [2, 0] } })
 
-    def test_check_error_rate_increase(self):
+    def test_check_error_rate_increases(self):
         # arrange
-        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password')
-        target_errors = [10]
-        history_errors = [5]
+        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                                 significance_test='bootstrap')
+        target_errors = np.array([[10]])
+        history_errors = np.array([[5]])
 
         # act
-        conf_int_diff = qed1week._check_error_rate_increase(target_errors, history_errors)
+        conf_int_diffs = qed1week._check_error_rate_increases(target_errors, history_errors)
 
         # assert
-        self.assertTrue(conf_int_diff[0] > 0)
+        self.assertTrue(conf_int_diffs[0][0] > 0)
 
     def test_prepare_report(self):
         # arrange
-        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password')
-        target_report = { 
-            'Document': { 'doc_key': [1] },
-            'Website': { 'error_key_1': [1], 'error_key_2': [2], 'error_key_3': [3] }
-        }
-
-        history_report = { 
-            'Document': { 'doc_key': [1] },
-            'Website': { 'error_key_2': [2, 3, 4, 5], 'error_key_3': [3, 4] }
-        }
-
-        def side_effect(target_errors_count, history_errors_count):
-            if target_errors_count == [2] \
-                and history_errors_count == [2, 3, 4, 5]:
-                return [1.0, 2.0]
-            elif target_errors_count == [3] \
-                and history_errors_count == [3, 4]:
-                return [0.0, 0.5]
-            
+        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                                 significance_test='bootstrap')
+        target_report = error_matrix.ErrorMatrix.from_reports([
+            {
+                'Document': { 'doc_key': 4 },
+                'Search': { 'search_key': 1 },
+                'Website': { 'error_key_1': 1, 'error_key_2': 2, 'error_key_3': 3 }
+            }
+        ])
+
+        history_report = error_matrix.ErrorMatrix.from_reports([
+            { 'Document': { 'doc_key': 1 }, 'Website': { 'error_key_2': 2, 'error_key_3': 3 } },
+            { 'Website': { 'error_key_2': 3, 'error_key_3': 4 } },
+            { 'Website': { 'error_key_2': 4 } },
+            { 'Website': { 'error_key_2': 5 } }
+        ])
+
+        def side_effect(target_errors_counts, history_errors_counts):
+            # days without a key are zeros
+            if target_errors_counts.tolist() == [[4], [2], [3]] \
+                and history_errors_counts.tolist() == [[1, 0, 0, 0], [2, 3, 4, 5], [3, 4, 0, 0]]:
+                return np.array([[2.0, 4.0], [1.0, 2.0], [0.0, 0.5]])
+
             raise ValueError('unexpected arguments')
 
-        qed1week._check_error_rate_increase = mock.MagicMock(side_effect=side_effect)
+        qed1week._check_error_rate_increases = mock.MagicMock(side_effect=side_effect)
 
         # act
         (new_errors, errors_increased) = qed1week._prepare_report(target_report, history_report)
 
         # assert
-        self.assertEqual(new_errors, { 'error_key_1': [1] })
-        self.assertEqual(errors_increased, { 'error_key_2': [1.0, 2.0] })
+        self.assertEqual(new_errors, { 'Document': {}, 'Search': { 'search_key': [1] }, 'Website': { 'error_key_1': [1] } })
+        self.assertEqual(
+            errors_increased, { 'Document': { 'doc_key': [2.0, 4.0] }, 'Search': {}, 'Website': { 'error_key_2': [1.0, 2.0] } })
+        qed1week._check_error_rate_increases.assert_called_once()
+
+    def test_prepare_report_known_keys(self):
+        """ test keys seen before the history are compared with zeros instead of being new """
+        # arrange
+        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password')
+        target_report = error_matrix.ErrorMatrix.from_reports([{ 'Website': { 'known': 40, 'new': 1, 'same': 5 } }])
+        history_report = error_matrix.ErrorMatrix.from_reports([{ 'Website': { 'same': 5 } }, { 'Website': { 'same': 5 } }])
+
+        # act
+        (new_errors, errors_increased) = qed1week._prepare_report(
+            target_report, history_report, frozenset([('Website', 'known'), ('Website', 'same')]))
+
+        # assert
+        self.assertEqual(new_errors, { 'Website': { 'new': [1] } })
+        self.assertEqual(list(errors_increased['Website']), ['known'])
+
+    def test_prepare_env_diff(self):
+        """ test keys only in one environment and keys elevated in one over the other, compared in one batch """
+        # arrange
+        qed1week = reporter.ErrorCompareReporter(['QED', 'PROD'], datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                                 env_diff=True)
+        first_report = error_matrix.ErrorMatrix.from_reports([
+            { 'Website': { 'only_qed': 1, 'shared_up': 50, 'shared_same': 10 } },
+            { 'Website': { 'shared_up': 60, 'shared_same': 10 } },
+            { 'Website': { 'shared_up': 55, 'shared_same': 10 } }
+        ])
+        second_report = error_matrix.ErrorMatrix.from_reports([
+            { 'Search': { 'only_prod': 2 }, 'Website': { 'shared_up': 5, 'shared_same': 10 } },
+            { 'Website': { 'shared_up': 6, 'shared_same': 10 } },
+            { 'Website': { 'shared_up': 4, 'shared_same': 10 } }
+        ])
+
+        check_error_rate_increases = qed1week._check_error_rate_increases
+        qed1week._check_error_rate_increases = mock.MagicMock(side_effect=check_error_rate_increases)
+
+        # act
+        comparisons = qed1week._prepare_env_diff(first_report, second_report)
+
+        # assert
+        self.assertEqual([env for (env, _, _) in comparisons], ['QED', 'PROD'])
+        self.assertEqual(comparisons[0][1], { 'Website': { 'only_qed': [1, 0, 0] } })
+        self.assertEqual(list(comparisons[0][2]['Website']), ['shared_up'])
+        self.assertEqual(comparisons[1][1], { 'Search': { 'only_prod': [2, 0, 0] }, 'Website': {} })
+        self.assertEqual(comparisons[1][2], { 'Search': {}, 'Website': {} })
+        qed1week._check_error_rate_increases.assert_called_once()
+
+    def test_prepare_env_diff_canonical_keys(self):
+        """ test the environments are joined on fingerprints, whichever key of a cluster each one saw first """
+        # arrange
+        qed1week = reporter.ErrorCompareReporter(['QED', 'PROD'], datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                                 env_diff=True)
+        qed_reports = [{ 'Website': { 'Timeout for order 12345': 5 } } for _ in range(3)]
+        prod_reports = [{ 'Website': { 'Timeout for order 99999': 50 + i } } for i in range(3)]
+
+        # act
+        comparisons = qed1week._prepare_comparisons(None, None, [qed_reports, prod_reports], None)
+
+        # assert
+        self.assertEqual(comparisons[0][1], { 'Website': {} })
+        self.assertEqual(comparisons[1][1], { 'Website': {} })
+        self.assertEqual(list(comparisons[1][2]['Website']), ['Timeout for order 12345'])
+
+    def test_check_error_rate_increases_seeded(self):
+        """ test the same seed gives the same intervals """
+        # arrange
+        target_errors = [[9], [12], [30]]
+        history_errors = [[5, 9, 2, 8, 7], [10, 11, 12, 10, 1], [20, 40, 25, 22, 27]]
+
+        reporters = [
+            reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                          seed=42, significance_test='bootstrap')
+            for _ in range(2)
+        ]
+
+        # act
+        intervals = [qed1week._check_error_rate_increases(target_errors, history_errors) for qed1week in reporters]
+        intervals.append(reporters[0]._check_error_rate_increases(target_errors, history_errors))
+
+        # assert
+        np.testing.assert_array_equal(intervals[0], intervals[1])
+        np.testing.assert_array_equal(intervals[0], intervals[2])
+
+    def test_get_comparison_cached(self):
+        """ test a seeded comparison of the same data is read from the results cache """
+        # arrange
+        store = history_store.HistoryStore(':memory:')
+        target_report = error_matrix.ErrorMatrix.from_reports([{ 'Website': { 'error_key_1': 1, 'error_key_2': 20 } }])
+        history_report = error_matrix.ErrorMatrix.from_reports(
+            [{ 'Website': { 'error_key_2': count } } for count in [2, 3, 4, 5, 3]])
+
+        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                                 seed=1, significance_test='bootstrap')
+        prepare_report = qed1week._prepare_report
+        qed1week._prepare_report = mock.MagicMock(side_effect=prepare_report)
+
+        # act
+        first = qed1week._get_comparison(store, target_report, history_report)
+        second = qed1week._get_comparison(store, target_report, history_report)
+        qed1week.seed = 2
+        qed1week._get_comparison(store, target_report, history_report)
+
+        # assert
+        self.assertEqual(first, ({ 'Website': { 'error_key_1': [1] } }, { 'Website': { 'error_key_2': [15.0, 18.0] } }))
+        self.assertEqual(second, first)
+        self.assertEqual(qed1week._prepare_report.call_count, 2)
 
     def test_create_notification(self):
         # arrange
@@ -144,36 +275,104 @@ class ErrorCompareReporterTestCase(unittest.TestCase):
             (datetime(2018, 4, 5), datetime(2018, 4, 5, 23, 59, 59))
         ]
 
-        new_errors = { 'error_key_1': [1] }
-        errors_increased = { 'error_key_2': [1.0, 2.0], 'error_key_3': [.5, .8] }
+        new_errors = { 'Search': {}, 'Website': { 'error_key_1': [1] } }
+        errors_increased = { 'Search': { 'search_key': [1.5, 3.0] }, 'Website': { 'error_key_2': [1.0, 2.0], 'error_key_3': [.5, .8] } }
 
         # act
-        (subject, body) = qed1week._create_notification(target_dates, history_dates, new_errors, errors_increased)
+        (subject, body, attachments) = qed1week._create_notification(
+            target_dates, history_dates, [('env', new_errors, errors_increased)])
 
         # assert
-        self.assertTrue(len(subject) > 0)
-        self.assertTrue(len(body) > 0)
+        self.assertEqual(subject, 'Error report for env for 2018-04-09 v. 2018-04-06|2018-04-05')
+        self.assertTrue(body.index('<h3>Search</h3>') < body.index('search_key') < body.index('<h3>Website</h3>'))
+        self.assertTrue(body.index('<h3>Website</h3>') < body.index('error_key_1'))
+        # ranked by the lower bound of the interval
+        self.assertTrue(body.index('error_key_2') < body.index('error_key_3'))
+        self.assertEqual(attachments, [])
+
+    @mock.patch.dict(report_retriever.ENV, { 'PROD': report_retriever.ENV['QED'] })
+    def test_run_environments(self):
+        """ test environments are fetched into one combined report, sharing the store and SAFE sessions """
+        # arrange
+        history_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, history_dir)
+
+        def load_report(builder, start_time, end_time, apps=None):
+            return { 'Website': { '{}_key'.format(builder.env): 100 if start_time.day == 10 else 1 } }
+
+        notifier = mock.MagicMock()
+        qed1week = reporter.ErrorCompareReporter(['QED', 'PROD'], datetime(2018, 4, 10), 'safeid_user', 'safeid_password',
+                                                 'smtp_user', 'smtp_password', max_workers=2, notifier=notifier)
 
-    @mock.patch('errorguimonitor.reporter.smtplib')
-    def test_send_notification(self, mock_smtplib):
+        # act
+        with mock.patch.object(report_builder.ErrorReportBuilder, '_load_report', autospec=True, side_effect=load_report) as mock_load_report, \
+            mock.patch.object(report_builder.ErrorReportBuilder, '_get_history_data_path', return_value=history_dir), \
+            mock.patch.object(report_builder.ErrorReportBuilder, 'get_store_path', return_value=':memory:'):
+            (report_builders, session_pools) = qed1week._create_report_builders()
+            qed1week.run()
+
+        # assert
+        self.assertEqual(len(session_pools), 1)
+        self.assertIs(report_builders[0].report_retriever.session_pool, report_builders[1].report_retriever.session_pool)
+        self.assertIs(report_builders[0].fetch_slots, report_builders[1].fetch_slots)
+
+        self.assertEqual(mock_load_report.call_count, 2 * 6)
+        self.assertEqual(qed1week.metrics.stages['get_report']['calls'], 1)
+        self.assertEqual(qed1week.metrics.stages['load_report']['calls'], 2 * 6)
+        notifier.send.assert_called_once()
+        message = notifier.send.call_args[0][0]
+        self.assertTrue(message['Subject'].startswith('Error report for QED, PROD for 2018-04-10 v.'))
+        body = message.get_content()
+        self.assertTrue(body.index('<h2>QED</h2>') < body.index('QED_key') < body.index('<h2>PROD</h2>') < body.index('PROD_key'))
+
+    def test_baseline_report(self):
+        """ test the trend only fetches the days added since the last run and target keys are compared with its medians """
         # arrange
-        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password')
+        trend_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trend_dir)
+
+        builder = mock.MagicMock()
+        builder.env = 'env'
+        builder.get_store_path.return_value = os.path.join(trend_dir, 'history.sqlite3')
+        builder.get_store.return_value = history_store.HistoryStore(':memory:')
+        self.addCleanup(builder.get_store.return_value.close)
+        builder.build_reports.side_effect = lambda windows, max_workers: [
+            { 'Website': { 'a': 10 + start_time.day % 2, 'b': 1 } } for (start_time, _) in windows]
+        qed1week = reporter.ErrorCompareReporter('env', datetime(2018, 4, 10), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                                 baseline_days=3)
 
-        mock_server = mock.MagicMock()
-        dummySMTP = mock.MagicMock(return_value=mock_server)
+        # act
+        qed1week._get_trend_store(builder, [(datetime(2018, 4, 10), datetime(2018, 4, 10, 23, 59, 59))])
+        trend = qed1week._get_trend_store(builder, [(datetime(2018, 4, 11), datetime(2018, 4, 11, 23, 59, 59))])
+        (new_errors, errors_increased) = qed1week._prepare_baseline_report(
+            error_matrix.ErrorMatrix.from_reports([{ 'Website': { 'a': 40, 'b': 1, 'c': 5 } }]), trend, [2])
 
-        mock_smtplib.SMTP = dummySMTP
+        # assert
+        self.assertEqual([[start_time for (start_time, _) in call[0][0]] for call in builder.build_reports.call_args_list], [
+            [datetime(2018, 4, 5), datetime(2018, 4, 6), datetime(2018, 4, 9)],
+            [datetime(2018, 4, 10)]
+        ])
+        self.assertEqual(trend.last_day, np.datetime64('2018-04-10'))
+        self.assertEqual(os.listdir(trend_dir), ['trend_env_3d_canonical.npz'])
+        self.assertEqual(new_errors, { 'Website': { 'c': [5] } })
+        self.assertEqual(list(errors_increased['Website']), ['a'])
+
+    def test_send_notification(self):
+        """ test reports go to the notifier provided with the recipients configured """
+        # arrange
+        notifier = mock.MagicMock()
+        qed1week = reporter.ErrorCompareReporter('env', datetime.today(), 'safeid_user', 'safeid_password', 'smtp_user', 'smtp_password',
+                                                 notifier=notifier, recipients=['a@test.com', 'b@test.com'])
 
         # act
-        qed1week._send_notification('Test email', 'Test email body', 'smtp_user', 'smtp_password', ['ihar.malkevich@thomsonreuters.com'])
+        qed1week._send_notification('Test email', 'Test email body')
 
         # assert
-        mock_smtplib.SMTP.assert_called_with('smtp.gmail.com', 587)
-        mock_server.ehlo.assert_called_once()
-        mock_server.starttls.assert_called_once()
-        mock_server.login.assert_called_with('smtp_user', 'smtp_password')
-        mock_server.send_message.assert_called_once()
-        mock_server.quit.assert_called_once()
+        message = notifier.send.call_args[0][0]
+        self.assertEqual(message['Subject'], 'Test email')
+        self.assertEqual(message['To'], 'a@test.com, b@test.com')
+        self.assertEqual(message.get_content_type(), 'text/html')
+        self.assertFalse(notifier.close.called)
 
 class ErrorReportBuilderTestCase(unittest.TestCase):
     def setUp(self):
@@ -186,8 +385,8 @@ class ErrorReportBuilderTestCase(unittest.TestCase):
         # arrange
         builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password')
 
-        builder.report_retriever.get_html = mock.MagicMock(return_value='<html></html>')
-        builder._process_html = mock.MagicMock(return_value={ 'module': { 'key': 1 } })
+        builder.report_retriever.get_html = mock.MagicMock(
+            return_value='<div class="borderedBoxWhite"><table class="tablesorter"><tr><th>h</th></tr></table></div>')
 
         start_time = datetime(2018, 4, 8)
         end_time = datetime(2018, 4, 8, 23, 59, 59)
@@ -196,10 +395,85 @@ class ErrorReportBuilderTestCase(unittest.TestCase):
         report = builder._load_report(start_time, end_time)
 
         # assert
-        self.assertEqual(report, { 'module': { 'key': 1 } })
+        self.assertEqual(report, {})
+        builder.report_retriever.get_html.assert_called_once_with(start_time, end_time, new_session=False)
 
-        
-        builder.report_retriever.get_html.assert_called_with(start_time, end_time)
+    def test_load_report_login_page(self):
+        """ test a page without the error table is fetched again after a new login """
+        # arrange
+        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password')
+
+        html_path = os.path.join(
+            os.path.dirname(inspect.getfile(self.__class__)),
+            'test_fixture',
+            'sample_errorgui_page.html')
+
+        with open(html_path, 'r') as f:
+            content = f.read()
+
+        builder.report_retriever.get_html = mock.MagicMock(side_effect=['<html><body>SAFE login</body></html>', content])
+        builder.report_retriever.discard_sessions = mock.MagicMock()
+
+        start_time = datetime(2018, 4, 8)
+        end_time = datetime(2018, 4, 8, 23, 59, 59)
+
+        # act
+        report = builder._load_report(start_time, end_time)
+
+        # assert
+        self.assertEqual(report['Website'], { 'website_error_key_1': 3, 'website_error_key_2': 5 })
+        builder.report_retriever.discard_sessions.assert_called_once_with()
+        builder.report_retriever.get_html.assert_called_with(start_time, end_time, new_session=True)
+
+    def test_build_report_login_page_not_cached(self):
+        """ test a login page served after a new login too fails the fetch and is never cached """
+        # arrange
+        store = history_store.HistoryStore(':memory:')
+        self.addCleanup(store.close)
+        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password', store=store, bucket_size=None)
+        builder.report_retriever.get_html = mock.MagicMock(return_value='<html><body>SAFE login</body></html>')
+
+        window = (datetime(2018, 4, 8), datetime(2018, 4, 8, 23, 59, 59))
+
+        # act
+        with self.assertRaises(RuntimeError):
+            builder.build_report(*window)
+
+        # assert
+        self.assertEqual(builder.report_retriever.get_html.call_count, 2)
+        self.assertEqual(store.get_reports('some_env', [window], settings.PARSER_VERSION), {})
+
+    def test_load_report_stream(self):
+        """ test streamed report chunks are parsed and kept as a gzipped artifact """
+        # arrange
+        raw_html_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, raw_html_dir)
+
+        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password', stream=True, raw_html_dir=raw_html_dir)
+
+        html_path = os.path.join(
+            os.path.dirname(inspect.getfile(self.__class__)),
+            'test_fixture',
+            'sample_errorgui_page.html')
+
+        with open(html_path, 'r') as f:
+            content = f.read()
+
+        chunks = [content[i:i + 1000] for i in range(0, len(content), 1000)]
+        builder.report_retriever.iter_html = mock.MagicMock(return_value=iter(chunks))
+
+        start_time = datetime(2018, 4, 8)
+        end_time = datetime(2018, 4, 8, 23, 59, 59)
+
+        # act
+        report = builder._load_report(start_time, end_time)
+
+        # assert
+        self.assertEqual(report['Website'], { 'website_error_key_1': 3, 'website_error_key_2': 5 })
+        builder.report_retriever.iter_html.assert_called_with(start_time, end_time, new_session=False)
+
+        with gzip.open(os.path.join(raw_html_dir, 'some_env__2018_04_08_00_00__2018_04_08_23_59.html.gz'), 'rt', encoding='utf-8') as f:
+            self.assertEqual(f.read(), content)
 
     def test_process_html(self):
         # arrange
@@ -213,10 +487,8 @@ class ErrorReportBuilderTestCase(unittest.TestCase):
         with open(html_path, 'r') as f:
             content = f.read()
 
-        html = pq(content)
-
         # act
-        report = builder._process_html(html)
+        report = builder._process_html(content)
 
         # assert
         self.assertEqual(
@@ -228,16 +500,457 @@ class ErrorReportBuilderTestCase(unittest.TestCase):
             }
         )
 
-    @mock.patch('errorguimonitor.report_builder.os')    
+    def test_build_reports_concurrent(self):
+        """ Test reports fetched concurrently are returned in the windows order """
+        # arrange
+        builder = report_builder.ErrorReportBuilder(
+            'some_env', 'user', 'password', store=history_store.HistoryStore(':memory:'), bucket_size=None)
+
+        windows = [
+            (datetime(2018, 4, 10), datetime(2018, 4, 10, 23, 59, 59)),
+            (datetime(2018, 4, 9), datetime(2018, 4, 9, 23, 59, 59)),
+            (datetime(2018, 4, 6), datetime(2018, 4, 6, 23, 59, 59))
+        ]
+
+        def side_effect(start_time, end_time):
+            # the first window completes last
+            time.sleep(0.05 * (len(windows) - [w[0] for w in windows].index(start_time)))
+            return { 'module': { 'key': start_time.day } }
+
+        builder._load_report = mock.MagicMock(side_effect=side_effect)
+
+        # act
+        reports = builder.build_reports(windows, max_workers=3)
+
+        # assert
+        self.assertEqual(reports, [{ 'module': { 'key': 10 } }, { 'module': { 'key': 9 } }, { 'module': { 'key': 6 } }])
+        self.assertEqual(builder._load_report.call_count, 3)
+
+    def test_build_report_no_report_exist(self):
+        # arrange
+        store = history_store.HistoryStore(':memory:')
+        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password', store=store, bucket_size=None)
+
+        builder._load_report = mock.MagicMock(return_value={ 'module': { 'key': 1 } })
+
+        start_time = datetime(2018, 4, 8)
+        end_time = datetime(2018, 4, 8, 23, 59, 59)
+
+        # act
+        report = builder.build_report(start_time, end_time)
+
+        # assert
+        self.assertEqual(report, { 'module': { 'key': 1 } })
+
+        builder._load_report.assert_called_with(start_time, end_time)
+        self.assertEqual(
+            store.get_reports('some_env', [(start_time, end_time)], settings.PARSER_VERSION), { (start_time, end_time): report })
+
+    def test_build_report_report_exist(self):
+        # arrange
+        start_time = datetime(2018, 4, 8)
+        end_time = datetime(2018, 4, 8, 23, 59, 59)
+
+        store = history_store.HistoryStore(':memory:')
+        store.put_report('some_env', start_time, end_time, { 'module': { 'key': 1 }, 'other': { 'key': 2 } }, settings.PARSER_VERSION)
+
+        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password', store=store)
+        builder._load_report = mock.MagicMock()
+
+        # act
+        report = builder.build_report(start_time, end_time, apps=['module'])
+
+        # assert
+        self.assertEqual(report, { 'module': { 'key': 1 } })
+        self.assertFalse(builder._load_report.called)
+
+    def test_fetch_report(self):
+        """ test a window is fetched in one request, across bucket edges, and never cached """
+        # arrange
+        store = history_store.HistoryStore(':memory:')
+        self.addCleanup(store.close)
+        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password', store=store, bucket_size=timedelta(hours=1))
+        builder._load_report = mock.MagicMock(return_value={ 'module': { 'key': 1 } })
+
+        window = (datetime(2018, 4, 9, 10, 45), datetime(2018, 4, 9, 11, 14, 59))
+
+        # act
+        report = builder.fetch_report(*window, apps=['module'])
+
+        # assert
+        self.assertEqual(report, { 'module': { 'key': 1 } })
+        builder._load_report.assert_called_once_with(window[0], window[1], ['module'])
+        self.assertEqual(store.get_reports('some_env', [window, (window[0], datetime(2018, 4, 9, 10, 59, 59))],
+                                           settings.PARSER_VERSION), {})
+
+    def test_build_reports_from_buckets(self):
+        """ test windows are put together from hourly buckets and only missing buckets are fetched """
+        # arrange
+        store = history_store.HistoryStore(':memory:')
+        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password', store=store, bucket_size=timedelta(hours=1))
+
+        def side_effect(start_time, end_time):
+            return { 'module': { 'key': 1, 'hour_{}'.format(start_time.hour): 1 } }
+
+        builder._load_report = mock.MagicMock(side_effect=side_effect)
+
+        # a cached day is reused as a whole
+        day = (datetime(2018, 4, 9), datetime(2018, 4, 9, 23, 59, 59))
+        store.put_report('some_env', day[0], day[1], { 'module': { 'day': 1 } }, settings.PARSER_VERSION)
+
+        # act
+        morning = builder.build_report(datetime(2018, 4, 10, 8), datetime(2018, 4, 10, 11, 59, 59))
+        reports = builder.build_reports([(datetime(2018, 4, 10, 10, 30), datetime(2018, 4, 10, 12, 59, 59)), day])
+
+        # assert
+        self.assertEqual(morning, { 'module': { 'key': 4, 'hour_8': 1, 'hour_9': 1, 'hour_10': 1, 'hour_11': 1 } })
+        self.assertEqual(reports, [{ 'module': { 'key': 3, 'hour_10': 1, 'hour_11': 1, 'hour_12': 1 } }, { 'module': { 'day': 1 } }])
+
+        builder._load_report.assert_has_calls([
+            mock.call(datetime(2018, 4, 10, 8), datetime(2018, 4, 10, 8, 59, 59)),
+            mock.call(datetime(2018, 4, 10, 9), datetime(2018, 4, 10, 9, 59, 59)),
+            mock.call(datetime(2018, 4, 10, 10), datetime(2018, 4, 10, 10, 59, 59)),
+            mock.call(datetime(2018, 4, 10, 11), datetime(2018, 4, 10, 11, 59, 59)),
+            mock.call(datetime(2018, 4, 10, 10, 30), datetime(2018, 4, 10, 10, 59, 59)),
+            mock.call(datetime(2018, 4, 10, 12), datetime(2018, 4, 10, 12, 59, 59))
+        ])
+        self.assertEqual(builder._load_report.call_count, 6)
+
+        # the cached day and the 11 o'clock bucket of the second call were hits
+        self.assertEqual(builder.metrics.counters[metrics.CACHE_HITS], 2)
+        self.assertEqual(builder.metrics.counters[metrics.CACHE_MISSES], 6)
+        self.assertEqual(builder.metrics.stages['cache_write']['calls'], 6)
+
+    def test_build_report_in_progress_parses_apps(self):
+        """ test a window still in progress is parsed for the apps asked for only and not cached """
+        # arrange
+        store = history_store.HistoryStore(':memory:')
+        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password', store=store, bucket_size=None)
+
+        html_path = os.path.join(
+            os.path.dirname(inspect.getfile(self.__class__)),
+            'test_fixture',
+            'sample_errorgui_page.html')
+
+        with open(html_path, 'r') as f:
+            builder.report_retriever.get_html = mock.MagicMock(return_value=f.read())
+
+        start_time = datetime.now().replace(microsecond=0)
+        end_time = start_time + timedelta(hours=1)
+
+        # act
+        report = builder.build_report(start_time, end_time, apps=['Search'])
+
+        # assert
+        self.assertEqual(report, { 'Search': { 'search_error_key': 2 } })
+        self.assertEqual(store.get_reports('some_env', [(start_time, end_time)], settings.PARSER_VERSION), {})
+
+class ErrorMatrixTestCase(unittest.TestCase):
+    def test_from_reports(self):
+        """ test days without a key are zeros and keys are sorted by app and key """
+        # arrange
+        reports = [
+            { 'Website': { 'b': 3, 'a': 1 } },
+            {},
+            { 'Search': { 'c': 2 }, 'Website': { 'b': 4 } }
+        ]
+
+        # act
+        matrix = error_matrix.ErrorMatrix.from_reports(reports)
+
+        # assert
+        self.assertEqual(matrix.keys, [('Search', 'c'), ('Website', 'a'), ('Website', 'b')])
+        self.assertEqual(matrix.apps, ['Search', 'Website'])
+        np.testing.assert_array_equal(matrix.counts, [[0, 1, 3], [0, 0, 0], [2, 0, 4]])
+        np.testing.assert_array_equal(matrix.get_counts('Website', 'b'), [3, 0, 4])
+        self.assertEqual(len(matrix.get_counts('Website', 'x')), 0)
+        np.testing.assert_array_equal(
+            matrix.get_columns(error_matrix.ErrorMatrix.from_reports([{ 'Search': { 'x': 1 }, 'Website': { 'b': 1 } }])), [-1, 2])
+        self.assertEqual(matrix.get_key(2), ('Website', 'b'))
+        self.assertEqual(
+            matrix.digest(),
+            error_matrix.ErrorMatrix.from_reports([{ 'Website': { 'a': 1, 'b': 3 } }, {}, { 'Website': { 'b': 4 }, 'Search': { 'c': 2 } }]).digest())
+
+class ReportRendererTestCase(unittest.TestCase):
+    def setUp(self):
+        self.significance_test = significance.PoissonRateTest()
+        self.new_errors = { 'Website': dict(('key_{}'.format(i), [i, 1]) for i in range(30)) }
+        self.errors_increased = { 'Website': { 'slow_key': [1.5, 2.5], 'fast_key': [3.0, 4.0] } }
+
+    def test_render_top_n(self):
+        """ test the top entries are listed by impact and the full results attached """
+        # arrange
+        renderer = report_renderer.ReportRenderer(self.significance_test, top_n=5)
+
+        # act
+        (body, attachments) = renderer.render([('QED', reporter.NOTIFICATION_LABELS, self.new_errors, self.errors_increased)])
+
+        # assert
+        self.assertTrue(body.index('key_29') < body.index('key_28') < body.index('key_25'))
+        self.assertNotIn('key_24', body)
+        self.assertTrue(body.index('fast_key') < body.index('slow_key'))
+        self.assertIn('25 more in the attached errors.csv.gz and errors.json.gz.', body)
+
+        self.assertEqual([name for (name, _) in attachments], ['errors.csv.gz', 'errors.json.gz'])
+        rows = json.loads(gzip.decompress(attachments[1][1]).decode('utf-8'))
+        self.assertEqual(len(rows), 32)
+        self.assertEqual(rows[0], { 'env': 'QED', 'app': 'Website', 'kind': 'new', 'rank': 1, 'key': 'key_29',
+                                    'occurrences': [29, 1] })
+        self.assertEqual(gzip.decompress(attachments[0][1]).decode('utf-8').splitlines()[:2], [
+            'env,app,kind,rank,key,occurrences,result', 'QED,Website,new,1,key_29,29 1,'])
+
+    def test_render_max_bytes(self):
+        """ test rows over the size cap are cut and attachments over half of it dropped, the larger first """
+        # arrange
+        sections = [('QED', reporter.NOTIFICATION_LABELS, self.new_errors, self.errors_increased)]
+
+        # act
+        (body, attachments) = report_renderer.ReportRenderer(
+            self.significance_test, top_n=0, max_bytes=report_renderer.RESERVED_BYTES + 2000).render(sections)
+        (small_body, small_attachments) = report_renderer.ReportRenderer(
+            self.significance_test, top_n=0, max_bytes=1000).render(sections)
+
+        # assert
+        self.assertEqual([name for (name, _) in attachments], ['errors.csv.gz', 'errors.json.gz'])
+        self.assertLess(len(body), 2000)
+        self.assertIn('key_29', body)
+        self.assertRegex(body, r'</table>\d+ more in the attached errors.csv.gz and errors.json.gz.')
+        # no room is left for the increased errors table
+        self.assertTrue(body.endswith('Errors increased:<br/>2 more in the attached errors.csv.gz and errors.json.gz.<br/><br/><br/>'))
+
+        self.assertEqual([name for (name, _) in small_attachments], ['errors.csv.gz'])
+        self.assertIn('The full results were not attached, errors.json.gz would take over half', small_body)
+
+    def test_render_message_size(self):
+        """ test the message stays under the cap as sent, with its body encoded for the transfer """
+        # arrange
+        new_errors = { 'Website': dict(('id={} caf\xe9={}'.format(i, '=' * (i % 40)), [i % 50 + 1]) for i in range(5000)) }
+        max_bytes = 64 * 1024
+
+        # act
+        (body, attachments) = report_renderer.ReportRenderer(self.significance_test, top_n=0, max_bytes=max_bytes).render(
+            [('QED', reporter.NOTIFICATION_LABELS, new_errors, {})], 'Thanks')
+        message = notifiers.build_message('subject', body, ['a@test.com'], attachments=attachments)
+
+        # assert
+        self.assertLessEqual(len(message.as_bytes()), max_bytes)
+        self.assertRegex(body, r'\d+ more ')
+
+class MetricsTestCase(unittest.TestCase):
+    def test_write(self):
+        # arrange
+        run_metrics = metrics.Metrics()
+        run_metrics.count(metrics.CACHE_HITS, 3)
+        run_metrics.count(metrics.CACHE_MISSES)
+        run_metrics.add_time('parse', 0.5)
+        with run_metrics.time('parse'):
+            pass
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        # act
+        run_metrics.write_json(os.path.join(tmp_dir, 'metrics.json'))
+        run_metrics.write_prometheus(os.path.join(tmp_dir, 'metrics.prom'))
+
+        # assert
+        with open(os.path.join(tmp_dir, 'metrics.json'), 'r') as f:
+            written = json.load(f)
+        self.assertEqual(written['counters'][metrics.CACHE_HITS], 3)
+        self.assertEqual(written['counters'][metrics.ROWS_PARSED], 0)
+        self.assertEqual(written['cache_hit_ratio'], 0.75)
+        self.assertEqual(written['stages']['parse']['calls'], 2)
+        self.assertGreaterEqual(written['stages']['parse']['seconds'], 0.5)
+
+        with open(os.path.join(tmp_dir, 'metrics.prom'), 'r') as f:
+            lines = f.read().splitlines()
+        self.assertIn('errorguimonitor_cache_hits_total 3', lines)
+        self.assertIn('errorguimonitor_cache_hit_ratio 0.75', lines)
+        self.assertIn('errorguimonitor_stage_calls_total{stage="parse"} 2', lines)
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ['metrics.json', 'metrics.prom'])
+
+class FilesTestCase(unittest.TestCase):
+    def test_atomic_open(self):
+        """ test a write failing half way keeps the file written before and leaves nothing aside """
+        # arrange
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'state.json')
+        with files.atomic_open(path) as f:
+            f.write('{}')
+
+        # act
+        with self.assertRaises(ValueError):
+            with files.atomic_open(path) as f:
+                f.write('{"half":')
+                raise ValueError('interrupted')
+
+        # assert
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), '{}')
+        self.assertEqual(os.listdir(tmp_dir), ['state.json'])
+
+class TrendStoreTestCase(unittest.TestCase):
+    def test_add_day(self):
+        """ test the ring keeps the last days, with the statistics updated and idle keys dropped, across a reload """
+        # arrange
+        trend_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trend_dir)
+        path = os.path.join(trend_dir, 'trend_env_3d.npz')
+        matrix = error_matrix.ErrorMatrix.from_reports([{ 'Search': { 'c': 1 }, 'Website': { 'a': 1, 'b': 1 } }])
+
+        # act
+        trend = trend_store.TrendStore(path, 3)
+        trend.add_day(datetime(2018, 4, 4), { 'Website': { 'a': 2, 'b': 1 } })
+        trend.add_day(datetime(2018, 4, 5), { 'Website': { 'a': 4 }, 'Search': { 'c': 3 } })
+        trend.add_day(datetime(2018, 4, 6), { 'Website': { 'a': 6 } })
+        trend.save()
+
+        reloaded = trend_store.TrendStore(path, 3)
+        reloaded.add_day(datetime(2018, 4, 9), { 'Website': { 'a': 8 } })
+
+        # assert
+        self.assertEqual(reloaded.matrix.keys, [('Search', 'c'), ('Website', 'a')])
+        np.testing.assert_array_equal(reloaded.get_baseline(matrix, trend_store.MEDIAN), [0, 6, -1])
+        np.testing.assert_array_equal(reloaded.get_baseline(matrix, trend_store.EWMA), [0.375, 6.25, -1])
+        np.testing.assert_array_equal(reloaded.get_baseline(matrix, trend_store.WEEKDAY, 3), [3, 4, -1])
+        np.testing.assert_array_equal(reloaded.get_baseline(matrix, trend_store.WEEKDAY, 0), [0, 8, -1])
+        self.assertRaises(ValueError, reloaded.add_day, datetime(2018, 4, 6), {})
+
+    def test_get_baseline_without_keys(self):
+        """ test a trend of days without any errors has no baseline for any key """
+        # arrange
+        trend = trend_store.TrendStore(None, 3)
+        trend.add_day(datetime(2018, 4, 4), {})
+        matrix = error_matrix.ErrorMatrix.from_reports([{ 'W': { 'a': 3 } }])
+
+        # act
+        baselines = [trend.get_baseline(matrix, statistic, 2) for statistic in settings.STATISTICS]
+
+        # assert
+        for baseline in baselines:
+            np.testing.assert_array_equal(baseline, [-1])
+
+class KeyNormalizerTestCase(unittest.TestCase):
+    def test_normalize_key(self):
+        """ test ids, GUIDs, timestamps and long numbers are collapsed, status codes are kept """
+        # act / assert
+        self.assertEqual(normalizer.normalize_key('User 123456 not found, id=42'), 'User <n> not found, id=<n>')
+        self.assertEqual(normalizer.normalize_key('Session 3f2504e0-4f89-11d3-9a0c-0305e82c3301 expired'), 'Session <guid> expired')
+        self.assertEqual(normalizer.normalize_key('Timeout at 2018-04-10T09:15:02.123Z'), 'Timeout at <timestamp>')
+        self.assertEqual(normalizer.normalize_key('Pointer 0x7ffde3a1 is null'), 'Pointer <hex> is null')
+        self.assertEqual(normalizer.normalize_key('HTTP 500 on step 3'), 'HTTP 500 on step 3')
+
+    def test_normalize_reports(self):
+        """ test keys of a fingerprint are summed under the canonical key indexed by the first run """
+        # arrange
+        store = history_store.HistoryStore(':memory:')
+        self.addCleanup(store.close)
+        key_normalizer = normalizer.KeyNormalizer(store, 'env')
+        windows = [(datetime(2018, 4, 9), datetime(2018, 4, 9, 23, 59, 59)), (datetime(2018, 4, 10), datetime(2018, 4, 10, 23, 59, 59))]
+
+        # act
+        key_normalizer.normalize_reports(windows[1:], [{ 'Website': { 'User 2000 not found': 1 } }])
+        (reports, first_seen) = key_normalizer.normalize_reports(windows, [
+            { 'Website': { 'User 1000 not found': 2, 'Bad request': 1 } },
+            { 'Website': { 'User 1000 not found': 3, 'User 3000 not found': 4 }, 'Search': { 'User 1000 not found': 1 } }
+        ])
+
+        # assert
+        self.assertEqual(reports, [
+            { 'Website': { 'User 2000 not found': 2, 'Bad request': 1 } },
+            { 'Website': { 'User 2000 not found': 7 }, 'Search': { 'User 1000 not found': 1 } }
+        ])
+        self.assertEqual(first_seen, {
+            ('Website', 'User 2000 not found'): datetime(2018, 4, 9),
+            ('Website', 'Bad request'): datetime(2018, 4, 9),
+            ('Search', 'User 1000 not found'): datetime(2018, 4, 10)
+        })
+
+    def test_normalize_reports_environments(self):
+        """ test a key seen in one environment is still first seen in another on its own days """
+        # arrange
+        store = history_store.HistoryStore(':memory:')
+        self.addCleanup(store.close)
+        windows = [(datetime(2018, 4, 3), datetime(2018, 4, 3, 23, 59, 59)), (datetime(2018, 4, 10), datetime(2018, 4, 10, 23, 59, 59))]
+        normalizer.KeyNormalizer(store, 'PROD').normalize_reports(windows[:1], [{ 'Website': { 'boom 1234': 1 } }])
+
+        # act
+        (reports, first_seen) = normalizer.KeyNormalizer(store, 'QED').normalize_reports(
+            windows[1:], [{ 'Website': { 'boom 5678': 2 } }])
+
+        # assert
+        self.assertEqual(reports, [{ 'Website': { 'boom 5678': 2 } }])
+        self.assertEqual(first_seen, { ('Website', 'boom 5678'): datetime(2018, 4, 10) })
+
+class ReportWindowsTestCase(unittest.TestCase):
+    def test_parse_length(self):
+        """ Test lengths in hours, days and weeks """
+        # act / assert
+        self.assertEqual(report_windows.parse_length('6h'), (6, 'h'))
+        self.assertEqual(report_windows.parse_length('5'), (5, 'd'))
+        self.assertEqual(report_windows.parse_length(5), (5, 'd'))
+        self.assertEqual(report_windows.parse_length('2W'), (10, 'd'))
+        for value in ['', '0d', '3m', 'd']:
+            self.assertRaises(ValueError, report_windows.parse_length, value)
+
+    def test_get_report_windows_hours(self):
+        """ Test target hours of today end with the last complete hour, history hours come right before them """
+        # arrange
+        now = datetime(2018, 4, 10, 9, 30)
+
+        # act
+        target_windows, history_windows = report_windows.get_report_windows(now, '2h', '3h', now=now)
+
+        # assert
+        self.assertEqual(target_windows, [(datetime(2018, 4, 10, 8), datetime(2018, 4, 10, 8, 59, 59)),
+                                          (datetime(2018, 4, 10, 7), datetime(2018, 4, 10, 7, 59, 59))])
+        self.assertEqual([start for (start, _) in history_windows],
+                         [datetime(2018, 4, 10, 6), datetime(2018, 4, 10, 5), datetime(2018, 4, 10, 4)])
+
+    def test_get_report_windows_same_hours(self):
+        """ Test history days of an hours target are the same hours of the business days before """
+        # arrange
+        date = datetime(2018, 4, 9)
+
+        # act
+        target_windows, history_windows = report_windows.get_report_windows(
+            date, '1h', '2d', holidays=[datetime(2018, 4, 5).date()], now=datetime(2018, 4, 12))
+
+        # assert
+        self.assertEqual(target_windows, [(datetime(2018, 4, 9, 23), datetime(2018, 4, 9, 23, 59, 59))])
+        self.assertEqual(history_windows, [(datetime(2018, 4, 6, 23), datetime(2018, 4, 6, 23, 59, 59)),
+                                           (datetime(2018, 4, 4, 23), datetime(2018, 4, 4, 23, 59, 59))])
+
+    def test_get_report_windows_history_hours(self):
+        """ Test a history in hours needs a target in hours """
+        # act / assert
+        self.assertRaises(ValueError, report_windows.get_report_windows, datetime(2018, 4, 9), '1d', '24h')
+
+    def test_load_holidays(self):
+        """ Test holiday files with comments """
+        # arrange
+        path = os.path.join(tempfile.mkdtemp(), 'holidays.txt')
+        with open(path, 'w') as f:
+            f.write('# Easter\n2018-04-02\n\n2018-03-30 # Good Friday\n')
+
+        # act
+        holidays = report_windows.load_holidays([path])
+
+        # assert
+        self.assertEqual(holidays, [datetime(2018, 3, 30).date(), datetime(2018, 4, 2).date()])
+        shutil.rmtree(os.path.dirname(path))
+
+class HistoryStoreTestCase(unittest.TestCase):
+    @mock.patch('errorguimonitor.history_store.os')
     def test_get_history_data_path_dir_not_exist(self, mock_os):
         # arrange
-        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password')
         mock_os.path.join.return_value = 'history_data'
         mock_os.path.isdir.return_value = False
         mock_os.makedirs.return_value = True
 
         # act
-        history_dir = builder._get_history_data_path()
+        history_dir = history_store.get_history_data_path()
 
         # assert
         expected_dir = 'history_data'
@@ -246,17 +959,15 @@ class ErrorReportBuilderTestCase(unittest.TestCase):
         mock_os.path.isdir.assert_called_with(expected_dir)
         mock_os.makedirs.assert_called_with(expected_dir)
 
-    @mock.patch('errorguimonitor.report_builder.os')
+    @mock.patch('errorguimonitor.history_store.os')
     def test_get_history_data_path_dir_exist(self, mock_os):
         # arrange
         mock_os.path.join.return_value = 'history_data'
         mock_os.path.isdir.return_value = True
         mock_os.makedirs.return_value = False
 
-        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password')
-
         # act
-        history_dir = builder._get_history_data_path()
+        history_dir = history_store.get_history_data_path()
 
         # assert
         expected_dir = 'history_data'
@@ -265,67 +976,333 @@ class ErrorReportBuilderTestCase(unittest.TestCase):
         mock_os.path.isdir.assert_called_with(expected_dir)
         self.assertFalse(mock_os.makedirs.called)
 
-    @mock.patch('errorguimonitor.report_builder.os')
-    @mock.patch('errorguimonitor.report_builder.pickle')
-    @mock.patch('errorguimonitor.report_builder.open')
-    def test_build_report_no_report_exist(self, mock_open, mock_pickle, mock_os):
+    def test_get_reports(self):
+        """ test several windows are loaded at once, limited to the apps and environment requested """
         # arrange
-        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password')
+        store = history_store.HistoryStore(':memory:')
 
-        builder._get_history_data_path = mock.MagicMock(return_value='history_data')
-        builder._load_report = mock.MagicMock(return_value={ 'module': { 'key': 1 } })
+        day_1 = (datetime(2018, 4, 5), datetime(2018, 4, 5, 23, 59, 59))
+        day_2 = (datetime(2018, 4, 6), datetime(2018, 4, 6, 23, 59, 59))
+        day_3 = (datetime(2018, 4, 9), datetime(2018, 4, 9, 23, 59, 59))
 
-        mock_os.path.join.return_value = 'path_does_not_exist'
-        mock_os.path.isfile.return_value = False
+        store.put_report('QED', day_1[0], day_1[1], { 'Website': { 'a': 1 }, 'Document': { 'd': 3 } }, 1)
+        store.put_report('QED', day_2[0], day_2[1], { 'Document': { 'd': 1 } }, 1)
+        store.put_report('PROD', day_3[0], day_3[1], { 'Website': { 'a': 5 } }, 1)
+        store.put_report('QED', day_3[0], day_3[1], { 'Website': { 'a': 5 } }, 0)
 
-        mock_pickle.dump.return_value = True
+        # act
+        reports = store.get_reports('QED', [day_1, day_2, day_3], 1, apps=['Website'])
 
-        mock_open.return_value = True
+        # assert
+        self.assertEqual(reports, { day_1: { 'Website': { 'a': 1 } }, day_2: {} })
 
-        start_time = datetime(2018, 4, 8)
-        end_time = datetime(2018, 4, 8, 23, 59, 59)
+    def test_migrate_pickles(self):
+        # arrange
+        history_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, history_dir)
+
+        with open(os.path.join(history_dir, '2018_04_08_00_00__2018_04_08_23_59.pkl'), 'wb') as f:
+            pickle.dump({ 'Website': { 'a': 1 } }, f)
+
+        store = history_store.HistoryStore(os.path.join(history_dir, history_store.DB_FILE_NAME))
 
         # act
-        report = builder.build_report(start_time, end_time)
+        migrated = store.migrate_pickles(history_dir, 'QED', 1)
 
         # assert
-        self.assertEqual(report, { 'module': { 'key': 1 } })
+        self.assertEqual(migrated, 1)
 
-        mock_os.path.join.assert_called_with('history_data', '2018_04_08_00_00__2018_04_08_23_59.pkl')
-        mock_os.path.isfile.assert_called_with('path_does_not_exist')
-        builder._load_report.assert_called_with(start_time, end_time)
-        mock_open.assert_called_with('path_does_not_exist', 'wb')
-        mock_pickle.dump.assert_called_with(report, True)
+        window = (datetime(2018, 4, 8), datetime(2018, 4, 8, 23, 59, 59))
+        self.assertEqual(store.get_reports('QED', [window], 1), { window: { 'Website': { 'a': 1 } } })
 
-    @mock.patch('errorguimonitor.report_builder.os')
-    @mock.patch('errorguimonitor.report_builder.pickle')
-    @mock.patch('errorguimonitor.report_builder.open')
-    def test_build_report_report_exist(self, mock_open, mock_pickle, mock_os):
+    def test_prune(self):
+        """ test stale parser versions go first, then least recently used windows until the size limit is met """
         # arrange
-        builder = report_builder.ErrorReportBuilder('some_env', 'user', 'password')
+        store = history_store.HistoryStore(':memory:')
 
-        builder._get_history_data_path = mock.MagicMock(return_value='history_data')
+        days = [(datetime(2018, 4, day), datetime(2018, 4, day, 23, 59, 59)) for day in (2, 3, 4, 5)]
+        for (start_time, end_time) in days:
+            store.put_report('QED', start_time, end_time, { 'Website': { 'key': 1 } }, 1)
+        store.put_report('QED', days[0][0], days[0][1], { 'Website': { 'key': 1 } }, 0)
 
-        mock_os.path.join.return_value = 'path_exists'
-        mock_os.path.isfile.return_value = True
+        window_bytes = len('Website') + len('key') + history_store.ROW_OVERHEAD_BYTES
 
-        mock_pickle.load.return_value = { 'module': { 'key': 1 } }
+        with mock.patch('errorguimonitor.history_store.datetime') as mock_datetime:
+            mock_datetime.strptime = datetime.strptime
+            mock_datetime.now.return_value = datetime(2030, 1, 1)
+            # the first day becomes the most recently used one
+            store.get_reports('QED', [days[0]], 1)
 
-        mock_open.return_value = True
+        # act
+        evicted = store.prune(1, max_bytes=2 * window_bytes)
 
-        start_time = datetime(2018, 4, 8)
-        end_time = datetime(2018, 4, 8, 23, 59, 59)
+        # assert
+        self.assertEqual(evicted, 3)
+        self.assertEqual(sorted(store.get_reports('QED', days, 1)), [days[0], days[3]])
+        self.assertEqual(store.stats()[0]['windows'], 2)
+        self.assertEqual(store.stats()[0]['errors'], 2)
+
+class ErrorTableParserTestCase(unittest.TestCase):
+    def _get_fixture(self):
+        html_path = os.path.join(
+            os.path.dirname(inspect.getfile(self.__class__)),
+            'test_fixture',
+            'sample_errorgui_page.html')
+
+        with open(html_path, 'r') as f:
+            return f.read()
+
+    def test_feed_in_chunks(self):
+        """ test the page fed in small chunks gives the same result as pyquery selectors """
+        # arrange
+        content = self._get_fixture()
+
+        expected = {}
+        html = pq(content)
+        for tr in html('div.borderedBoxWhite table.tablesorter tr')[1:]:
+            tr = pq(tr)
+            app = tr('td:eq(1)').text().strip()
+            key = tr('td:eq(2)').text().strip()
+            expected.setdefault(app, {}).setdefault(key, int(tr('td:eq(3)').text().strip()))
+
+        parser = report_parser.ErrorTableParser()
 
         # act
-        report = builder.build_report(start_time, end_time)
+        for i in range(0, len(content), 100):
+            parser.feed(content[i:i + 100])
+        report = parser.close()
 
         # assert
-        self.assertEqual(report, { 'module': { 'key': 1 } })
+        self.assertEqual(report, expected)
+        self.assertEqual(parser.rows_parsed, 5)
+
+    def test_rows_outside_report_table(self):
+        """ test only rows of tablesorter tables inside bordered boxes are parsed """
+        # arrange
+        content = (
+            '<table class="tablesorter"><tr><th>h</th></tr><tr><td></td><td>App</td><td>outside</td><td>1</td></tr></table>'
+            '<div class="borderedBoxWhite"><table class="tablesorter">'
+            '<tr><th>h</th></tr>'
+            '<tr><td></td><td> App </td><td><a>inside\n key</a></td><td>&nbsp;<a>7</a></td></tr>'
+            '<tr><td colspan="4">no more rows</td></tr>'
+            '</table></div>'
+        )
+
+        parser = report_parser.ErrorTableParser()
+
+        # act
+        parser.feed(content)
+        report = parser.close()
+
+        # assert
+        self.assertEqual(report, { 'App': { 'inside key': 7 } })
+
+class BootstrapMedianTestTestCase(unittest.TestCase):
+    def test_intervals(self):
+        """ test keys of different shapes are bootstrapped in one batch """
+        # arrange
+        test = significance.BootstrapMedianTest(n_resamples=1000, alpha=0.05, rng=np.random.default_rng(1))
+
+        targets = [[10], [5], [20, 22], [3]]
+        histories = [[5], [5, 6, 5, 7, 5], [1, 2, 1, 2], [3, 30, 3, 30]]
+
+        # act
+        intervals = test.intervals(targets, histories)
+
+        # assert
+        self.assertEqual(intervals.shape, (4, 2))
+        np.testing.assert_array_equal(intervals[0], [5, 5])
+        self.assertTrue(intervals[1][1] <= 0)
+        self.assertTrue(intervals[2][0] > 0)
+        self.assertTrue(intervals[3][0] < 0)
+
+    def test_intervals_match_per_key_bootstrap(self):
+        """ test the shared order statistics give the same intervals as resampling each key on its own """
+        # arrange
+        rng = np.random.default_rng(7)
+        target = np.array([12., 15., 9.])
+        history = np.array([3., 8., 5., 4., 10.])
+
+        test = significance.BootstrapMedianTest(n_resamples=20000, alpha=0.05, rng=np.random.default_rng(7))
+
+        target_medians = np.median(target[rng.integers(0, 3, (20000, 3))], axis=1)
+        history_medians = np.median(history[rng.integers(0, 5, (20000, 5))], axis=1)
+        expected = np.percentile(target_medians - history_medians, [2.5, 97.5])
+
+        # act
+        intervals = test.intervals([target], [history])
+
+        # assert
+        np.testing.assert_allclose(intervals[0], expected, atol=1.0)
+
+    def test_weighted_percentiles(self):
+        # arrange
+        values = np.array([[3., 1., 2.], [5., 5., -1.]])
+        weights = np.array([2, 5, 1])
+
+        # act
+        result = significance.weighted_percentiles(values, weights, [2.5, 50, 97.5])
+
+        # assert
+        expected = np.percentile(np.repeat(values, weights, axis=1), [2.5, 50, 97.5], axis=1).T
+        np.testing.assert_allclose(result, expected)
+
+class PoissonRateTestTestCase(unittest.TestCase):
+    def test_compare(self):
+        # arrange
+        test = significance.PoissonRateTest(alpha=0.05)
+
+        # act
+        results = test.compare([[10], [30], [5]], [[5, 5, 5, 5, 5], [5, 6, 4, 5, 5], [0, 0, 0, 0, 0]])
+
+        # assert
+        np.testing.assert_allclose(results[0], [0.9606, 4.1641], atol=1e-4)
+        np.testing.assert_array_equal(test.increased(results), [False, True, True])
+
+class PermutationTestTestCase(unittest.TestCase):
+    def test_compare_exact(self):
+        """ test the p-value is the share of all day relabellings at least as extreme as the observed one """
+        # arrange
+        test = significance.PermutationTest(alpha=0.05)
+
+        # act
+        results = test.compare([[10, 12], [4, 5]], [[5, 5, 5, 5, 5], [5, 6, 4, 5, 5]])
+
+        # assert
+        np.testing.assert_allclose(results[0], [6., 1. / 21])
+        self.assertAlmostEqual(results[1][0], -0.5)
+        np.testing.assert_array_equal(test.increased(results), [True, False])
+
+    def test_compare_sampled(self):
+        """ test random relabellings are drawn when there are too many to enumerate """
+        # arrange
+        test = significance.PermutationTest(alpha=0.05, max_permutations=500, rng=np.random.default_rng(3))
+
+        # act
+        results = test.compare([[20, 22, 25, 21, 30]], [[5, 5, 6, 4, 5, 7, 5, 3, 6, 5]])
+
+        # assert
+        self.assertAlmostEqual(results[0][0], 18.5)
+        # the observed labelling itself is always counted, so the p-value never drops to zero
+        self.assertTrue(1. / 501 <= results[0][1] < 0.01)
 
-        mock_os.path.join.assert_called_with('history_data', '2018_04_08_00_00__2018_04_08_23_59.pkl')
-        mock_os.path.isfile.assert_called_with('path_exists')
-        mock_open.assert_called_with('path_exists', 'rb')
-        mock_pickle.load.assert_called_with(True)
+    def test_get_min_p_value(self):
+        # arrange
+        test = significance.PermutationTest(max_permutations=100)
+
+        # act
+        p_values = [test.get_min_p_value(1, 6), test.get_min_p_value(2, 7), test.get_min_p_value(5, 15)]
+
+        # assert
+        np.testing.assert_almost_equal(p_values, [1. / 6, 1. / 21, 1. / 101])
+
+class ErrorWatcherTestCase(unittest.TestCase):
+    def test_poll(self):
+        """ test polls fetch the minutes since the last poll, alert a key once a day and go on after a restart """
+        # arrange
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        state_path = os.path.join(state_dir, 'watch_env.json')
+
+        builder = mock.MagicMock()
+        builder.env = 'env'
+        builder.build_reports.return_value = [{ 'Website': { 'a': 10, 'b': 12 } }, { 'Website': { 'a': 20 } }]
+        builder.fetch_report.side_effect = [
+            { 'Website': { 'a': 20, 'b': 9 } },
+            { 'Website': { 'a': 11, 'b': 1, 'c': 10 } },
+            { 'Website': { 'a': 1 } }
+        ]
+        notifier = mock.MagicMock()
+
+        error_watcher = watcher.ErrorWatcher(builder, notifier, state_path, ['a@test.com'], apps=['Website'], history_days_count=2)
+
+        # act
+        first = error_watcher.poll(datetime(2018, 4, 10, 10, 15, 30))
+        second = error_watcher.poll(datetime(2018, 4, 10, 10, 30, 10))
+        restarted = watcher.ErrorWatcher(builder, notifier, state_path, ['a@test.com'], apps=['Website'], history_days_count=2)
+        third = restarted.poll(datetime(2018, 4, 10, 10, 45))
+
+        # assert
+        self.assertEqual(first, [])
+        self.assertEqual(second, [('Website', 'a', 31, 15.0), ('Website', 'c', 10, 0)])
+        self.assertEqual(third, [])
+
+        builder.build_reports.assert_called_once_with(
+            [(datetime(2018, 4, 9), datetime(2018, 4, 9, 23, 59, 59)), (datetime(2018, 4, 6), datetime(2018, 4, 6, 23, 59, 59))],
+            1, apps=['Website'])
+        builder.fetch_report.assert_has_calls([
+            mock.call(datetime(2018, 4, 10), datetime(2018, 4, 10, 10, 14, 59), apps=['Website']),
+            mock.call(datetime(2018, 4, 10, 10, 15), datetime(2018, 4, 10, 10, 29, 59), apps=['Website']),
+            mock.call(datetime(2018, 4, 10, 10, 30), datetime(2018, 4, 10, 10, 44, 59), apps=['Website'])
+        ])
+        notifier.send.assert_called_once()
+        self.assertEqual(restarted.state['counts'], { 'Website': { 'a': 32, 'b': 10, 'c': 10 } })
+
+class NotifiersTestCase(unittest.TestCase):
+    @mock.patch('errorguimonitor.notifiers.smtplib')
+    def test_smtp_notifier_reuses_connection(self, mock_smtplib):
+        """ test messages share one SMTP connection, reopened after a failure """
+        # arrange
+        mock_smtplib.SMTPException = smtplib.SMTPException
+        mock_servers = [mock.MagicMock(), mock.MagicMock()]
+        mock_servers[0].send_message.side_effect = [None, None, smtplib.SMTPServerDisconnected()]
+        mock_smtplib.SMTP = mock.MagicMock(side_effect=mock_servers)
+
+        notifier = notifiers.SmtpNotifier('smtp_user', 'smtp_password')
+        messages = [notifiers.build_message('Test email {}'.format(i), 'Test email body', ['a@test.com']) for i in range(4)]
+
+        # act
+        notifier.send(messages[0])
+        notifier.send(messages[1])
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            notifier.send(messages[2])
+        notifier.send(messages[3])
+        notifier.close()
+
+        # assert
+        mock_smtplib.SMTP.assert_called_with('smtp.gmail.com', 587)
+        self.assertEqual(mock_smtplib.SMTP.call_count, 2)
+        mock_servers[0].login.assert_called_once_with('smtp_user', 'smtp_password')
+        self.assertEqual(mock_servers[0].send_message.call_count, 3)
+        mock_servers[1].send_message.assert_called_once_with(messages[3])
+        mock_servers[1].quit.assert_called_once()
+
+    def test_queued_notifier_retries(self):
+        """ test queued messages are delivered in order in the background and failures are retried """
+        # arrange
+        sink = mock.MagicMock()
+        sink.send.side_effect = [OSError('busy'), None, OSError('busy'), OSError('busy'), None]
+
+        run_metrics = metrics.Metrics()
+        notifier = notifiers.QueuedNotifier(sink, retries=1, retry_delay=0., metrics=run_metrics)
+        messages = [notifiers.build_message('Test email {}'.format(i), 'Test email body', ['a@test.com']) for i in range(3)]
+
+        # act
+        for message in messages:
+            notifier.send(message)
+        notifier.close()
+
+        # assert
+        self.assertEqual(sink.send.call_args_list, [
+            mock.call(messages[0]), mock.call(messages[0]), mock.call(messages[1]), mock.call(messages[1]), mock.call(messages[2])])
+        self.assertEqual(notifier.failed, [messages[1]])
+        self.assertEqual(run_metrics.stages['deliver_notification']['calls'], 3)
+        sink.close.assert_called_once()
+
+    def test_maildir_notifier(self):
+        # arrange
+        maildir = os.path.join(tempfile.mkdtemp(), 'mail')
+        self.addCleanup(shutil.rmtree, os.path.dirname(maildir))
+
+        notifier = notifiers.get_notifier('maildir:{}'.format(maildir))
+
+        # act
+        notifier.send(notifiers.build_message('Test email', 'Test email body', ['a@test.com']))
+
+        # assert
+        delivered = list(mailbox.Maildir(maildir))
+        self.assertEqual(len(delivered), 1)
+        self.assertEqual(delivered[0]['Subject'], 'Test email')
 
 class ErrorReportRetrieverTestCase(unittest.TestCase):
     def test_get_error_gui_url(self):
@@ -345,23 +1322,263 @@ class ErrorReportRetrieverTestCase(unittest.TestCase):
         )
         self.assertEqual(url, expected_url)
 
-    '''
     @mock.patch('errorguimonitor.report_retriever.requests')
-    def test_get_html(self, mock_requests):
+    def test_get_html_reuses_session(self, mock_requests):
+        """ test SAFE login happens once and the session is reused for the next report """
+        # arrange
+        start_time = datetime(2018, 4, 8)
+        end_time = datetime(2018, 4, 8, 23, 59, 59)
+
+        reauth_html = (
+            '<html><body><form action="https://errorgui/auth" method="post">'
+            '<input name="uid" value="user"/><input name="time" value="2018-04-08 10:00"/>'
+            '<input name="digest" value="abc"/></form></body></html>'
+        )
+        report_html = '<html><body>report</body></html>'
+
+        mock_session = mock.MagicMock()
+        mock_session.get.side_effect = [
+            mock.MagicMock(text=reauth_html), mock.MagicMock(text=report_html),
+            mock.MagicMock(text=report_html)
+        ]
+        mock_requests.session.return_value = mock_session
+
+        retriever = report_retriever.ErrorReportRetriever('QED', 'user', 'password')
+
+        # act
+        first_html = retriever.get_html(start_time, end_time)
+        second_html = retriever.get_html(start_time, end_time)
+
+        # assert
+        self.assertEqual(first_html, report_html)
+        self.assertEqual(second_html, report_html)
+
+        mock_requests.session.assert_called_once()
+        self.assertEqual(mock_session.post.call_count, 2)
+        mock_session.post.assert_called_with(
+            'https://errorgui/auth', headers=mock.ANY, data='uid=user&time=2018-04-08%2010%3A00&digest=abc', allow_redirects=True)
+        self.assertEqual(retriever.logins, 1)
+        self.assertEqual(retriever.logins_avoided, 1)
+
+    @mock.patch('errorguimonitor.report_retriever.requests')
+    def test_iter_html_stream(self, mock_requests):
+        """ test the report body is streamed in chunks after the re-auth form is submitted """
         # arrange
         start_time = datetime(2018, 4, 8)
         end_time = datetime(2018, 4, 8, 23, 59, 59)
-        
 
+        reauth_html = (
+            b'<form action="https://errorgui/auth"><input name="uid" value="user"/>'
+            b'<input name="time" value="t"/><input name="digest" value="abc"/></form>'
+        )
+        report_chunks = [b'<html><body>', b'report \xc3', b'\xa9</body></html>']
+
+        reauth_response = mock.MagicMock(encoding='utf-8')
+        reauth_response.iter_content.return_value = iter([reauth_html])
+        report_response = mock.MagicMock(encoding='utf-8')
+        report_response.iter_content.return_value = iter(report_chunks)
+
+        mock_session = mock.MagicMock()
+        mock_session.get.side_effect = [reauth_response, report_response]
+        mock_requests.session.return_value = mock_session
 
         retriever = report_retriever.ErrorReportRetriever('QED', 'user', 'password')
 
+        # act
+        html = ''.join(retriever.iter_html(start_time, end_time, chunk_size=1024))
+
+        # assert
+        self.assertEqual(html, '<html><body>report \xe9</body></html>')
+        mock_session.get.assert_called_with(mock.ANY, headers=mock.ANY, stream=True)
+        report_response.iter_content.assert_called_with(1024)
+        reauth_response.close.assert_called_once()
+        self.assertEqual(retriever.logins, 1)
+
+    @mock.patch('errorguimonitor.report_retriever.requests')
+    def test_get_html_session_expired(self, mock_requests):
+        """ test a new SAFE login happens when the re-auth form keeps coming back """
+        # arrange
+        start_time = datetime(2018, 4, 8)
+        end_time = datetime(2018, 4, 8, 23, 59, 59)
+
+        reauth_html = (
+            '<form action="https://errorgui/auth"><input name="uid" value="user"/>'
+            '<input name="time" value="t"/><input name="digest" value="abc"/></form>'
+        )
+        report_html = '<html><body>report</body></html>'
+
+        expired_session = mock.MagicMock()
+        expired_session.get.return_value = mock.MagicMock(text=reauth_html)
+
+        new_session = mock.MagicMock()
+        new_session.get.side_effect = [mock.MagicMock(text=reauth_html), mock.MagicMock(text=report_html)]
+        mock_requests.session.return_value = new_session
+
+        retriever = report_retriever.ErrorReportRetriever('QED', 'user', 'password')
+        retriever.session_pool.release(expired_session)
+
         # act
         html = retriever.get_html(start_time, end_time)
 
         # assert
-        self.assertIsNotNone(html)
-    '''
+        self.assertEqual(html, report_html)
+        expired_session.close.assert_called_once()
+        self.assertEqual(retriever.logins, 1)
+        self.assertEqual(retriever.logins_avoided, 0)
+
+    def test_get_html_stub_server(self):
+        """ test the SAFE login, re-auth form and expired session flow against the benchmarks stub server """
+        # arrange
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+        self.addCleanup(sys.path.pop, 0)
+        from stub_server import StubErrorGUI
+
+        windows = [(datetime(2018, 4, 10, hour), datetime(2018, 4, 10, hour, 59, 59)) for hour in range(3)]
+
+        # act
+        with StubErrorGUI(rows=20, session_requests=2) as stub:
+            retriever = report_retriever.ErrorReportRetriever(stub.env, 'user', 'password')
+            reports = [report_parser.ErrorTableParser() for _ in windows]
+            for (parser, window) in zip(reports, windows):
+                for chunk in retriever.iter_html(*window):
+                    parser.feed(chunk)
+            retriever.close()
+
+        # assert
+        self.assertEqual([sum(len(errors) for errors in parser.close().values()) for parser in reports], [20, 20, 20])
+        self.assertEqual((stub.logins, stub.reauths, stub.reports), (2, 2, 3))
+        self.assertEqual((retriever.logins, retriever.logins_avoided), (2, 1))
+        self.assertNotIn(stub.env, report_retriever.ENV)
+
+    def test_record_replay(self):
+        """ test pages recorded from the benchmarks stub server are replayed with the server gone """
+        # arrange
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+        self.addCleanup(sys.path.pop, 0)
+        from stub_server import StubErrorGUI
+
+        recordings_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, recordings_dir)
+
+        windows = [(datetime(2018, 4, 10, hour), datetime(2018, 4, 10, hour, 59, 59)) for hour in range(2)]
+
+        with StubErrorGUI(rows=20) as stub:
+            env_data = dict(report_retriever.ENV[stub.env])
+            retriever = report_retriever.ErrorReportRetriever(
+                stub.env, 'user', 'password', transport=transport.RecordingTransport(recordings_dir))
+            recorded = [retriever.get_html(*window) for window in windows]
+            retriever.close()
+
+        report_retriever.ENV[stub.env] = env_data
+        self.addCleanup(report_retriever.ENV.pop, stub.env)
+
+        # act
+        retriever = report_retriever.ErrorReportRetriever(
+            stub.env, 'user', 'password', transport=transport.ReplayTransport(recordings_dir))
+        replayed = [''.join(retriever.iter_html(*window, chunk_size=100)) for window in windows]
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            retriever.get_html(datetime(2018, 4, 11), datetime(2018, 4, 11, 0, 59, 59))
+        retriever.close()
+
+        # assert
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(stub.reports, 2)
+        self.assertIn('STUB__2018_04_10_00_00__2018_04_10_00_59.gz', os.listdir(recordings_dir))
+
+class CommandLineTestCase(unittest.TestCase):
+    def test_import_time(self):
+        """ test the command line is built without loading the modules the commands run on """
+        # arrange
+        heavy_modules = ['lxml', 'numpy', 'prettytable', 'pyquery', 'requests', 'smtplib', 'sqlite3']
+        code = (
+            'import sys, time; started = time.perf_counter(); from errorguimonitor import cli; '
+            'cli.get_parser().parse_args(["compare", "-e", "QED", "-d", "2018-04-10"]); '
+            'print(time.perf_counter() - started); print(",".join(sorted(set({}) & set(sys.modules))))'
+        ).format(heavy_modules)
+
+        # act
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        # assert
+        (seconds, loaded) = output.decode('utf-8').splitlines()
+        self.assertEqual(loaded, '')
+        self.assertLess(float(seconds), 0.25)
+
+    def test_cache_command_imports(self):
+        """ test the cache command opens the store without loading the modules reports are fetched with """
+        # arrange
+        heavy_modules = ['lxml', 'numpy', 'prettytable', 'pyquery', 'requests', 'smtplib']
+        code = (
+            'import sys; from errorguimonitor import cli, history_store; '
+            'history_store.get_store_path = lambda: ":memory:"; cli.command_line_runner(["cache", "stats"]); '
+            'print(",".join(sorted(set({}) & set(sys.modules))))'
+        ).format(heavy_modules)
+
+        # act
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        # assert
+        self.assertEqual(output.decode('utf-8').splitlines()[-1], '')
+
+    @mock.patch('errorguimonitor.cli.run_compare_command')
+    def test_command_line_runner_default_command(self, mock_run_compare_command):
+        # act
+        cli.command_line_runner(['-e', 'QED', '-d', '2018-04-10', '--test', 'bootstrap'])
+
+        # assert
+        (args, metrics) = mock_run_compare_command.call_args[0]
+        self.assertEqual(args['command'], 'compare')
+        self.assertEqual(args['environment'], ['QED'])
+        self.assertEqual(args['date'], datetime(2018, 4, 10))
+        self.assertEqual(args['test'], 'bootstrap')
+
+    @mock.patch('errorguimonitor.watcher.ErrorWatcher')
+    @mock.patch('errorguimonitor.report_builder.ErrorReportBuilder')
+    @mock.patch('errorguimonitor.reporter.ErrorCompareReporter')
+    @mock.patch('errorguimonitor.cli.get_queued_notifier')
+    def test_notifications_not_delivered(self, mock_get_queued_notifier, mock_reporter, mock_report_builder, mock_watcher):
+        """ test compare and watch exit with an error when a notification could not be delivered """
+        # arrange
+        mock_get_queued_notifier.return_value.failed = [{ 'Subject': 'Error report' }]
+        mock_report_builder.return_value.get_store_path.return_value = os.path.join(tempfile.gettempdir(), 'history.db')
+        options = ['-e', 'QED', '-u', 'user', '-p', 'password', '--notifier', 'stdout']
+
+        # act
+        with self.assertRaises(SystemExit) as compare_exit:
+            cli.command_line_runner(['compare', '-d', '2018-04-10'] + options)
+        with self.assertRaises(SystemExit) as watch_exit:
+            cli.command_line_runner(['watch'] + options)
+
+        # assert
+        self.assertEqual(compare_exit.exception.code, '1 notification(s) not delivered.')
+        self.assertEqual(watch_exit.exception.code, '1 notification(s) not delivered.')
+        self.assertEqual(mock_get_queued_notifier.return_value.close.call_count, 2)
+        self.assertTrue(mock_watcher.return_value.run.called)
+
+    @mock.patch('builtins.print')
+    @mock.patch('errorguimonitor.cli.get_queued_notifier')
+    @mock.patch('errorguimonitor.reporter.ErrorCompareReporter')
+    def test_permutation_test_windows(self, mock_reporter, mock_get_queued_notifier, mock_print):
+        """ test the permutation test is refused when no relabelling of the windows can reach alpha """
+        # arrange
+        mock_get_queued_notifier.return_value.failed = []
+        command = ['compare', '-e', 'QED', '-d', '2018-04-10', '-u', 'user', '-p', 'password', '--notifier', 'stdout',
+                   '--test', 'permutation', '--history-length', '5d']
+
+        # act
+        cli.command_line_runner(command + ['--target-length', '1d'])
+        refused = mock_reporter.called
+        cli.command_line_runner(command + ['--target-length', '2d'])
+
+        # assert
+        self.assertFalse(refused)
+        self.assertIn('1 target with 5 history windows', mock_print.call_args_list[0][0][0])
+        self.assertTrue(mock_reporter.called)
+
+    def test_significance_test_names(self):
+        # assert
+        self.assertEqual(settings.SIGNIFICANCE_TEST_NAMES, sorted(significance.SIGNIFICANCE_TESTS))
+        self.assertIn(settings.SIGNIFICANCE_TEST, significance.SIGNIFICANCE_TESTS)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file